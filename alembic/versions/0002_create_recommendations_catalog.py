@@ -0,0 +1,40 @@
+# alembic/versions/0002_create_recommendations_catalog.py
+"""create_recommendations_catalog
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.create_table('recommendations',
+        sa.Column('id', sa.String(), nullable=False),
+        sa.Column('location_key', sa.String(length=255), nullable=False),
+        sa.Column('language', sa.String(length=10), nullable=False),
+        sa.Column('budget', sa.String(length=32), nullable=True),
+        sa.Column('type', sa.String(length=32), nullable=False),
+        sa.Column('latitude', sa.Float(), nullable=True),
+        sa.Column('longitude', sa.Float(), nullable=True),
+        sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), onupdate=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('id', 'location_key', 'language', name=op.f('pk_recommendations'))
+    )
+    op.create_index('ix_recommendations_destination', 'recommendations', ['location_key', 'language', 'updated_at'], unique=False)
+    op.create_index('ix_recommendations_type', 'recommendations', ['type'], unique=False)
+
+def downgrade() -> None:
+    op.drop_index('ix_recommendations_type', table_name='recommendations')
+    op.drop_index('ix_recommendations_destination', table_name='recommendations')
+    op.drop_table('recommendations')
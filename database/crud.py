@@ -1,9 +1,11 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import update, delete
-from typing import List, Optional, Tuple
+from sqlalchemy import update, delete, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-from .models import User, Feedback, FeedbackType
+from .models import User, Feedback, FeedbackType, Recommendation
 
 
 # ========== User Operations ==========
@@ -98,15 +100,17 @@ async def get_user_feedback_history(
     """
     Получает историю лайков и дизлайков пользователя.
     Возвращает кортеж: (список ID понравившихся рекомендаций, список ID не понравившихся).
+    Списки упорядочены от старых отзывов к новым: по updated_at, так как отзыв может смениться
+    с лайка на дизлайк и обратно, а id разрешает совпадения времени.
     """
     liked_stmt = select(Feedback.recommendation_id).filter_by(
         user_telegram_id=user_telegram_id,
         feedback_type=FeedbackType.LIKE
-    )
+    ).order_by(Feedback.updated_at, Feedback.id)
     disliked_stmt = select(Feedback.recommendation_id).filter_by(
         user_telegram_id=user_telegram_id,
         feedback_type=FeedbackType.DISLIKE
-    )
+    ).order_by(Feedback.updated_at, Feedback.id)
 
     liked_results = await db.execute(liked_stmt)
     disliked_results = await db.execute(disliked_stmt)
@@ -132,4 +136,73 @@ async def remove_feedback(
         Feedback.recommendation_id == recommendation_id
     )
     await db.execute(stmt)
-    await db.commit()
\ No newline at end of file
+    await db.commit()
+
+
+# ========== Recommendation Catalog Operations ==========
+
+async def upsert_recommendations(
+    db: AsyncSession,
+    rows: List[Dict[str, Any]]
+) -> int:
+    """
+    Добавляет рекомендации в каталог или обновляет существующие (по id, месту и языку) одним запросом.
+    rows - словари с полями модели Recommendation без повторов ключа. Возвращает число переданных строк.
+    """
+    if not rows:
+        return 0
+    stmt = pg_insert(Recommendation).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Recommendation.id, Recommendation.location_key, Recommendation.language],
+        set_={
+            "budget": stmt.excluded.budget,
+            "type": stmt.excluded.type,
+            "latitude": stmt.excluded.latitude,
+            "longitude": stmt.excluded.longitude,
+            "payload": stmt.excluded.payload,
+            "updated_at": func.now(),
+        }
+    )
+    await db.execute(stmt)
+    await db.commit()
+    return len(rows)
+
+
+async def get_catalog_recommendations(
+    db: AsyncSession,
+    location_key: str,
+    language: str,
+    fresh_since: datetime,
+    budget: Optional[str] = None,
+    exclude_ids: Iterable[str] = (),
+    limit: int = 10
+) -> List[Recommendation]:
+    """
+    Получает свежие (обновленные не раньше fresh_since) рекомендации каталога для места назначения
+    на нужном языке, новые - первыми. Рекомендации с ID из exclude_ids не возвращаются.
+    """
+    stmt = select(Recommendation).where(
+        Recommendation.location_key == location_key,
+        Recommendation.language == language,
+        Recommendation.updated_at >= fresh_since
+    )
+    if budget:
+        stmt = stmt.where((Recommendation.budget == budget) | (Recommendation.budget.is_(None)))
+    exclude_ids = list(exclude_ids)
+    if exclude_ids:
+        stmt = stmt.where(Recommendation.id.notin_(exclude_ids))
+    stmt = stmt.order_by(Recommendation.updated_at.desc()).limit(limit)
+    result = await db.execute(stmt)
+    return list(result.scalars().all())
+
+
+async def get_recommendations_by_ids(
+    db: AsyncSession,
+    recommendation_ids: Iterable[str]
+) -> List[Recommendation]:
+    """Получает рекомендации каталога по списку ID (отсутствующие в каталоге пропускаются)."""
+    recommendation_ids = list(recommendation_ids)
+    if not recommendation_ids:
+        return []
+    result = await db.execute(select(Recommendation).where(Recommendation.id.in_(recommendation_ids)))
+    return list(result.scalars().all())
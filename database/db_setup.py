@@ -6,6 +6,7 @@ from dotenv import load_dotenv
 import logging
 
 from .models import Base # Импортируем Base из нашего models.py
+from utils.metrics import instrument_sqlalchemy_engine
 
 # Загружаем переменные окружения (если еще не загружены глобально в main.py)
 # load_dotenv() # Лучше, чтобы это было сделано в main.py
@@ -19,6 +20,7 @@ DATABASE_NAME = os.getenv("POSTGRES_DB", "travel_bot_db")
 DATABASE_URL = f"postgresql+asyncpg://{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
 
 async_engine = create_async_engine(DATABASE_URL, echo=False) # echo=True для отладки SQL запросов
+instrument_sqlalchemy_engine(async_engine)  # Длительность каждого запроса -> db_query_duration_seconds
 AsyncSessionLocal = sessionmaker(
     bind=async_engine, class_=AsyncSession, expire_on_commit=False
 )
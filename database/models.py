@@ -1,5 +1,6 @@
 # database/models.py
-from sqlalchemy import Column, String, BigInteger, Enum as SAEnum, ForeignKey, DateTime, UniqueConstraint
+from sqlalchemy import Column, String, BigInteger, Enum as SAEnum, ForeignKey, DateTime, UniqueConstraint, Float, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from sqlalchemy.orm import declarative_base, relationship
 import enum
@@ -35,4 +36,25 @@ class Feedback(Base):
         UniqueConstraint('user_telegram_id', 'recommendation_id', name='uq_user_recommendation_feedback'),
     )
     def __repr__(self):
-        return f"<Feedback(id={self.id}, user_id={self.user_telegram_id}, rec_id='{self.recommendation_id}', type='{self.feedback_type.value}')>"
\ No newline at end of file
+        return f"<Feedback(id={self.id}, user_id={self.user_telegram_id}, rec_id='{self.recommendation_id}', type='{self.feedback_type.value}')>"
+
+class Recommendation(Base):
+    """Каталог рекомендаций, когда-либо сгенерированных AI (upsert по id, месту и языку)."""
+    __tablename__ = "recommendations"
+    # ID придумывает модель, поэтому один и тот же ID может встретиться для другого места или языка
+    id = Column(String, primary_key=True) # ID от AI, например "hotel_le_bristol_paris_01"
+    location_key = Column(String(255), primary_key=True) # Нормализованное место и профиль запроса (см. utils/recommendation_catalog.py)
+    language = Column(String(10), primary_key=True) # Тексты в payload написаны на этом языке
+    budget = Column(String(32), nullable=True)
+    type = Column(String(32), nullable=False)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+    payload = Column(JSONB, nullable=False) # Рекомендация целиком, в том виде, в каком ее показывает бот
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+    __table_args__ = (
+        Index('ix_recommendations_destination', 'location_key', 'language', 'updated_at'),
+        Index('ix_recommendations_type', 'type'),
+    )
+    def __repr__(self):
+        return f"<Recommendation(id='{self.id}', location_key='{self.location_key}', type='{self.type}')>"
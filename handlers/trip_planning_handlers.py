@@ -1,123 +1,44 @@
+import asyncio
 import logging
-from typing import Union, Dict, Any, List
+from typing import Union, Dict, Any, List, Optional, Tuple
 from aiogram import Router, F, Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import Message, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, \
-    ContentType
+    ContentType, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from handlers.trip_planning_states import TripPlanning
-from utils.ai_integration import get_travel_recommendations
+from middlewares.fsm_snapshot_middleware import flush_state
+from utils.ai_integration import get_travel_recommendations, stream_travel_recommendations, AI_STREAMING_ENABLED
+from utils.ai_prefetch import recommendation_prefetcher
+from utils.ranking import rank_for_user
 from utils.localization import get_text
+from utils.card_renderer import card_renderer
+from utils.telegram_sender import telegram_sender, TELEGRAM_ALBUM_MODE
+from utils.telegram_media_cache import telegram_media_cache
+from utils.logging_setup import LogPayload
+
+ALBUM_MAX_SIZE = 10  # Ограничение sendMediaGroup
+ALBUM_LINK_BUTTONS_PER_ROW = 4
+# Ответы Telegram, которые означают, что не удалось получить саму картинку (по file_id или URL).
+# Только такие ошибки попадают в кэш медиа: подпись, разметка или клавиатура тут ни при чем.
+PHOTO_FETCH_ERRORS = (
+    "wrong file identifier/http url specified",
+    "failed to get http url content",
+    "wrong type of the web page content",
+)
 
 
 # from database.models import FeedbackType
 # from database import crud
 
 async def _format_recommendation_text(recommendation: dict, lang: str = "ru") -> str:
-    # КОД ФУНКЦИИ _format_recommendation_text ОСТАЕТСЯ ТЕМ ЖЕ, ЧТО И В ПРЕДЫДУЩЕМ ОТВЕТЕ
-    # (Я его здесь сократил для краткости полного файла)
+    """HTML-текст карточки рекомендации (шаблоны и готовые карточки кэширует card_renderer)."""
     logging.debug(
         f"Форматирование рекомендации (lang={lang}): ID={recommendation.get('id')}, Тип={recommendation.get('type')}")
-    rec_type_map_general = {"route": "🗺️", "hotel": "🏨", "museum": "🏛️", "restaurant": "🍽️", "event": "🎉",
-                            "activity": "🤸", "transport_option": "🚌"}
-    rec_type = recommendation.get("type", "unknown")
-    name_from_ai = recommendation.get('name', get_text('text_no_name', lang))
-    text_parts = [f"<b>{rec_type_map_general.get(rec_type, '⭐')}: {name_from_ai}</b>"]
-    address = recommendation.get('address')
-    if address and isinstance(address, str) and address.lower() != "null" and address.strip() != "": text_parts.append(
-        f"📍 <b>{get_text('text_address', lang)}:</b> {address}")
-    description = recommendation.get('description')
-    if description and isinstance(description, str) and description.strip() != "": text_parts.append(
-        f"📝 <i>{description}</i>")
-    details = recommendation.get("details")
-    detail_str_parts = []
-    if details and isinstance(details, dict) and details:
-        if rec_type == "route":
-            route_type_val = details.get("route_type")
-            if route_type_val and isinstance(route_type_val, str) and route_type_val.strip(): detail_str_parts.append(
-                f"<b>{get_text('detail_route_type', lang)}:</b> {route_type_val}")
-            stops_list = details.get("stops")
-            if stops_list and isinstance(stops_list, list) and stops_list:
-                stops_names = [s['name'] for s in stops_list[:3] if isinstance(s, dict) and s.get("name")]
-                if stops_names:
-                    stops_text = " → ".join(stops_names)
-                    if len(stops_list) > 3: stops_text += f" {get_text('text_and_more', lang)}"
-                    detail_str_parts.append(f"<b>{get_text('detail_stops', lang)}:</b> {stops_text}")
-        elif rec_type == "hotel":  # ... и так далее, вся твоя логика форматирования деталей ...
-            stars_value = details.get("stars")
-            if stars_value is not None and str(stars_value).lower() != 'null':
-                try:
-                    stars_num = int(stars_value)
-                    if 0 < stars_num <= 5:
-                        detail_str_parts.append(
-                            f"<b>{get_text('detail_hotel_stars', lang)}:</b> {'⭐' * stars_num} ({stars_num})")
-                    elif stars_num != 0:
-                        detail_str_parts.append(f"<b>{get_text('detail_hotel_stars', lang)}:</b> {stars_value}")
-                except (ValueError, TypeError):
-                    if isinstance(stars_value, str) and str(stars_value).strip(): detail_str_parts.append(
-                        f"<b>{get_text('detail_hotel_stars', lang)}:</b> {stars_value}")
-            amenities = details.get("amenities")
-            if amenities and isinstance(amenities, list) and amenities:
-                amenities_text = ", ".join(amenities[:4])
-                if len(amenities) > 4: amenities_text += f" {get_text('text_and_more', lang)}"
-                detail_str_parts.append(f"<b>{get_text('detail_hotel_amenities', lang)}:</b> {amenities_text}")
-        elif rec_type == "restaurant":
-            cuisine_types = details.get("cuisine_type")
-            if cuisine_types:
-                if isinstance(cuisine_types, list) and cuisine_types:
-                    detail_str_parts.append(
-                        f"<b>{get_text('detail_restaurant_cuisine', lang)}:</b> {', '.join(cuisine_types)}")
-                elif isinstance(cuisine_types, str) and cuisine_types.strip() and cuisine_types.lower() != 'null':
-                    detail_str_parts.append(f"<b>{get_text('detail_restaurant_cuisine', lang)}:</b> {cuisine_types}")
-            average_bill = details.get("average_bill")
-            if average_bill and isinstance(average_bill,
-                                           str) and average_bill.lower() != 'null' and average_bill.strip() != "": detail_str_parts.append(
-                f"<b>{get_text('detail_restaurant_avg_bill', lang)}:</b> {average_bill}")
-        elif rec_type == "event":
-            event_dates = details.get("event_dates")
-            if event_dates:
-                if isinstance(event_dates, list) and event_dates:
-                    detail_str_parts.append(f"<b>{get_text('detail_event_dates', lang)}:</b> {', '.join(event_dates)}")
-                elif isinstance(event_dates, str) and event_dates.strip() and event_dates.lower() != 'null':
-                    detail_str_parts.append(f"<b>{get_text('detail_event_dates', lang)}:</b> {event_dates}")
-            ticket_info = details.get("ticket_info")
-            if ticket_info and isinstance(ticket_info,
-                                          str) and ticket_info.lower() != 'null' and ticket_info.strip() != "": detail_str_parts.append(
-                f"<b>{get_text('detail_ticket_info', lang)}:</b> {ticket_info}")
-        elif rec_type in ["museum", "activity"]:
-            ticket_info = details.get("ticket_info")
-            if ticket_info and isinstance(ticket_info,
-                                          str) and ticket_info.lower() != 'null' and ticket_info.strip() != "": detail_str_parts.append(
-                f"<b>{get_text('detail_ticket_info', lang)}:</b> {ticket_info}")
-    if detail_str_parts: text_parts.append(
-        f"\n<b>{get_text('text_details_header', lang)}:</b>\n" + "\n".join([f"  • {d}" for d in detail_str_parts]))
-    dist_time = recommendation.get('distance_or_time')
-    if dist_time and isinstance(dist_time,
-                                str) and dist_time.lower() != "null" and dist_time.strip() != "": text_parts.append(
-        f"🚗/🚶 <b>{get_text('text_distance_time', lang)}:</b> {dist_time}")
-    price_est = recommendation.get('price_estimate')
-    if price_est and isinstance(price_est,
-                                str) and price_est.lower() != "null" and price_est.strip() != "": text_parts.append(
-        f"💰 <b>{get_text('text_price', lang)}:</b> {price_est}")
-    rating_val = recommendation.get('rating')
-    if rating_val is not None and str(rating_val).lower() != "null":
-        try:
-            rating_float = float(rating_val)
-            if rating_float > 0:
-                text_parts.append(f"🌟 <b>{get_text('text_rating', lang)}:</b> {rating_float:.1f}/5")
-            elif isinstance(rating_val, str) and rating_val.strip() and rating_val.strip().lower() not in ["0", "0.0",
-                                                                                                           "null"]:
-                text_parts.append(f"🌟 <b>{get_text('text_rating', lang)}:</b> {rating_val}")
-        except (ValueError, TypeError):
-            if isinstance(rating_val,
-                          str) and rating_val.strip() and rating_val.strip().lower() != "null": text_parts.append(
-                f"🌟 <b>{get_text('text_rating', lang)}:</b> {rating_val}")
-    oh = recommendation.get('opening_hours')
-    if oh and isinstance(oh, str) and oh.lower() != "null" and oh.strip() != "": text_parts.append(
-        f"⏰ <b>{get_text('text_opening_hours', lang)}:</b> {oh}")
-    return "\n\n".join(text_parts)
+    return card_renderer.render(recommendation, lang)
 
 
 trip_planning_router = Router(name="trip_planning_router")
@@ -128,14 +49,8 @@ async def get_user_language(state: FSMContext, default_lang: str = "ru") -> str:
     return user_data.get("user_language", default_lang)
 
 
-async def _send_recommendations_batch(
-        target_message_entity: Union[Message, CallbackQuery],
-        bot: Bot,
-        recommendations_list: List[Dict[str, Any]],
-        lang: str,
-        is_more_request: bool = False
-) -> List[str]:
-    shown_ids_this_batch = []
+def _resolve_chat_target(target_message_entity: Union[Message, CallbackQuery]) -> Tuple[int, int, Message]:
+    """Возвращает (chat_id, base_message_id, сообщение для ответа) для Message или CallbackQuery."""
     if isinstance(target_message_entity, CallbackQuery):
         chat_id = target_message_entity.message.chat.id
         base_message_id = target_message_entity.message.message_id  # Для генерации уникальных временных ID
@@ -144,119 +59,468 @@ async def _send_recommendations_batch(
         chat_id = target_message_entity.chat.id
         base_message_id = target_message_entity.message_id
         message_to_answer_or_send_new = target_message_entity
+    return chat_id, base_message_id, message_to_answer_or_send_new
+
+
+async def _send_recommendations_batch(
+        target_message_entity: Union[Message, CallbackQuery],
+        bot: Bot,
+        recommendations_list: List[Dict[str, Any]],
+        lang: str,
+        is_more_request: bool = False
+) -> List[str]:
+    shown_ids_this_batch = []
+    _, _, message_to_answer_or_send_new = _resolve_chat_target(target_message_entity)
 
     if not recommendations_list:  # Если список пуст (например, после фильтрации)
         no_recs_key = "ai_no_more_recommendations_found" if is_more_request else "ai_no_recommendations_found"
-        await message_to_answer_or_send_new.answer(get_text(no_recs_key, lang))
+        await _send_text(message_to_answer_or_send_new, get_text(no_recs_key, lang))
         return shown_ids_this_batch
 
+    cards = []
     for rec_idx, rec_data in enumerate(recommendations_list):
-        if not isinstance(rec_data, dict):
-            logging.warning(f"Элемент #{rec_idx} в recommendations не словарь: {rec_data}")
+        card = await _prepare_recommendation_card(target_message_entity, rec_data, rec_idx, lang, is_more_request)
+        if card:
+            cards.append(card)
+            shown_ids_this_batch.append(card["id"])
+
+    # Все отправки ставятся в очередь чата сразу: планировщик отправляет их по порядку с учетом лимитов Telegram
+    pending_sends = []
+    photo_run: List[Dict[str, Any]] = []  # Подряд идущие карточки с фото - кандидаты в альбом
+
+    def flush_photo_run():
+        for start in range(0, len(photo_run), ALBUM_MAX_SIZE):
+            album_cards = photo_run[start:start + ALBUM_MAX_SIZE]
+            if len(album_cards) > 1:  # Альбом из одной фотографии Telegram не принимает
+                pending_sends.append(_queue_album(target_message_entity, bot, album_cards, lang))
+            else:
+                pending_sends.append(_queue_card(target_message_entity, bot, album_cards[0], lang))
+        photo_run.clear()
+
+    # Порядок карточек (после ранжирования) сохраняется: альбомом уходят только соседние карточки с фото
+    for card in cards:
+        if TELEGRAM_ALBUM_MODE and card["photo_url"]:
+            photo_run.append(card)
             continue
+        flush_photo_run()
+        pending_sends.append(_queue_card(target_message_entity, bot, card, lang))
+    flush_photo_run()
+    await asyncio.gather(*pending_sends)
 
-        rec_id_for_log = rec_data.get("id", f"temp_id_log_{rec_idx}")  # Для логов, если ID нет
-        logging.info(f"--- Обработка рекомендации ID: {rec_id_for_log} ---")
+    return shown_ids_this_batch
 
-        formatted_text = await _format_recommendation_text(rec_data, lang)
-        buttons_row1 = []  # Кнопки Бронь/На карте
-        buttons_row2 = []  # Кнопки Лайк/Дизлайк
 
-        recommendation_id_for_feedback = rec_data.get("id")
-        if not recommendation_id_for_feedback or not isinstance(recommendation_id_for_feedback,
-                                                                str) or not recommendation_id_for_feedback.strip():
-            id_prefix = "temp_more_rec_" if is_more_request else "temp_rec_"
-            recommendation_id_for_feedback = f"{id_prefix}{chat_id}_{base_message_id}_{rec_idx}"
+async def _queue_recommendation_card(
+        target_message_entity: Union[Message, CallbackQuery],
+        bot: Bot,
+        rec_data: Dict[str, Any],
+        rec_idx: int,
+        lang: str,
+        is_more_request: bool = False
+) -> Optional[Tuple[str, "asyncio.Future[Any]"]]:
+    """
+    Ставит карточку рекомендации в очередь отправки чата (telegram_sender).
+    Возвращает (ID показанной рекомендации, future отправки) или None, если карточку не из чего собрать.
+    """
+    card = await _prepare_recommendation_card(target_message_entity, rec_data, rec_idx, lang, is_more_request)
+    if not card:
+        return None
+    return card["id"], _queue_card(target_message_entity, bot, card, lang)
+
+
+async def _prepare_recommendation_card(
+        target_message_entity: Union[Message, CallbackQuery],
+        rec_data: Dict[str, Any],
+        rec_idx: int,
+        lang: str,
+        is_more_request: bool = False
+) -> Optional[Dict[str, Any]]:
+    """
+    Собирает данные карточки: ID для фидбека, текст, ссылки для кнопок "Бронь" и "На карте" и фото.
+    Возвращает None, если элемент ответа AI не является рекомендацией.
+    """
+    chat_id, base_message_id, _ = _resolve_chat_target(target_message_entity)
+
+    if not isinstance(rec_data, dict):
+        logging.warning("Элемент #%d в recommendations не словарь: %s", rec_idx, LogPayload(rec_data, sample_rate=1.0))
+        return None
+
+    rec_id_for_log = rec_data.get("id", f"temp_id_log_{rec_idx}")  # Для логов, если ID нет
+    logging.info(f"--- Обработка рекомендации ID: {rec_id_for_log} ---")
+
+    formatted_text = await _format_recommendation_text(rec_data, lang)
+    booking_url = None
+    maps_url = None
+
+    recommendation_id_for_feedback = rec_data.get("id")
+    if not recommendation_id_for_feedback or not isinstance(recommendation_id_for_feedback,
+                                                            str) or not recommendation_id_for_feedback.strip():
+        id_prefix = "temp_more_rec_" if is_more_request else "temp_rec_"
+        recommendation_id_for_feedback = f"{id_prefix}{chat_id}_{base_message_id}_{rec_idx}"
+        logging.warning(
+            f"AI не предоставил ID для рекомендации (name: {rec_data.get('name')}), используется временный: {recommendation_id_for_feedback}")
+
+    # Формирование кнопок "Бронь/Билеты"
+    booking_url_value = rec_data.get('booking_link')
+    # Промпт просит JSON null, если ссылки нет. Python превратит это в None.
+
+    # --- НАЧАЛО ПРОВЕРКИ ДЛЯ booking_url_value ---
+    is_valid_booking_url_condition = False  # Флаг для отладки
+    if booking_url_value:  # Шаг 1: Убедимся, что это не None и не пустая строка
+        if isinstance(booking_url_value, str):  # Шаг 2: Убедимся, что это строка
+            cleaned_booking_url = booking_url_value.strip()
+            if cleaned_booking_url and cleaned_booking_url.lower() not in ["null",
+                                                                           "none"]:  # Шаг 3: Не "null", "none" и не пустая после strip
+                if cleaned_booking_url.startswith("http://") or cleaned_booking_url.startswith(
+                        "https://"):  # Шаг 4: Валидный URL
+                    is_valid_booking_url_condition = True
+    # --- КОНЕЦ ПРОВЕРКИ ДЛЯ booking_url_value ---
+
+    if is_valid_booking_url_condition:
+        logging.debug(
+            f"Rec ID: {recommendation_id_for_feedback} - Добавляем кнопку 'Бронь/Билеты' URL: {booking_url_value}")
+        booking_url = booking_url_value.strip()  # Добавил strip() для URL
+    else:
+        logging.debug(
+            f"Rec ID: {recommendation_id_for_feedback} - НЕТ кнопки 'Бронь/Билеты'. booking_link: '{booking_url_value}' (тип: {type(booking_url_value)}), Условие: {is_valid_booking_url_condition}")
+
+    # Формирование кнопок "На карте"
+    coords_value = rec_data.get('coordinates')
+    # Промпт просит список из 2 чисел или JSON null.
+
+    # --- НАЧАЛО ПРОВЕРКИ ДЛЯ coords_value ---
+    is_valid_coords_condition = False  # Флаг для отладки
+    lat, lon = None, None  # Инициализируем
+    if isinstance(coords_value, list) and len(coords_value) == 2:  # Шаг 1: Список из двух элементов
+        try:
+            val1 = coords_value[0]
+            val2 = coords_value[1]
+            # AI может прислать числа как строки, поэтому float() обязателен
+            # Также AI может прислать строку "null" или None внутри списка
+            if val1 is not None and str(val1).lower() != "null" and \
+                    val2 is not None and str(val2).lower() != "null":
+                lat = float(val1)
+                lon = float(val2)
+                is_valid_coords_condition = True  # Шаг 2: Успешная конвертация в float
+        except (ValueError, TypeError, IndexError) as e_coord:
             logging.warning(
-                f"AI не предоставил ID для рекомендации (name: {rec_data.get('name')}), используется временный: {recommendation_id_for_feedback}")
-        shown_ids_this_batch.append(recommendation_id_for_feedback)
-
-        # Формирование кнопок "Бронь/Билеты"
-        booking_url_value = rec_data.get('booking_link')
-        # Промпт просит JSON null, если ссылки нет. Python превратит это в None.
-
-        # --- НАЧАЛО ПРОВЕРКИ ДЛЯ booking_url_value ---
-        is_valid_booking_url_condition = False  # Флаг для отладки
-        if booking_url_value:  # Шаг 1: Убедимся, что это не None и не пустая строка
-            if isinstance(booking_url_value, str):  # Шаг 2: Убедимся, что это строка
-                cleaned_booking_url = booking_url_value.strip()
-                if cleaned_booking_url and cleaned_booking_url.lower() not in ["null",
-                                                                               "none"]:  # Шаг 3: Не "null", "none" и не пустая после strip
-                    if cleaned_booking_url.startswith("http://") or cleaned_booking_url.startswith(
-                            "https://"):  # Шаг 4: Валидный URL
-                        is_valid_booking_url_condition = True
-        # --- КОНЕЦ ПРОВЕРКИ ДЛЯ booking_url_value ---
-
-        if is_valid_booking_url_condition:
-            logging.debug(
-                f"Rec ID: {recommendation_id_for_feedback} - Добавляем кнопку 'Бронь/Билеты' URL: {booking_url_value}")
-            buttons_row1.append(InlineKeyboardButton(text=get_text("button_book_tickets", lang),
-                                                     url=booking_url_value.strip()))  # Добавил strip() для URL
-        else:
-            logging.debug(
-                f"Rec ID: {recommendation_id_for_feedback} - НЕТ кнопки 'Бронь/Билеты'. booking_link: '{booking_url_value}' (тип: {type(booking_url_value)}), Условие: {is_valid_booking_url_condition}")
+                f"Rec ID: {recommendation_id_for_feedback} - Ошибка конвертации координат: {coords_value}, ошибка: {e_coord}. Кнопка 'На карте' не будет добавлена.")
+            is_valid_coords_condition = False  # Явно ставим False при ошибке
+    # --- КОНЕЦ ПРОВЕРКИ ДЛЯ coords_value ---
+
+    if is_valid_coords_condition:  # Проверяем флаг
+        maps_url = f"https://www.google.com/maps/search/?api=1&query={lat},{lon}"
+        logging.debug(
+            f"Rec ID: {recommendation_id_for_feedback} - Добавляем кнопку 'На карте'. Coords: [{lat},{lon}]")
+    else:
+        logging.debug(
+            f"Rec ID: {recommendation_id_for_feedback} - НЕТ кнопки 'На карте'. coordinates: {coords_value} (тип: {type(coords_value)}), Условие: {is_valid_coords_condition}")
+
+    images = rec_data.get("images", [])
+    photo_url = None
+    if images and isinstance(images, list) and images and isinstance(images[0], str) and images[0].strip() and \
+            images[0].lower() != "null":
+        photo_url = images[0]
+        if telegram_media_cache and telegram_media_cache.is_broken(photo_url):
+            logging.debug(f"Rec ID: {recommendation_id_for_feedback} - фото {photo_url} недавно не отправилось, "
+                          f"карточка уйдет текстом.")
+            photo_url = None
+
+    return {
+        "id": recommendation_id_for_feedback,
+        "name": rec_data.get("name"),
+        "text": formatted_text,
+        "booking_url": booking_url,
+        "maps_url": maps_url,
+        "photo_url": photo_url,
+    }
 
-        # Формирование кнопок "На карте"
-        coords_value = rec_data.get('coordinates')
-        # Промпт просит список из 2 чисел или JSON null.
 
-        # --- НАЧАЛО ПРОВЕРКИ ДЛЯ coords_value ---
-        is_valid_coords_condition = False  # Флаг для отладки
-        lat, lon = None, None  # Инициализируем
-        if isinstance(coords_value, list) and len(coords_value) == 2:  # Шаг 1: Список из двух элементов
+def _card_keyboard(card: Dict[str, Any], lang: str) -> InlineKeyboardMarkup:
+    buttons_row1 = []  # Кнопки Бронь/На карте
+    if card["booking_url"]:
+        buttons_row1.append(InlineKeyboardButton(text=get_text("button_book_tickets", lang), url=card["booking_url"]))
+    if card["maps_url"]:
+        buttons_row1.append(InlineKeyboardButton(text=get_text("button_on_map", lang), url=card["maps_url"]))
+    buttons_row2 = [  # Кнопки Лайк/Дизлайк
+        InlineKeyboardButton(text=f"👍 {get_text('button_like', lang)}", callback_data=f"feedback_like_{card['id']}"),
+        InlineKeyboardButton(text=f"👎 {get_text('button_dislike', lang)}",
+                             callback_data=f"feedback_dislike_{card['id']}"),
+    ]
+
+    all_buttons_rows = []
+    if buttons_row1:  # Если есть кнопки в первом ряду (Бронь/На карте)
+        all_buttons_rows.append(buttons_row1)
+    all_buttons_rows.append(buttons_row2)  # Ряд с Лайк/Дизлайк добавляется всегда
+    return InlineKeyboardMarkup(inline_keyboard=all_buttons_rows)
+
+
+async def _deliver_card(target_message_entity: Union[Message, CallbackQuery], bot: Bot, card: Dict[str, Any],
+                        lang: str) -> Any:
+    """Отправляет карточку: фото с подписью, а если фото не отправилось - текстом."""
+    chat_id, _, message_to_answer_or_send_new = _resolve_chat_target(target_message_entity)
+    reply_markup = _card_keyboard(card, lang)
+    photo_url = card["photo_url"]
+    if photo_url:
+        cached_file_id = telegram_media_cache.get_file_id(photo_url) if telegram_media_cache else None
+        # Сначала file_id (Telegram не скачивает картинку заново), при его отказе - исходный URL
+        for photo in ([cached_file_id] if cached_file_id else []) + [photo_url]:
             try:
-                val1 = coords_value[0]
-                val2 = coords_value[1]
-                # AI может прислать числа как строки, поэтому float() обязателен
-                # Также AI может прислать строку "null" или None внутри списка
-                if val1 is not None and str(val1).lower() != "null" and \
-                        val2 is not None and str(val2).lower() != "null":
-                    lat = float(val1)
-                    lon = float(val2)
-                    is_valid_coords_condition = True  # Шаг 2: Успешная конвертация в float
-            except (ValueError, TypeError, IndexError) as e_coord:
-                logging.warning(
-                    f"Rec ID: {recommendation_id_for_feedback} - Ошибка конвертации координат: {coords_value}, ошибка: {e_coord}. Кнопка 'На карте' не будет добавлена.")
-                is_valid_coords_condition = False  # Явно ставим False при ошибке
-        # --- КОНЕЦ ПРОВЕРКИ ДЛЯ coords_value ---
-
-        if is_valid_coords_condition:  # Проверяем флаг
-            maps_url = f"https://www.google.com/maps/search/?api=1&query={lat},{lon}"
-            logging.debug(
-                f"Rec ID: {recommendation_id_for_feedback} - Добавляем кнопку 'На карте'. Coords: [{lat},{lon}]")
-            buttons_row1.append(InlineKeyboardButton(text=get_text("button_on_map", lang), url=maps_url))
-        else:
-            logging.debug(
-                f"Rec ID: {recommendation_id_for_feedback} - НЕТ кнопки 'На карте'. coordinates: {coords_value} (тип: {type(coords_value)}), Условие: {is_valid_coords_condition}")
+                sent_message = await bot.send_photo(chat_id=chat_id, photo=photo, caption=card["text"],
+                                                    reply_markup=reply_markup, parse_mode="HTML")
+            except TelegramRetryAfter:
+                raise  # Планировщик выдержит паузу и повторит отправку фото
+            except Exception as e:
+                logging.warning(f"Ошибка отправки фото {photo_url} для rec_id {card['id']} "
+                                f"({'file_id' if photo == cached_file_id else 'URL'}): {e}.")
+                if not _is_photo_fetch_error(e):
+                    break  # Картинка тут ни при чем: повтор с URL упадет так же, кэш не трогаем
+                if telegram_media_cache:
+                    if photo == cached_file_id:
+                        telegram_media_cache.forget_file_id(photo_url)
+                    else:
+                        telegram_media_cache.mark_broken(photo_url)
+                continue
+            _remember_photo_file_id(photo_url, sent_message)
+            return sent_message
+        logging.warning(f"Фото для rec_id {card['id']} не отправлено. Отправка текста.")
+    return await message_to_answer_or_send_new.answer(card["text"], reply_markup=reply_markup, parse_mode="HTML")
+
+
+def _is_photo_fetch_error(error: Exception) -> bool:
+    if not isinstance(error, TelegramBadRequest):
+        return False
+    message = str(error.message).lower()
+    return any(marker in message for marker in PHOTO_FETCH_ERRORS)
+
+
+def _remember_photo_file_id(photo_url: str, sent_message: Optional[Message]) -> None:
+    if telegram_media_cache and sent_message and sent_message.photo:
+        telegram_media_cache.remember_file_id(photo_url, sent_message.photo[-1].file_id)
+
+
+def _album_photo(photo_url: str) -> str:
+    file_id = telegram_media_cache.get_file_id(photo_url) if telegram_media_cache else None
+    return file_id or photo_url
+
+
+def _queue_card(target_message_entity: Union[Message, CallbackQuery], bot: Bot, card: Dict[str, Any],
+                lang: str) -> "asyncio.Future[Any]":
+    chat_id, _, _ = _resolve_chat_target(target_message_entity)
+    return telegram_sender.submit(chat_id, lambda: _deliver_card(target_message_entity, bot, card, lang))
+
+
+async def _send_text(message: Message, text: str, **kwargs: Any) -> Any:
+    """
+    Отправляет текст в чат message через очередь telegram_sender, как и карточки: сообщения чата
+    уходят строго в порядке постановки (сводка и кнопка "Еще" не обгонят карточки) и в общих лимитах.
+    """
+    return await telegram_sender.send(message.chat.id, lambda: message.answer(text, **kwargs))
+
+
+def _album_keyboard(cards: List[Dict[str, Any]], lang: str) -> InlineKeyboardMarkup:
+    """
+    Клавиатура для альбома (у sendMediaGroup не бывает кнопок): ссылки всех карточек плотными рядами
+    с номером карточки, затем по ряду лайк/дизлайк на карточку - _update_feedback_buttons
+    убирает ряд фидбека после оценки, не трогая остальные.
+    """
+    link_buttons = []
+    for number, card in enumerate(cards, start=1):
+        if card["booking_url"]:
+            link_buttons.append(InlineKeyboardButton(text=f"{number}. 🔗", url=card["booking_url"]))
+        if card["maps_url"]:
+            link_buttons.append(InlineKeyboardButton(text=f"{number}. 🗺️", url=card["maps_url"]))
+    rows = [link_buttons[i:i + ALBUM_LINK_BUTTONS_PER_ROW]
+            for i in range(0, len(link_buttons), ALBUM_LINK_BUTTONS_PER_ROW)]
+    for number, card in enumerate(cards, start=1):
+        rows.append([
+            InlineKeyboardButton(text=f"{number}. 👍 {get_text('button_like', lang)}",
+                                 callback_data=f"feedback_like_{card['id']}"),
+            InlineKeyboardButton(text=f"{number}. 👎 {get_text('button_dislike', lang)}",
+                                 callback_data=f"feedback_dislike_{card['id']}"),
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def _deliver_album(target_message_entity: Union[Message, CallbackQuery], bot: Bot,
+                         cards: List[Dict[str, Any]], lang: str) -> Any:
+    """
+    Отправляет карточки одним альбомом (sendMediaGroup) и следом - одно сообщение с клавиатурой.
+    Если альбом не отправился (например, одна из ссылок на фото битая), карточки уходят по одной.
+    """
+    chat_id, _, message_to_answer_or_send_new = _resolve_chat_target(target_message_entity)
+    media = [InputMediaPhoto(media=_album_photo(card["photo_url"]), caption=card["text"], parse_mode="HTML")
+             for card in cards]
+    try:
+        album_messages = await bot.send_media_group(chat_id=chat_id, media=media)
+    except TelegramRetryAfter:
+        raise
+    except Exception as e:
+        # По ошибке альбома не понять, какая именно картинка битая, - это выяснит отправка по одной
+        logging.warning(f"Ошибка отправки альбома из {len(cards)} карточек: {e}. Отправка по одной.")
+        for card in cards:
+            await _deliver_card(target_message_entity, bot, card, lang)
+        return None
+    for card, album_message in zip(cards, album_messages or []):
+        _remember_photo_file_id(card["photo_url"], album_message)
 
-        buttons_row2.append(InlineKeyboardButton(text=f"👍 {get_text('button_like', lang)}",
-                                                 callback_data=f"feedback_like_{recommendation_id_for_feedback}"))
-        buttons_row2.append(InlineKeyboardButton(text=f"👎 {get_text('button_dislike', lang)}",
-                                                 callback_data=f"feedback_dislike_{recommendation_id_for_feedback}"))
+    numbered_names = "\n".join(f"{number}. {card['name'] or card['id']}" for number, card in enumerate(cards, start=1))
+    return await message_to_answer_or_send_new.answer(
+        get_text("album_keyboard_text", lang, recommendations=numbered_names),
+        reply_markup=_album_keyboard(cards, lang), parse_mode=None)
 
-        all_buttons_rows = []
-        if buttons_row1:  # Если есть кнопки в первом ряду (Бронь/На карте)
-            all_buttons_rows.append(buttons_row1)
-        all_buttons_rows.append(buttons_row2)  # Ряд с Лайк/Дизлайк добавляется всегда
 
-        reply_markup = InlineKeyboardMarkup(inline_keyboard=all_buttons_rows)
+def _queue_album(target_message_entity: Union[Message, CallbackQuery], bot: Bot, cards: List[Dict[str, Any]],
+                 lang: str) -> "asyncio.Future[Any]":
+    chat_id, _, _ = _resolve_chat_target(target_message_entity)
+    return telegram_sender.submit(chat_id, lambda: _deliver_album(target_message_entity, bot, cards, lang),
+                                  cost=len(cards) + 1)  # Каждое фото альбома и сообщение с кнопками
 
-        images = rec_data.get("images", [])
-        photo_sent = False
-        if images and isinstance(images, list) and images and isinstance(images[0], str) and images[0].strip() and \
-                images[0].lower() != "null":
-            try:
-                await bot.send_photo(chat_id=chat_id, photo=images[0], caption=formatted_text,
-                                     reply_markup=reply_markup, parse_mode="HTML")
-                photo_sent = True
-            except Exception as e:
-                logging.warning(
-                    f"Ошибка отправки фото {images[0]} для rec_id {recommendation_id_for_feedback}: {e}. Отправка текста.")
 
-        if not photo_sent:
-            await message_to_answer_or_send_new.answer(formatted_text, reply_markup=reply_markup, parse_mode="HTML")
+def _make_queue_notifier(message: Message, lang: str):
+    """Колбэк для планировщика AI: сообщает пользователю его позицию в очереди."""
+    async def notify_queue_position(position: int):
+        await _send_text(message, get_text("ai_queue_position_text", lang, position=position))
+    return notify_queue_position
 
-    return shown_ids_this_batch
+
+async def _fetch_and_send_recommendations(
+        target_message_entity: Union[Message, CallbackQuery],
+        bot: Bot,
+        ai_request_data: Dict[str, Any],
+        lang: str,
+        is_more_request: bool = False,
+        prefetched_result: Optional[Tuple[Optional[Dict[str, Any]], Optional[str]]] = None,
+        session: Optional[AsyncSession] = None
+) -> Tuple[Optional[Dict[str, Any]], Optional[str], List[str]]:
+    """
+    Запрашивает рекомендации целиком, отправляет сопроводительный текст и затем карточки
+    (без уже показанных в этой сессии ID). Если передан prefetched_result, AI не вызывается.
+    Возвращает (structured_recommendations или None, textual_summary или текст ошибки, показанные ID).
+    """
+    _, _, message_to_answer = _resolve_chat_target(target_message_entity)
+    request_label = "more_options" if is_more_request else "initial"
+    no_recs_key = "ai_no_more_recommendations_found" if is_more_request else "ai_no_recommendations_found"
+
+    if prefetched_result is not None:
+        recommendations_json, accompanying_text = prefetched_result
+    else:
+        recommendations_json, accompanying_text = await get_travel_recommendations(
+            ai_request_data, on_queued=_make_queue_notifier(message_to_answer, lang), session=session)
+    shown_ids_this_batch: List[str] = []
+    if not recommendations_json:
+        return None, accompanying_text, shown_ids_this_batch
+
+    if accompanying_text:  # Может быть пустым, если ответ AI был обрезан и спасен частично
+        await _send_text(message_to_answer, accompanying_text)
+    recommendation_items_from_ai = recommendations_json.get("recommendations")
+
+    if isinstance(recommendation_items_from_ai, list):
+        # Для первого запроса фильтрация не так критична, т.к. current_session_shown_ids должен быть пуст,
+        # но оставим для консистентности и на случай, если AI вдруг повторит что-то из истории (хотя промпт это запрещает)
+        already_shown_ids_set = set(ai_request_data.get('current_session_shown_ids', []))
+        # Старые дизлайки могли не попасть в промпт при сжатии истории - не показываем их повторно
+        already_shown_ids_set.update(ai_request_data.get('disliked_recommendation_ids') or [])
+        unique_recs_to_show = []
+        for rec_item in recommendation_items_from_ai:
+            rec_id = rec_item.get("id")
+            if rec_id and rec_id not in already_shown_ids_set:
+                unique_recs_to_show.append(rec_item)
+            elif rec_id:  # Дубликат
+                logging.info(f"AI ({request_label}) вернул ID, который уже был показан: {rec_id}. Фильтруем.")
+            elif not rec_id:  # Нет ID
+                unique_recs_to_show.append(rec_item)
+
+        # Локальное ранжирование по лайкам/дизлайкам пользователя (без лишнего обращения к AI)
+        unique_recs_to_show = await rank_for_user(unique_recs_to_show, session,
+                                                  target_message_entity.from_user.id, ai_request_data)
+        if unique_recs_to_show:
+            shown_ids_this_batch = await _send_recommendations_batch(
+                target_message_entity, bot, unique_recs_to_show, lang, is_more_request=is_more_request
+            )
+        elif recommendation_items_from_ai:  # Были только дубликаты или невалидные
+            await _send_text(message_to_answer, get_text(no_recs_key, lang))
+    else:  # recommendations не список или отсутствует
+        logging.error("Ключ 'recommendations' отсутствует или не список в ответе AI (%s): %s", request_label,
+                      LogPayload(recommendations_json, sample_rate=1.0))
+        await _send_text(message_to_answer, get_text("no_recommendations_in_response_text", lang))
+
+    return recommendations_json, accompanying_text, shown_ids_this_batch
+
+
+async def _stream_recommendations_to_chat(
+        target_message_entity: Union[Message, CallbackQuery],
+        bot: Bot,
+        ai_request_data: Dict[str, Any],
+        lang: str,
+        is_more_request: bool = False,
+        session: Optional[AsyncSession] = None
+) -> Tuple[Optional[Dict[str, Any]], Optional[str], List[str]]:
+    """
+    Потоковый вариант _fetch_and_send_recommendations: каждая карточка отправляется, как только
+    Gemini закончил ее генерировать, а сопроводительный текст - после всех карточек.
+    Локальное ранжирование (rank_for_user) здесь не применяется: карточка уходит в чат раньше,
+    чем сгенерированы следующие, и сравнивать ее не с чем. Показываются в порядке ответа AI.
+    Возвращает (structured_recommendations или None, textual_summary или текст ошибки, показанные ID).
+    """
+    _, _, message_to_answer = _resolve_chat_target(target_message_entity)
+    no_recs_key = "ai_no_more_recommendations_found" if is_more_request else "ai_no_recommendations_found"
+    pending_sends = []  # Карточки уходят в фоне, пока Gemini генерирует следующие
+    already_shown_ids_set = set(ai_request_data.get('current_session_shown_ids', []))
+    already_shown_ids_set.update(ai_request_data.get('disliked_recommendation_ids') or [])
+    shown_ids_this_batch: List[str] = []
+    structured, summary_or_error = None, None
+    rec_idx = 0
+
+    async for event_type, payload in stream_travel_recommendations(
+            ai_request_data, on_queued=_make_queue_notifier(message_to_answer, lang), session=session):
+        if event_type == "recommendation":
+            rec_id = payload.get("id") if isinstance(payload, dict) else None
+            if rec_id and rec_id in already_shown_ids_set:
+                logging.info(f"AI (stream) вернул ID, который уже был показан: {rec_id}. Фильтруем.")
+                continue
+            queued = await _queue_recommendation_card(target_message_entity, bot, payload, rec_idx, lang,
+                                                      is_more_request)
+            rec_idx += 1
+            if queued:
+                shown_ids_this_batch.append(queued[0])
+                already_shown_ids_set.add(queued[0])
+                pending_sends.append(queued[1])
+        elif event_type == "done":
+            structured, summary_or_error = payload
+        elif event_type == "error":
+            summary_or_error = payload
+    await asyncio.gather(*pending_sends)  # Сопроводительный текст - только после всех карточек
+
+    if structured:
+        if summary_or_error:
+            await _send_text(message_to_answer, summary_or_error)
+        if not shown_ids_this_batch and structured.get("recommendations"):  # Были только дубликаты
+            await _send_text(message_to_answer, get_text(no_recs_key, lang))
+    return structured, summary_or_error, shown_ids_this_batch
+
+
+async def _answer_ai_error(message: Message, accompanying_text: Optional[str], lang: str):
+    """Отправляет пользователю локализованное сообщение об ошибке get_travel_recommendations."""
+    error_key = "ai_response_error_text"
+    error_details = ""
+    if accompanying_text:
+        if " некорректный JSON" in accompanying_text:
+            error_key = "ai_json_decode_error_text"
+        elif "Непредвиденная ошибка" in accompanying_text:
+            error_key = "ai_unexpected_error_text"
+        elif "неверном формате" in accompanying_text:
+            error_key = "ai_unexpected_format_text"
+        elif "перегружен" in accompanying_text:
+            error_key = "ai_overloaded_text"
+        elif "временно недоступен" in accompanying_text:
+            error_key = "ai_unavailable_text"
+        try:
+            error_details = accompanying_text.split("Ошибка: ", 1)[1].rstrip(
+                ")") if "(Ошибка: " in accompanying_text else accompanying_text.split(": ", 1)[-1].rstrip(".")
+        except IndexError:
+            error_details = accompanying_text if len(accompanying_text) < 50 else "детали см. в логах"
+    await _send_text(message, get_text(error_key, lang, error_details=error_details, error_type=error_details))
 
 
 @trip_planning_router.message(Command("plan_trip"))
@@ -265,6 +529,9 @@ async def cmd_plan_trip(message: Message, state: FSMContext):
     current_data = await state.get_data()
     user_language_to_keep = current_data.get('user_language')
 
+    # Предзагруженные "еще рекомендации" относятся к прошлой сессии планирования
+    recommendation_prefetcher.cancel(user_id)
+
     await state.clear()
     if user_language_to_keep:
         await state.update_data(user_language=user_language_to_keep)
@@ -277,14 +544,14 @@ async def cmd_plan_trip(message: Message, state: FSMContext):
         current_session_shown_ids=[]
     )
     lang = await get_user_language(state)
-    logging.info(
-        f"Данные FSM после очистки и перед началом нового планирования для {user_id}: {await state.get_data()}")
+    logging.info("Данные FSM для %s (%s) очищены перед началом нового планирования.", user_id, lang)
+    await state.set_state(TripPlanning.waiting_for_location)
+    await flush_state(state)  # Ответ на подсказку должен застать уже новое состояние
     await message.answer(
         get_text("start_planning_prompt", lang) + "\n\n" +
         get_text("step1_location_prompt", lang),
         reply_markup=ReplyKeyboardRemove()
     )
-    await state.set_state(TripPlanning.waiting_for_location)
 
 
 # --- Хэндлеры FSM (остаются без изменений) ---
@@ -313,8 +580,9 @@ async def log_unhandled_location_input(message: Message, state: FSMContext):
 
 
 async def _ask_for_interests(message: Message, state: FSMContext, lang: str):
-    await message.answer(get_text("step2_interests_prompt", lang))
     await state.set_state(TripPlanning.waiting_for_interests)
+    await flush_state(state)
+    await message.answer(get_text("step2_interests_prompt", lang))
 
 
 @trip_planning_router.message(TripPlanning.waiting_for_interests, F.text)
@@ -327,12 +595,13 @@ async def process_interests(message: Message, state: FSMContext):
         [InlineKeyboardButton(text=get_text("budget_option_premium", lang), callback_data="budget_premium")]
     ]
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await state.set_state(TripPlanning.waiting_for_budget)
+    await flush_state(state)
     await message.answer(
         get_text("interests_received_text", lang, interests_text=message.text) + "\n\n" +
         get_text("step3_budget_prompt", lang),
         reply_markup=keyboard
     )
-    await state.set_state(TripPlanning.waiting_for_budget)
 
 
 @trip_planning_router.callback_query(TripPlanning.waiting_for_budget, F.data.startswith("budget_"))
@@ -344,36 +613,41 @@ async def process_budget_callback(callback_query: CallbackQuery, state: FSMConte
     budget_full_name = get_text(budget_name_key, lang)
     budget_display_name_cleaned = budget_full_name.split(" ", 1)[
         -1] if " " in budget_full_name and not budget_full_name.startswith("<L10N_ERROR") else budget_full_name
+    await state.set_state(TripPlanning.waiting_for_trip_dates)
+    await flush_state(state)
     await callback_query.message.edit_text(
         get_text("budget_selected_text", lang, selected_budget=budget_display_name_cleaned) + "\n\n" +
         get_text("step4_dates_prompt", lang)
     )
     await callback_query.answer()
-    await state.set_state(TripPlanning.waiting_for_trip_dates)
 
 
 @trip_planning_router.message(TripPlanning.waiting_for_trip_dates, F.text)
 async def process_trip_dates(message: Message, state: FSMContext):
     lang = await get_user_language(state)
     await state.update_data(user_trip_dates_text=message.text.strip())
+    await state.set_state(TripPlanning.waiting_for_transport_prefs)
+    await flush_state(state)
     await message.answer(
         get_text("dates_received_text", lang, dates_text=message.text) + "\n\n" +
         get_text("step5_transport_prompt", lang)
     )
-    await state.set_state(TripPlanning.waiting_for_transport_prefs)
 
 
 # --- Конец FSM хэндлеров ---
 
-@trip_planning_router.message(TripPlanning.waiting_for_transport_prefs, F.text)
-async def process_transport_prefs_and_get_initial_recs(message: Message, state: FSMContext, bot: Bot):
+# inflight_guard: пока для пользователя готовятся рекомендации, повторный запуск подавляется (см. InflightGuardMiddleware)
+@trip_planning_router.message(TripPlanning.waiting_for_transport_prefs, F.text, flags={"inflight_guard": "initial_recs"})
+async def process_transport_prefs_and_get_initial_recs(message: Message, state: FSMContext, bot: Bot,
+                                                       session: AsyncSession):
     user_id = message.from_user.id
     await state.update_data(user_transport_prefs_text=message.text.strip())
 
     fsm_collected_data = await state.get_data()
     lang = fsm_collected_data.get("user_language", "ru")
 
-    await message.answer(
+    await _send_text(
+        message,
         get_text("transport_received_text", lang, transport_text=message.text) + "\n\n" +
         get_text("all_data_collected_prompt", lang)
     )
@@ -392,79 +666,44 @@ async def process_transport_prefs_and_get_initial_recs(message: Message, state:
         'current_session_shown_ids': fsm_collected_data.get('current_session_shown_ids', [])
         # Должен быть [] после cmd_plan_trip
     }
-    logging.info(f"Данные для ПЕРВОГО AI запроса от {user_id} ({lang}): {initial_ai_request_data}")
-
-    recommendations_json, accompanying_text = await get_travel_recommendations(initial_ai_request_data)
-
-    all_shown_ids_this_round: List[str] = []
-    recommendation_items_exist = False
-
-    if recommendations_json and accompanying_text:
-        await message.answer(accompanying_text)
-        recommendation_items_from_ai = recommendations_json.get("recommendations")
-
-        if isinstance(recommendation_items_from_ai, list):
-            # Для первого запроса фильтрация не так критична, т.к. current_session_shown_ids должен быть пуст,
-            # но оставим для консистентности и на случай, если AI вдруг повторит что-то из истории (хотя промпт это запрещает)
-            already_shown_ids_set = set(initial_ai_request_data['current_session_shown_ids'])
-            unique_recs_to_show = []
-            if recommendation_items_from_ai:  # Только если список не пуст
-                for rec_item in recommendation_items_from_ai:
-                    rec_id = rec_item.get("id")
-                    if rec_id and rec_id not in already_shown_ids_set:
-                        unique_recs_to_show.append(rec_item)
-                    elif rec_id:  # Дубликат
-                        logging.info(
-                            f"AI (initial) вернул ID, который уже есть в (пустом) shown_ids: {rec_id}. Игнорируем.")
-                    elif not rec_id:  # Нет ID
-                        unique_recs_to_show.append(rec_item)
-
-            if unique_recs_to_show:
-                recommendation_items_exist = True
-                all_shown_ids_this_round = await _send_recommendations_batch(
-                    message, bot, unique_recs_to_show, lang, is_more_request=False
-                )
-            # Если unique_recs_to_show пуст, _send_recommendations_batch вызовет get_text("ai_no_recommendations_found", lang)
-            elif not unique_recs_to_show and recommendation_items_from_ai:  # Были только дубликаты или невалидные
-                await message.answer(get_text("ai_no_recommendations_found", lang))
-
-        else:  # recommendations не список или отсутствует
-            logging.error(f"Ключ 'recommendations' отсутствует или не список в ответе AI: {recommendations_json}")
-            await message.answer(get_text("no_recommendations_in_response_text", lang))
-    else:  # Ошибка от get_travel_recommendations
-        error_key = "ai_response_error_text"
-        # ... (обработка ошибок, как и раньше) ...
-        error_details = ""
-        if accompanying_text:
-            if " некорректный JSON" in accompanying_text:
-                error_key = "ai_json_decode_error_text"
-            elif "Непредвиденная ошибка" in accompanying_text:
-                error_key = "ai_unexpected_error_text"
-            elif "неверном формате" in accompanying_text:
-                error_key = "ai_unexpected_format_text"
-            try:
-                error_details = accompanying_text.split("Ошибка: ", 1)[1].rstrip(
-                    ")") if "(Ошибка: " in accompanying_text else accompanying_text.split(": ", 1)[-1].rstrip(".")
-            except IndexError:
-                error_details = accompanying_text if len(accompanying_text) < 50 else "детали см. в логах"
-        await message.answer(get_text(error_key, lang, error_details=error_details, error_type=error_details))
+    logging.info("Данные для ПЕРВОГО AI запроса от %s (%s): %s", user_id, lang, LogPayload(initial_ai_request_data))
+
+    # В потоковом режиме карточки уходят в чат по мере генерации, а сопроводительный текст - в конце
+    deliver_recommendations = _stream_recommendations_to_chat if AI_STREAMING_ENABLED else _fetch_and_send_recommendations
+    recommendations_json, accompanying_text, all_shown_ids_this_round = await deliver_recommendations(
+        message, bot, initial_ai_request_data, lang, is_more_request=False, session=session
+    )
+    recommendation_items_exist = bool(all_shown_ids_this_round)
+
+    if not recommendations_json:  # Ошибка от get_travel_recommendations
+        await _answer_ai_error(message, accompanying_text, lang)
 
     await state.update_data(current_session_shown_ids=all_shown_ids_this_round)
+    await state.set_state(None)
+    # Кнопку "Еще" нажимают сразу: ее апдейт должен прочитать уже записанные показанные ID
+    await flush_state(state)
 
     if recommendation_items_exist:
+        # Большинство пользователей нажимают "Еще" - начинаем генерировать следующий набор заранее
+        recommendation_prefetcher.schedule(user_id, {
+            **initial_ai_request_data,
+            'request_type': 'more_options',
+            'current_session_shown_ids': all_shown_ids_this_round,
+        })
         more_recs_button = InlineKeyboardButton(text=get_text("button_more_recs", lang),
                                                 callback_data="more_recs_request")
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[more_recs_button]])
-        await message.answer(get_text("prompt_more_recs_available", lang), reply_markup=keyboard)
+        await _send_text(message, get_text("prompt_more_recs_available", lang), reply_markup=keyboard)
     elif recommendations_json and not recommendation_items_exist:  # Был ответ от AI, но рекомендации пустые (или все отфильтрованы)
-        await message.answer(get_text("ai_no_recommendations_found", lang))
+        await _send_text(message, get_text("ai_no_recommendations_found", lang))
 
-    await state.set_state(None)
-    logging.info(f"Пользователь {user_id} ({lang}) получил ПЕРВЫЙ набор. Данные в state: {await state.get_data()}")
+    logging.info("Пользователь %s (%s) получил ПЕРВЫЙ набор. Показанные ID: %s", user_id, lang,
+                 LogPayload(all_shown_ids_this_round))
 
 
-@trip_planning_router.callback_query(F.data == "more_recs_request")
-async def process_more_recs_request(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
+@trip_planning_router.callback_query(F.data == "more_recs_request", flags={"inflight_guard": "more_recs"})
+async def process_more_recs_request(callback_query: CallbackQuery, state: FSMContext, bot: Bot,
+                                   session: AsyncSession):
     user_id = callback_query.from_user.id
     await callback_query.answer()
 
@@ -473,8 +712,8 @@ async def process_more_recs_request(callback_query: CallbackQuery, state: FSMCon
 
     location_present = current_state_data.get('user_location_text') or current_state_data.get('user_location_geo')
     if not location_present or not current_state_data.get('user_interests_text'):
-        logging.warning(
-            f"Запрос 'еще рекомендаций' от {user_id}, но state не содержит FSM данных. State: {current_state_data}")
+        logging.warning("Запрос 'еще рекомендаций' от %s, но state не содержит FSM данных. State: %s", user_id,
+                        LogPayload(current_state_data))
         await callback_query.message.answer(get_text("error_state_lost_for_more_recs", lang))
         return
 
@@ -484,7 +723,7 @@ async def process_more_recs_request(callback_query: CallbackQuery, state: FSMCon
         logging.info(
             f"Не удалось убрать кнопку 'Еще рекомендации' с сообщения {callback_query.message.message_id} для {user_id}: {e}")
 
-    await callback_query.message.answer(get_text("generating_more_recs_prompt", lang))
+    await _send_text(callback_query.message, get_text("generating_more_recs_prompt", lang))
 
     # Собираем все необходимые данные из state
     ai_request_data_for_more = {
@@ -501,82 +740,50 @@ async def process_more_recs_request(callback_query: CallbackQuery, state: FSMCon
         # Это поле будет использовано в _prepare_user_data_for_prompt для previously_shown_ids
         'request_type': 'more_options'
     }
-    logging.info(f"Данные для AI ('еще' рекомендации) для {user_id}: {ai_request_data_for_more}")
-
-    recommendations_json, accompanying_text = await get_travel_recommendations(ai_request_data_for_more)
-
-    newly_shown_ids_this_batch: List[str] = []
-    new_recommendation_items_exist = False
-
-    if recommendations_json and accompanying_text:
-        await callback_query.message.answer(accompanying_text)
-
-        all_new_recs_from_ai = recommendations_json.get("recommendations")
-        if isinstance(all_new_recs_from_ai, list):
-            already_shown_ids_set = set(current_state_data.get('current_session_shown_ids', []))
-            unique_new_recs_to_show = []
-            if all_new_recs_from_ai:  # Только если список не пуст
-                for rec_item in all_new_recs_from_ai:
-                    rec_id = rec_item.get("id")
-                    if rec_id and rec_id not in already_shown_ids_set:
-                        unique_new_recs_to_show.append(rec_item)
-                    elif rec_id:
-                        logging.info(f"AI (more_options) вернул ID, который уже был показан: {rec_id}. Фильтруем.")
-                    elif not rec_id:
-                        unique_new_recs_to_show.append(rec_item)
-
-            if unique_new_recs_to_show:
-                new_recommendation_items_exist = True
-                newly_shown_ids_this_batch = await _send_recommendations_batch(
-                    callback_query, bot, unique_new_recs_to_show, lang, is_more_request=True
-                )
-            # Если unique_new_recs_to_show пуст, _send_recommendations_batch обработает это и отправит "больше ничего не найдено"
-            elif not unique_new_recs_to_show and all_new_recs_from_ai:  # Были только дубликаты
-                await callback_query.message.answer(get_text("ai_no_more_recommendations_found", lang))
-
-
-        else:
-            logging.error(f"Ключ 'recommendations' отсутствует или не список в 'еще' ответе AI: {recommendations_json}")
-            await callback_query.message.answer(get_text("no_recommendations_in_response_text", lang))
+    logging.info("Данные для AI ('еще' рекомендации) для %s: %s", user_id, LogPayload(ai_request_data_for_more))
+
+    prefetched_result = await recommendation_prefetcher.take(user_id, ai_request_data_for_more)
+    if prefetched_result is not None:
+        recommendations_json, accompanying_text, newly_shown_ids_this_batch = await _fetch_and_send_recommendations(
+            callback_query, bot, ai_request_data_for_more, lang, is_more_request=True,
+            prefetched_result=prefetched_result, session=session
+        )
     else:
-        error_key = "ai_response_error_text"  # ... (обработка ошибок)
-        error_details = ""
-        if accompanying_text:
-            if " некорректный JSON" in accompanying_text:
-                error_key = "ai_json_decode_error_text"
-            elif "Непредвиденная ошибка" in accompanying_text:
-                error_key = "ai_unexpected_error_text"
-            elif "неверном формате" in accompanying_text:
-                error_key = "ai_unexpected_format_text"
-            try:
-                error_details = accompanying_text.split("Ошибка: ", 1)[1].rstrip(
-                    ")") if "(Ошибка: " in accompanying_text else accompanying_text.split(": ", 1)[-1].rstrip(".")
-            except IndexError:
-                error_details = accompanying_text if len(accompanying_text) < 50 else "детали см. в логах"
-        await callback_query.message.answer(
-            get_text(error_key, lang, error_details=error_details, error_type=error_details))
+        deliver_recommendations = _stream_recommendations_to_chat if AI_STREAMING_ENABLED else _fetch_and_send_recommendations
+        recommendations_json, accompanying_text, newly_shown_ids_this_batch = await deliver_recommendations(
+            callback_query, bot, ai_request_data_for_more, lang, is_more_request=True, session=session
+        )
+    new_recommendation_items_exist = bool(newly_shown_ids_this_batch)
+
+    if not recommendations_json:
+        await _answer_ai_error(callback_query.message, accompanying_text, lang)
 
     if new_recommendation_items_exist:
         previously_shown_ids = current_state_data.get('current_session_shown_ids', [])
-        updated_shown_ids = list(set(previously_shown_ids + newly_shown_ids_this_batch))
+        updated_shown_ids = list(dict.fromkeys(previously_shown_ids + newly_shown_ids_this_batch))
         await state.update_data(current_session_shown_ids=updated_shown_ids)
+        await flush_state(state)  # До кнопки "Еще", как и в первом наборе
+        recommendation_prefetcher.schedule(user_id, {
+            **ai_request_data_for_more,
+            'current_session_shown_ids': updated_shown_ids,
+        })
 
         more_recs_button = InlineKeyboardButton(text=get_text("button_more_recs", lang),
                                                 callback_data="more_recs_request")
         keyboard = InlineKeyboardMarkup(inline_keyboard=[[more_recs_button]])
-        await callback_query.message.answer(get_text("prompt_more_recs_available", lang), reply_markup=keyboard)
+        await _send_text(callback_query.message, get_text("prompt_more_recs_available", lang),
+                         reply_markup=keyboard)
     # Если new_recommendation_items_exist is False, но был ответ от AI,
-    # то сообщение "ai_no_more_recommendations_found" уже было отправлено из _send_recommendations_batch или после фильтрации.
-    # Не нужно отправлять его здесь еще раз, если только не было ошибки от AI.
-    elif recommendations_json and not new_recommendation_items_exist and not newly_shown_ids_this_batch:
-        # Этот блок сработает, если unique_new_recs_to_show был пуст Изначально, а не после фильтрации.
-        # _send_recommendations_batch уже должен был обработать пустой список.
-        # Но на всякий случай, если AI вернул { "recommendations": [] }
+    # то сообщение "ai_no_more_recommendations_found" уже было отправлено после фильтрации дубликатов.
+    # Не нужно отправлять его здесь еще раз, если только AI не вернул пустой список.
+    elif recommendations_json and not new_recommendation_items_exist:
+        # На случай, если AI вернул { "recommendations": [] }
         if isinstance(recommendations_json.get("recommendations"), list) and not recommendations_json.get(
                 "recommendations"):
-            await callback_query.message.answer(get_text("ai_no_more_recommendations_found", lang))
+            await _send_text(callback_query.message, get_text("ai_no_more_recommendations_found", lang))
 
-    logging.info(f"Пользователь {user_id} ({lang}) получил ДОП. набор. Данные в state: {await state.get_data()}")
+    logging.info("Пользователь %s (%s) получил ДОП. набор. Новые показанные ID: %s", user_id, lang,
+                 LogPayload(newly_shown_ids_this_batch))
 
 
 async def _update_feedback_buttons(callback_query: CallbackQuery, recommendation_id: str, feedback_message_key: str,
@@ -622,8 +829,8 @@ async def process_feedback_like(callback_query: CallbackQuery, state: FSMContext
     if recommendation_id not in liked_ids: liked_ids.append(recommendation_id)
     if recommendation_id in disliked_ids: disliked_ids.remove(recommendation_id)
     await state.update_data(liked_recommendation_ids=liked_ids, disliked_recommendation_ids=disliked_ids)
-    logging.info(
-        f"Пользователь {callback_query.from_user.id} ({lang}) ЛАЙКНУЛ ID: {recommendation_id}. State: {await state.get_data()}")
+    logging.info("Пользователь %s (%s) ЛАЙКНУЛ ID: %s. Лайки: %s, дизлайки: %s", callback_query.from_user.id, lang,
+                 recommendation_id, LogPayload(liked_ids), LogPayload(disliked_ids))
     await _update_feedback_buttons(callback_query, recommendation_id, "feedback_thanks_like", lang)
 
 
@@ -638,6 +845,6 @@ async def process_feedback_dislike(callback_query: CallbackQuery, state: FSMCont
     if recommendation_id not in disliked_ids: disliked_ids.append(recommendation_id)
     if recommendation_id in liked_ids: liked_ids.remove(recommendation_id)
     await state.update_data(liked_recommendation_ids=liked_ids, disliked_recommendation_ids=disliked_ids)
-    logging.info(
-        f"Пользователь {callback_query.from_user.id} ({lang}) ДИЗЛАЙКНУЛ ID: {recommendation_id}. State: {await state.get_data()}")
+    logging.info("Пользователь %s (%s) ДИЗЛАЙКНУЛ ID: %s. Лайки: %s, дизлайки: %s", callback_query.from_user.id,
+                 lang, recommendation_id, LogPayload(liked_ids), LogPayload(disliked_ids))
     await _update_feedback_buttons(callback_query, recommendation_id, "feedback_thanks_dislike", lang)
\ No newline at end of file
@@ -97,8 +97,7 @@ async def process_language_selection(callback_query: CallbackQuery, state: FSMCo
     await callback_query.answer()  # Закрыть pop-up уведомление на кнопке
     await state.set_state(None)
 
-    logging.info(
-        f"Пользователь {user_id} выбрал язык: {selected_lang_code}. Данные state: {await state.get_data()}")
+    logging.info("Пользователь %s выбрал язык: %s.", user_id, selected_lang_code)
 
 
 @user_commands_router.message(Command("language"))
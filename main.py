@@ -1,13 +1,16 @@
 import asyncio
 import logging
 import os
+from typing import List
 from dotenv import load_dotenv
 
 # 1. ЗАГРУЖАЕМ .ENV В САМОМ НАЧАЛЕ!
 load_dotenv()
 
 # 2. НАСТРАИВАЕМ ЛОГИРОВАНИЕ ТОЖЕ В НАЧАЛЕ!
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Записи форматируются и пишутся в фоновом потоке (LOG_FORMAT=json - структурированные JSON записи)
+from utils.logging_setup import setup_logging, get_stats as get_logging_stats
+setup_logging()
 
 # Теперь можно делать остальные импорты
 from aiogram import Bot, Dispatcher
@@ -21,6 +24,107 @@ from handlers.trip_planning_handlers import trip_planning_router
 # Из db_setup нам нужна только фабрика сессий AsyncSessionLocal
 from database.db_setup import AsyncSessionLocal
 from middlewares.db_middleware import DbSessionMiddleware # Убедись, что путь к мидлвари правильный
+from middlewares.fsm_snapshot_middleware import fsm_snapshot_middleware
+from middlewares.inflight_guard_middleware import inflight_guard_middleware
+from middlewares.metrics_middleware import bot_api_metrics_middleware, handler_metrics_middleware
+from middlewares.slow_update_profiler import slow_update_profiler
+from utils.fsm_storage import create_fsm_storage
+from utils.telegram_media_cache import telegram_media_cache
+from utils.telegram_sender import telegram_sender
+from utils.card_renderer import card_renderer
+from utils.ai_cache import recommendation_cache
+from utils.ai_json import get_decode_stats
+from utils.ai_prefetch import recommendation_prefetcher
+from utils.ai_scheduler import ai_scheduler
+from utils.ai_resilience import ai_circuit_breaker, ai_hedged_caller, ai_latency
+from utils.ai_integration import ai_single_flight, gemini_models, model_router
+from utils.metrics import metrics, start_metrics_server
+
+# Пропускать ли апдейты, накопившиеся, пока бот был выключен (при переходе с webhook на polling - тоже)
+POLLING_DROP_PENDING_UPDATES = os.getenv("POLLING_DROP_PENDING_UPDATES", "1").lower() in ("1", "true", "yes")
+
+# Роутеры бота в порядке подключения к диспетчеру
+ROUTERS = (user_commands_router, trip_planning_router)
+
+
+def build_dispatcher() -> Dispatcher:
+    """Диспетчер со всеми мидлварями и роутерами (общий для polling и webhook воркеров)."""
+    # +++ ИНИЦИАЛИЗАЦИЯ ДИСПЕТЧЕРА И РЕГИСТРАЦИЯ MIDDLEWARE +++
+    # Хранилище FSM: в памяти или в Redis (FSM_STORAGE=redis) - для нескольких воркеров и перезапусков
+    dp = Dispatcher(storage=create_fsm_storage())
+
+    if slow_update_profiler:  # SLOW_UPDATE_PROFILER_ENABLED=1
+        # Профилировщик - самая внешняя мидлварь апдейта: встроенные внешние мидлвари aiogram
+        # (ошибки, контекст пользователя, FSM) переносим за него, чтобы их время тоже попадало в замер
+        builtin_outer = list(dp.update.outer_middleware)
+        for middleware in builtin_outer:
+            dp.update.outer_middleware.unregister(middleware)
+        dp.update.outer_middleware(slow_update_profiler)
+        for middleware in builtin_outer:
+            dp.update.outer_middleware(middleware)
+        logging.info("SlowUpdateProfiler зарегистрирован.")
+
+    # AsyncSessionLocal импортируется из database.db_setup и является нашей фабрикой сессий
+    session_pool = AsyncSessionLocal
+
+    # Регистрируем DbSessionMiddleware глобально для всех апдейтов
+    dp.update.middleware(DbSessionMiddleware(session_pool=session_pool))
+    logging.info("DbSessionMiddleware зарегистрирована.")
+
+    # Данные FSM читаются один раз за апдейт, изменения записываются одним заходом в конце
+    dp.update.middleware(fsm_snapshot_middleware)
+    logging.info("FSMSnapshotMiddleware зарегистрирована.")
+
+    # +++ РЕГИСТРАЦИЯ РОУТЕРОВ +++
+    dp.include_routers(*ROUTERS)
+    logging.info("Роутеры зарегистрированы.")
+
+    # Внутренние мидлвари на каждом используемом типе событий - видят, какой хэндлер выбран (и его флаги).
+    # Защита от повторного запуска первой: подавленные вызовы не попадают в латентность хэндлеров.
+    for update_type in dp.resolve_used_update_types():
+        dp.observers[update_type].middleware(inflight_guard_middleware)
+        dp.observers[update_type].middleware(handler_metrics_middleware)
+    register_metrics_collectors(dp)
+    return dp
+
+
+def resolve_used_update_types() -> List[str]:
+    """
+    Типы апдейтов, на которые есть хэндлеры (allowed_updates для set_webhook), без сборки диспетчера:
+    не создается хранилище FSM и не регистрируются мидлвари и коллекторы метрик.
+    """
+    return sorted({update_type for router in ROUTERS for update_type in router.resolve_used_update_types()})
+
+
+def register_metrics_collectors(dp: Dispatcher) -> None:
+    """Статистика компонентов (get_stats()) попадает в /metrics вместе с гистограммами."""
+    collectors = {
+        "ai_scheduler": ai_scheduler.get_stats,
+        "ai_single_flight": ai_single_flight.get_stats,
+        "ai_circuit_breaker": ai_circuit_breaker.get_stats,
+        "ai_hedging": ai_hedged_caller.get_stats,
+        "ai_latency": ai_latency.get_stats,
+        "ai_model_router": model_router.get_stats,
+        "ai_models": gemini_models.get_stats,
+        "ai_json_decode": get_decode_stats,
+        "ai_prefetch": recommendation_prefetcher.get_stats,
+        "card_renderer": card_renderer.get_stats,
+        "telegram_sender": telegram_sender.get_stats,
+        "fsm_snapshot": fsm_snapshot_middleware.get_stats,
+        "inflight_guard": inflight_guard_middleware.get_stats,
+        "logging": get_logging_stats,
+        "metrics": metrics.get_stats,
+    }
+    if recommendation_cache:
+        collectors["ai_cache"] = recommendation_cache.get_stats
+    if telegram_media_cache:
+        collectors["telegram_media_cache"] = telegram_media_cache.get_stats
+    if slow_update_profiler:
+        collectors["slow_update_profiler"] = slow_update_profiler.get_stats
+    if hasattr(dp.storage, "get_stats"):
+        collectors["fsm_storage"] = dp.storage.get_stats
+    for name, get_stats in collectors.items():
+        metrics.add_collector(name, get_stats)
 
 
 async def main():
@@ -40,33 +144,26 @@ async def main():
     # +++ ИНИЦИАЛИЗАЦИЯ БД НЕ ТРЕБУЕТСЯ ЗДЕСЬ, Alembic управляет схемой +++
     logging.info("Схема БД управляется Alembic. Пропуск явной инициализации таблиц в main.py.")
 
-
-    # +++ ИНИЦИАЛИЗАЦИЯ ДИСПЕТЧЕРА И РЕГИСТРАЦИЯ MIDDLEWARE +++
-    dp = Dispatcher()
-
-    # AsyncSessionLocal импортируется из database.db_setup и является нашей фабрикой сессий
-    session_pool = AsyncSessionLocal
-
-    # Регистрируем DbSessionMiddleware глобально для всех апдейтов
-    dp.update.middleware(DbSessionMiddleware(session_pool=session_pool))
-    logging.info("DbSessionMiddleware зарегистрирована.")
-
-
-    # +++ РЕГИСТРАЦИЯ РОУТЕРОВ +++
-    dp.include_router(user_commands_router)
-    dp.include_router(trip_planning_router)
-    logging.info("Роутеры зарегистрированы.")
+    dp = build_dispatcher()
 
     bot = Bot(token=bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(bot_api_metrics_middleware)
+    metrics_runner = await start_metrics_server()
 
     logging.info("Бот запускается...")
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
+        await bot.delete_webhook(drop_pending_updates=POLLING_DROP_PENDING_UPDATES)
         await dp.start_polling(bot)
     except Exception as e:
         logging.critical(f"Критическая ошибка при запуске или работе бота: {e}", exc_info=True)
     finally:
         logging.info("Бот остановлен.")
+        # Сколько времени event loop потратил на логирование (постановка записей в очередь)
+        logging.info(f"Логирование: {get_logging_stats()}")
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if telegram_media_cache:
+            telegram_media_cache.flush()  # Несохраненные file_id иначе пришлось бы получать заново
         # Если твой async_engine требует явного закрытия при остановке приложения:
         from database.db_setup import async_engine
         if async_engine:
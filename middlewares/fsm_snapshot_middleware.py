@@ -0,0 +1,155 @@
+# middlewares/fsm_snapshot_middleware.py
+import logging
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, Set
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.types import TelegramObject
+
+_NOT_LOADED = object()
+
+
+class StateSnapshot(FSMContext):
+    """
+    FSMContext, который читает хранилище не больше одного раза за апдейт.
+    Данные и состояние загружаются при первом обращении, дальше get_data/update_data/set_state
+    работают со снимком в памяти, а flush() в конце апдейта записывает изменения одним заходом:
+    только измененные ключи через update_data или весь словарь, если данные заменялись/очищались.
+    Хэндлер, который отправляет подсказку или кнопку и ждет ответа, сначала вызывает flush_state(state):
+    иначе ответ пользователя может прийти раньше записи и увидеть старое состояние.
+    """
+
+    def __init__(self, context: FSMContext):
+        super().__init__(storage=context.storage, key=context.key)
+        self._data: Optional[Dict[str, Any]] = None
+        self._state: Any = _NOT_LOADED
+        self._changed_keys: Set[str] = set()
+        self._data_replaced = False
+        self._state_changed = False
+        self.round_trips = 0
+        self.snapshot_hits = 0
+
+    async def _load_data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = dict(await self.storage.get_data(key=self.key))
+            self.round_trips += 1
+        else:
+            self.snapshot_hits += 1
+        return self._data
+
+    async def get_data(self) -> Dict[str, Any]:
+        return dict(await self._load_data())
+
+    async def get_value(self, key: str, default: Any = None) -> Any:
+        return (await self._load_data()).get(key, default)
+
+    async def update_data(self, data: Optional[Mapping[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        if data:
+            kwargs.update(data)
+        current = await self._load_data()
+        current.update(kwargs)
+        # Ключ считается измененным даже при равном значении: хэндлеры часто меняют список
+        # из get_data на месте и передают тот же объект обратно
+        self._changed_keys.update(kwargs)
+        return dict(current)
+
+    async def set_data(self, data: Mapping[str, Any]) -> None:
+        self._data = dict(data)
+        self._data_replaced = True
+        self._changed_keys.clear()
+
+    async def get_state(self) -> Optional[str]:
+        if self._state is _NOT_LOADED:
+            self._state = await self.storage.get_state(key=self.key)
+            self.round_trips += 1
+        else:
+            self.snapshot_hits += 1
+        return self._state
+
+    async def set_state(self, state: Any = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_changed = True
+
+    async def clear(self) -> None:
+        await self.set_state(None)
+        await self.set_data({})
+
+    @property
+    def dirty(self) -> bool:
+        return self._state_changed or self._data_replaced or bool(self._changed_keys)
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения в хранилище."""
+        if self._state_changed:
+            await self.storage.set_state(key=self.key, state=self._state)
+            self.round_trips += 1
+            self._state_changed = False
+        if self._data_replaced:
+            await self.storage.set_data(key=self.key, data=self._data or {})
+            self.round_trips += 1
+        elif self._changed_keys and self._data is not None:
+            await self.storage.update_data(key=self.key, data={k: self._data[k] for k in self._changed_keys})
+            self.round_trips += 1
+        self._data_replaced = False
+        self._changed_keys.clear()
+
+
+async def flush_state(state: FSMContext) -> None:
+    """
+    Записывает изменения снимка сразу, не дожидаясь конца апдейта. Вызывается перед отправкой
+    подсказки или кнопки, на которую пользователь может ответить: его следующий апдейт должен
+    прочитать уже новое состояние. Для обычного FSMContext ничего не делает - он пишет сразу.
+    """
+    if isinstance(state, StateSnapshot) and state.dirty:
+        await state.flush()
+
+
+class FSMSnapshotMiddleware(BaseMiddleware):
+    """
+    Подменяет state в данных хэндлера на StateSnapshot и записывает изменения после обработки апдейта
+    (в том числе если хэндлер упал - как и при прямой работе с FSMContext, изменения не теряются).
+    Регистрируется как внутренняя мидлварь dp.update - после FSMContextMiddleware, который создает state.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stats: Dict[str, int] = {"updates": 0, "round_trips": 0, "max_round_trips": 0, "snapshot_hits": 0,
+                                      "writes": 0, "flush_errors": 0}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        context = data.get("state")
+        if not isinstance(context, FSMContext) or isinstance(context, StateSnapshot):
+            return await handler(event, data)
+
+        snapshot = StateSnapshot(context)
+        data["state"] = snapshot
+        try:
+            return await handler(event, data)
+        finally:
+            if snapshot.dirty:
+                self.stats["writes"] += 1
+                try:
+                    await snapshot.flush()
+                except Exception as e:
+                    self.stats["flush_errors"] += 1
+                    logging.error(f"FSM Snapshot: Ошибка записи состояния {snapshot.key}: {e}", exc_info=True)
+            self.stats["updates"] += 1
+            self.stats["round_trips"] += snapshot.round_trips
+            self.stats["snapshot_hits"] += snapshot.snapshot_hits
+            self.stats["max_round_trips"] = max(self.stats["max_round_trips"], snapshot.round_trips)
+
+    def get_stats(self) -> Dict[str, Any]:
+        updates = self.stats["updates"]
+        return {
+            **self.stats,
+            "avg_round_trips_per_update": self.stats["round_trips"] / updates if updates else 0.0,
+        }
+
+
+fsm_snapshot_middleware = FSMSnapshotMiddleware()
@@ -0,0 +1,108 @@
+# middlewares/inflight_guard_middleware.py
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.fsm.context import FSMContext
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from utils.localization import get_text
+
+# После завершения действия его повторный запуск тем же пользователем игнорируется еще столько секунд
+# (двойное нажатие, пришедшее сразу после ответа, и запись state, которая идет после хэндлера)
+INFLIGHT_GUARD_DEBOUNCE_SECONDS = float(os.getenv("INFLIGHT_GUARD_DEBOUNCE_SECONDS", "1.5"))
+# Выше этого числа записей из таблицы недавних завершений вычищаются истекшие
+_RECENT_SWEEP_THRESHOLD = 10000
+
+GuardKey = Tuple[int, str]
+
+
+class InflightGuardMiddleware(BaseMiddleware):
+    """
+    Не дает одному пользователю запустить одно и то же дорогое действие параллельно.
+    Действие задается флагом хэндлера: flags={"inflight_guard": "more_recs"}. Пока хэндлер с этим
+    действием выполняется для пользователя (и INFLIGHT_GUARD_DEBOUNCE_SECONDS после), повторные
+    апдейты не доходят до хэндлера: пользователь сразу получает ответ "уже готовлю", а вызов
+    считается подавленным. Так двойное нажатие "Еще" не запускает второй запрос к Gemini и не
+    затирает current_session_shown_ids параллельной записью.
+    Состояние в памяти процесса: при webhook все апдейты пользователя приходят в один воркер.
+    """
+
+    def __init__(self, debounce_seconds: float = 1.5):
+        super().__init__()
+        self.debounce_seconds = debounce_seconds
+        self._in_flight: Set[GuardKey] = set()
+        self._notified: Set[GuardKey] = set()  # Кому уже отправлено сообщение "уже готовлю" (для Message)
+        self._recent: Dict[GuardKey, float] = {}  # Ключ -> время (monotonic), до которого действует debounce
+        self.stats: Dict[str, Any] = {"guarded": 0, "suppressed_in_flight": 0, "suppressed_debounce": 0,
+                                      "suppressed_by_action": {}}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        action = get_flag(data, "inflight_guard")
+        user = data.get("event_from_user")
+        if not action or user is None:
+            return await handler(event, data)
+
+        key = (user.id, action)
+        now = time.monotonic()
+        if key in self._in_flight:
+            self.stats["suppressed_in_flight"] += 1
+            await self._suppress(key, event, data)
+            return None
+        debounce_until = self._recent.get(key)
+        if debounce_until is not None:
+            if now < debounce_until:
+                self.stats["suppressed_debounce"] += 1
+                await self._suppress(key, event, data)
+                return None
+            del self._recent[key]
+
+        self.stats["guarded"] += 1
+        self._in_flight.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+            self._notified.discard(key)
+            self._recent[key] = time.monotonic() + self.debounce_seconds
+            if len(self._recent) > _RECENT_SWEEP_THRESHOLD:
+                now = time.monotonic()
+                self._recent = {k: until for k, until in self._recent.items() if until > now}
+
+    async def _suppress(self, key: GuardKey, event: TelegramObject, data: Dict[str, Any]) -> None:
+        by_action = self.stats["suppressed_by_action"]
+        by_action[key[1]] = by_action.get(key[1], 0) + 1
+        logging.info(f"Inflight Guard: Повторный запуск '{key[1]}' пользователем {key[0]} подавлен.")
+
+        lang = "ru"
+        state = data.get("state")
+        if isinstance(state, FSMContext):
+            lang = await state.get_value("user_language", "ru")
+        try:
+            if isinstance(event, CallbackQuery):
+                # На callback нужно ответить в любом случае - ответ заодно показывает всплывающую подсказку
+                await event.answer(get_text("request_in_progress_text", lang))
+            elif isinstance(event, Message) and key not in self._notified:
+                # В чат - не больше одного сообщения за время выполнения, чтобы не спамить в ответ на спам
+                self._notified.add(key)
+                await event.answer(get_text("request_in_progress_text", lang))
+        except Exception as e:
+            logging.warning(f"Inflight Guard: Не удалось отправить ответ пользователю {key[0]}: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "suppressed_by_action": dict(self.stats["suppressed_by_action"]),
+            "in_flight": len(self._in_flight),
+        }
+
+
+inflight_guard_middleware = InflightGuardMiddleware(debounce_seconds=INFLIGHT_GUARD_DEBOUNCE_SECONDS)
@@ -0,0 +1,62 @@
+# middlewares/metrics_middleware.py
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import Response, TelegramMethod
+from aiogram.types import TelegramObject
+
+from utils.metrics import bot_api_duration, handler_duration
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Замеряет длительность и исход каждого хэндлера (handler_duration_seconds).
+    Регистрируется как внутренняя мидлварь на наблюдателях событий диспетчера (dp.message,
+    dp.callback_query, ...): она вызывается уже для выбранного хэндлера, поэтому знает его имя.
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        handler_name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        outcome = "ok"
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started_at, event_type=type(event).__name__,
+                                     handler=handler_name, outcome=outcome)
+
+
+class BotAPIMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет каждый вызов Telegram Bot API (bot_api_duration_seconds по методу и исходу)."""
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType[Any],
+            bot: Bot,
+            method: TelegramMethod[Any],
+    ) -> Response[Any]:
+        outcome = "ok"
+        started_at = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            outcome = type(e).__name__  # TelegramRetryAfter, TelegramBadRequest, TelegramNetworkError, ...
+            raise
+        finally:
+            bot_api_duration.observe(time.perf_counter() - started_at, method=type(method).__name__,
+                                     outcome=outcome)
+
+
+handler_metrics_middleware = HandlerMetricsMiddleware()
+bot_api_metrics_middleware = BotAPIMetricsMiddleware()
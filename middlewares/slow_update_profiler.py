@@ -0,0 +1,265 @@
+# middlewares/slow_update_profiler.py
+import asyncio
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.handler import CallableObject, HandlerObject
+from aiogram.types import TelegramObject
+
+# Профилировщик медленных апдейтов включается явно: без него мидлварь даже не регистрируется
+SLOW_UPDATE_PROFILER_ENABLED = os.getenv("SLOW_UPDATE_PROFILER_ENABLED", "0").lower() in ("1", "true", "yes")
+# Через сколько секунд обработки апдейт считается медленным и к нему подключается сэмплер стеков
+SLOW_UPDATE_THRESHOLD_SECONDS = float(os.getenv("SLOW_UPDATE_THRESHOLD_SECONDS", "5"))
+SLOW_UPDATE_SAMPLE_INTERVAL_MS = float(os.getenv("SLOW_UPDATE_SAMPLE_INTERVAL_MS", "20"))
+# Сколько медленных апдейтов профилировать одновременно (остальные только считаются)
+SLOW_UPDATE_MAX_CONCURRENT = int(os.getenv("SLOW_UPDATE_MAX_CONCURRENT", "4"))
+# Относительный путь считается от корня проекта, а не от текущего каталога процесса
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLOW_UPDATE_PROFILE_DIR = os.path.join(_PROJECT_ROOT, os.getenv("SLOW_UPDATE_PROFILE_DIR", "data/slow_updates"))
+# Предел места на диске под профили: самые старые файлы удаляются
+SLOW_UPDATE_PROFILE_MAX_MB = float(os.getenv("SLOW_UPDATE_PROFILE_MAX_MB", "50"))
+
+_MAX_STACK_DEPTH = 200
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def _frame_label(frame: Any) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    # ";" разделяет кадры в folded формате, поэтому в подписях его быть не должно
+    return f"{name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})".replace(";", ":")
+
+
+def _below_profiler(frames: List[Any]) -> List[str]:
+    """
+    Подписи кадров ниже SlowUpdateProfiler.__call__: кадры event loop и запуска диспетчера
+    одинаковы у всех апдейтов и только загромождают flame graph.
+    """
+    for index, frame in enumerate(frames):
+        if frame.f_code is SlowUpdateProfiler.__call__.__code__:
+            frames = frames[index + 1:]
+            break
+    return [_frame_label(frame) for frame in frames]
+
+
+def _await_frames(task: "asyncio.Task[Any]") -> Tuple[List[Any], Any]:
+    """Кадры цепочки await задачи (корутина -> корутина, которую она ждет, -> ...) и то, что ждет последняя."""
+    frames = []
+    awaitable: Any = task.get_coro()
+    while awaitable is not None and len(frames) < _MAX_STACK_DEPTH:
+        frame = (getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None)
+                 or getattr(awaitable, "gi_frame", None))
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = (getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None)
+                     or getattr(awaitable, "gi_yieldfrom", None))
+    return frames, awaitable
+
+
+def _current_handler_name(task: "asyncio.Task[Any]") -> str:
+    """
+    Имя хэндлера, который сейчас выполняет задача апдейта. Внешняя мидлварь апдейта не видит выбранный
+    хэндлер в data, поэтому он берется из кадра HandlerObject.call в цепочке await - и только для медленных апдейтов.
+    """
+    for frame in reversed(_await_frames(task)[0]):
+        if frame.f_code is CallableObject.call.__code__:
+            handler_object = frame.f_locals.get("self")
+            if isinstance(handler_object, HandlerObject):
+                return getattr(handler_object.callback, "__name__", "unknown")
+    return "unknown"
+
+
+class _ProfiledUpdate:
+    """Медленный апдейт, к задаче которого подключен сэмплер."""
+
+    __slots__ = ("task", "loop", "loop_thread_id", "root", "samples", "attached_at")
+
+    def __init__(self, task: "asyncio.Task[Any]", loop: asyncio.AbstractEventLoop, root: List[str]):
+        self.task = task
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.root = root
+        self.samples: "Counter[str]" = Counter()
+        self.attached_at = time.monotonic()
+
+    def _thread_stack(self) -> Optional[List[str]]:
+        """Стек потока event loop, если он сейчас выполняет код этой задачи (CPU работа, блокирующий вызов)."""
+        if asyncio.current_task(self.loop) is not self.task:
+            return None
+        frame = sys._current_frames().get(self.loop_thread_id)
+        frames = []
+        while frame is not None and len(frames) < _MAX_STACK_DEPTH:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        return _below_profiler(frames)
+
+    def _await_chain(self) -> List[str]:
+        """Цепочка await приостановленной задачи: корутина -> корутина, которую она ждет, -> ... -> future."""
+        frames, awaitable = _await_frames(self.task)
+        labels = _below_profiler(frames)
+        if awaitable is not None and not hasattr(awaitable, "cr_await"):
+            labels.append(f"<await {type(awaitable).__name__}>")  # Future/Task, которую ждет самая глубокая корутина
+        return labels
+
+    def sample(self) -> None:
+        if self.task.done():
+            return
+        stack = self._thread_stack()
+        if stack is None:
+            stack = ["<suspended>"] + self._await_chain()
+        else:
+            stack = ["<running>"] + stack
+        self.samples[";".join(self.root + stack)] += 1
+
+
+class SlowUpdateProfiler(BaseMiddleware):
+    """
+    Находит медленные апдейты и сохраняет, на что ушло их время.
+    Каждый апдейт только ставит таймер на loop.call_later (и снимает его по завершении), поэтому
+    накладные расходы на обычные апдейты пренебрежимо малы. Если обработка длится дольше порога,
+    к задаче апдейта подключается фоновый поток-сэмплер: каждые SLOW_UPDATE_SAMPLE_INTERVAL_MS он
+    снимает стек потока event loop, если тот сейчас занят этой задачей, или цепочку await
+    приостановленной задачи (видно, чего она ждет: Gemini, Telegram, БД). По завершении апдейта
+    стеки пишутся в файл в folded формате (flamegraph.pl, speedscope, inferno); корневые кадры -
+    тип апдейта, хэндлер и пользователь. Стеки собираются с момента превышения порога.
+    Регистрируется первой внешней мидлварью на dp.update: в замер попадает вся обработка апдейта,
+    включая остальные мидлвари (FSM, сессия БД, защита от повторов), а на каждый апдейт - одна обертка
+    вместо обертки на каждом наблюдателе. Хэндлер определяется лениво, когда срабатывает порог.
+    """
+
+    def __init__(self, threshold_seconds: float = 5.0, sample_interval_ms: float = 20.0,
+                 max_concurrent: int = 4, directory: str = SLOW_UPDATE_PROFILE_DIR, max_disk_mb: float = 50.0):
+        super().__init__()
+        self.threshold_seconds = threshold_seconds
+        self.sample_interval = sample_interval_ms / 1000
+        self.max_concurrent = max_concurrent
+        self.directory = directory
+        self.max_disk_bytes = int(max_disk_mb * 1024 * 1024)
+        self._active: Dict["asyncio.Task[Any]", _ProfiledUpdate] = {}
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        self.stats: Dict[str, int] = {"updates": 0, "slow_updates": 0, "profiled": 0, "skipped_busy": 0,
+                                      "samples": 0, "profiles_written": 0, "write_errors": 0,
+                                      "profiles_deleted": 0}
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any],
+    ) -> Any:
+        task = asyncio.current_task()
+        if task is None:
+            return await handler(event, data)
+        loop = asyncio.get_running_loop()
+        started_at = time.monotonic()
+        timer = loop.call_later(self.threshold_seconds, self._attach, task, loop, event, data)
+        self.stats["updates"] += 1
+        try:
+            return await handler(event, data)
+        finally:
+            timer.cancel()
+            with self._lock:
+                profiled = self._active.pop(task, None)
+            if profiled is not None:
+                self._finish(profiled, time.monotonic() - started_at)
+
+    def _attach(self, task: "asyncio.Task[Any]", loop: asyncio.AbstractEventLoop, event: TelegramObject,
+                data: Dict[str, Any]) -> None:
+        self.stats["slow_updates"] += 1
+        if task.done() or task in self._active:
+            return
+        if len(self._active) >= self.max_concurrent:
+            self.stats["skipped_busy"] += 1
+            return
+
+        handler_name = _current_handler_name(task)
+        update_type = getattr(event, "event_type", None) or type(event).__name__
+        user = data.get("event_from_user")
+        root = [f"update:{update_type}", f"handler:{handler_name}", f"user:{getattr(user, 'id', 'unknown')}"]
+        logging.warning(f"Slow Update Profiler: Апдейт {update_type} ({handler_name}, пользователь "
+                        f"{getattr(user, 'id', 'unknown')}) обрабатывается дольше {self.threshold_seconds:g} с, "
+                        f"подключаем сэмплер стеков.")
+        with self._lock:
+            self._active[task] = _ProfiledUpdate(task, loop, root)
+            self.stats["profiled"] += 1
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="slow-update-sampler", daemon=True)
+                self._sampler.start()
+
+    def _sample_loop(self) -> None:
+        while True:
+            with self._lock:
+                profiled_updates = list(self._active.values())
+                if not profiled_updates:
+                    self._sampler = None  # Поток живет, только пока есть медленные апдейты
+                    return
+            for profiled in profiled_updates:
+                try:
+                    profiled.sample()
+                    self.stats["samples"] += 1
+                except Exception as e:  # Сэмплер не должен ронять ни себя, ни бота
+                    logging.debug(f"Slow Update Profiler: Ошибка снятия стека: {e}")
+            time.sleep(self.sample_interval)
+
+    def _finish(self, profiled: _ProfiledUpdate, duration: float) -> None:
+        update_type, handler_name, user = (part.split(":", 1)[1] for part in profiled.root)
+        file_name = _UNSAFE_FILENAME_CHARS.sub("_", f"{time.strftime('%Y%m%d-%H%M%S')}_{update_type}_"
+                                                    f"{handler_name}_{user}_{duration:.1f}s.folded")
+        samples = profiled.samples or Counter({";".join(profiled.root): 1})
+        lines = [f"{stack} {count}" for stack, count in samples.items()]
+        logging.warning(f"Slow Update Profiler: Апдейт {update_type} ({handler_name}, пользователь {user}) "
+                        f"обработан за {duration:.1f} с; профиль ({sum(samples.values())} сэмплов): {file_name}")
+        # Запись и очистка каталога - в пуле потоков, не в event loop
+        profiled.loop.run_in_executor(None, self._write_profile, file_name, lines)
+
+    def _write_profile(self, file_name: str, lines: List[str]) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, os.path.join(self.directory, file_name))
+            self.stats["profiles_written"] += 1
+            self._enforce_disk_limit(keep=file_name)
+        except OSError as e:
+            self.stats["write_errors"] += 1
+            logging.error(f"Slow Update Profiler: Не удалось сохранить профиль {file_name}: {e}")
+
+    def _enforce_disk_limit(self, keep: str) -> None:
+        """Удаляет самые старые профили, пока каталог не уложится в лимит (только что записанный остается)."""
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".folded") and entry.name != keep:
+                stat = entry.stat()
+                profiles.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in profiles) + os.path.getsize(os.path.join(self.directory, keep))
+        for _, size, path in sorted(profiles):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.stats["profiles_deleted"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "active": len(self._active)}
+
+
+slow_update_profiler: Optional[SlowUpdateProfiler] = (
+    SlowUpdateProfiler(threshold_seconds=SLOW_UPDATE_THRESHOLD_SECONDS,
+                       sample_interval_ms=SLOW_UPDATE_SAMPLE_INTERVAL_MS,
+                       max_concurrent=SLOW_UPDATE_MAX_CONCURRENT,
+                       directory=SLOW_UPDATE_PROFILE_DIR,
+                       max_disk_mb=SLOW_UPDATE_PROFILE_MAX_MB)
+    if SLOW_UPDATE_PROFILER_ENABLED else None
+)
@@ -0,0 +1,48 @@
+from utils.ai_history import compact_history, recommendation_index
+
+
+def _remember(rec_id: str, rec_type: str, cuisines=()) -> str:
+    recommendation_index.remember([{"id": rec_id, "type": rec_type, "details": {"cuisine_type": list(cuisines)}}])
+    return rec_id
+
+
+def _kept_ids(history, feedback_type):
+    return next((entry["item_ids"] for entry in history if entry["type"] == feedback_type), [])
+
+
+def _feedback():
+    liked = [_remember(f"restaurant_trattoria_{i:02d}", "restaurant", ["italian"]) for i in range(12)]
+    liked.insert(3, _remember("museum_orsay_paris_01", "museum"))  # Редкий тип среди лайков
+    disliked = [_remember(f"hotel_chain_{i:02d}", "hotel") for i in range(8)]
+    # Старый дизлайк итальянского ресторана противоречит профилю "любит итальянскую кухню"
+    disliked.insert(0, _remember("restaurant_tourist_trap_01", "restaurant", ["italian"]))
+    return liked, disliked
+
+
+def test_compaction_keeps_rare_likes_over_older_typical_ones():
+    liked, disliked = _feedback()
+    history, _, report = compact_history(liked, disliked, [], token_budget=120, min_recent=2)
+
+    kept_liked = _kept_ids(history, "user_feedback_positive")
+    assert report["ids_dropped"] > 0
+    assert kept_liked == ["museum_orsay_paris_01", *liked[-2:]]  # Исходный порядок, min_recent последних
+    summary = next(entry for entry in history if entry["type"] == "preference_summary")
+    assert summary["older_likes_count"] == len(liked) - len(kept_liked)
+    assert summary["liked_types"] == {"restaurant": len(liked) - len(kept_liked)}
+
+
+def test_compaction_keeps_dislikes_that_contradict_likes():
+    liked, disliked = _feedback()
+    history, _, _ = compact_history(liked, disliked, [], token_budget=110, min_recent=2)
+
+    kept_disliked = _kept_ids(history, "user_feedback_negative")
+    assert len(kept_disliked) < len(disliked)
+    assert kept_disliked[0] == "restaurant_tourist_trap_01"
+    assert kept_disliked[-2:] == disliked[-2:]
+
+
+def test_shown_ids_are_trimmed_from_oldest():
+    shown = [f"attraction_place_{i:03d}" for i in range(60)]
+    _, kept_shown, _ = compact_history([], [], shown, token_budget=100, min_recent=5)
+    assert kept_shown == shown[len(shown) - len(kept_shown):]
+    assert len(kept_shown) < len(shown)
@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendPhoto
+
+import handlers.trip_planning_handlers as trip_planning_handlers
+from utils.telegram_media_cache import TelegramMediaCache
+
+PHOTO_URL = "https://img/le_bristol.jpg"
+CARD = {"id": "hotel_le_bristol_paris_01", "text": "<b>Le Bristol</b>", "photo_url": PHOTO_URL,
+        "booking_url": None, "maps_url": None}
+
+
+class FakeBot:
+    def __init__(self, error_message: str):
+        self.error_message = error_message
+        self.photos = []
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.photos.append(photo)
+        raise TelegramBadRequest(SendPhoto(chat_id=chat_id, photo=photo), self.error_message)
+
+
+def _message(sent_texts: list) -> SimpleNamespace:
+    async def answer(text, **kwargs):
+        sent_texts.append(text)
+
+    return SimpleNamespace(chat=SimpleNamespace(id=111111111), message_id=1, answer=answer)
+
+
+@pytest.fixture
+def media_cache(tmp_path, monkeypatch):
+    cache = TelegramMediaCache(str(tmp_path / "telegram_media_cache.json"), max_entries=100,
+                               negative_ttl_seconds=3600, save_interval_seconds=30)
+    monkeypatch.setattr(trip_planning_handlers, "telegram_media_cache", cache)
+    return cache
+
+
+@pytest.mark.parametrize("error_message", [
+    "Bad Request: wrong file identifier/HTTP URL specified",
+    "Bad Request: failed to get HTTP URL content",
+    "Bad Request: wrong type of the web page content",
+])
+def test_image_fetch_error_marks_url_broken(media_cache, error_message):
+    sent_texts = []
+    asyncio.run(trip_planning_handlers._deliver_card(_message(sent_texts), FakeBot(error_message), CARD, "ru"))
+    assert sent_texts == [CARD["text"]]
+    assert media_cache.is_broken(PHOTO_URL)
+
+
+def test_other_errors_fall_back_to_text_without_touching_cache(media_cache):
+    media_cache.remember_file_id(PHOTO_URL, "file-bristol")
+    bot = FakeBot("Bad Request: can't parse entities: unsupported start tag")
+    sent_texts = []
+    asyncio.run(trip_planning_handlers._deliver_card(_message(sent_texts), bot, CARD, "ru"))
+
+    assert sent_texts == [CARD["text"]]
+    assert bot.photos == ["file-bristol"]  # Повтор с URL упал бы так же
+    assert not media_cache.is_broken(PHOTO_URL)
+    assert media_cache.get_file_id(PHOTO_URL) == "file-bristol"
@@ -0,0 +1,49 @@
+import asyncio
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from handlers.trip_planning_states import TripPlanning
+from middlewares.fsm_snapshot_middleware import FSMSnapshotMiddleware, flush_state
+
+KEY = StorageKey(bot_id=42, chat_id=111111111, user_id=111111111)
+
+
+def test_flush_state_writes_before_handler_returns():
+    async def scenario():
+        storage = MemoryStorage()
+        seen_by_next_update = {}
+
+        async def handler(event, data):
+            state = data["state"]
+            await state.update_data(current_session_shown_ids=["a", "b"])
+            await state.set_state(TripPlanning.waiting_for_budget)
+            assert await storage.get_state(KEY) is None  # Пока только в снимке
+            await flush_state(state)
+            # Здесь хэндлер отправил бы кнопку: ее апдейт уже читает новое состояние
+            seen_by_next_update["state"] = await storage.get_state(KEY)
+            seen_by_next_update["data"] = await storage.get_data(KEY)
+            await state.update_data(user_budget="mid")
+
+        middleware = FSMSnapshotMiddleware()
+        await middleware(handler, object(), {"state": FSMContext(storage=storage, key=KEY)})
+
+        assert seen_by_next_update == {"state": TripPlanning.waiting_for_budget.state,
+                                       "data": {"current_session_shown_ids": ["a", "b"]}}
+        # Изменения после flush_state записываются в конце апдейта, как обычно
+        assert await storage.get_data(KEY) == {"current_session_shown_ids": ["a", "b"], "user_budget": "mid"}
+        assert middleware.stats["writes"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_flush_state_is_noop_for_plain_context():
+    async def scenario():
+        storage = MemoryStorage()
+        state = FSMContext(storage=storage, key=KEY)
+        await state.update_data(user_language="ru")
+        await flush_state(state)
+        assert await storage.get_data(KEY) == {"user_language": "ru"}
+
+    asyncio.run(scenario())
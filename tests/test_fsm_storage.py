@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from fakeredis import aioredis as fake_aioredis
+
+import utils.fsm_storage as fsm_storage
+from handlers.trip_planning_states import TripPlanning
+from utils.fsm_storage import CompactRedisStorage, create_fsm_storage
+
+KEY = StorageKey(bot_id=42, chat_id=111111111, user_id=111111111)
+STATE_TTL, DATA_TTL = 600, 3600
+
+
+@pytest.fixture(params=["msgpack", "json"])
+def codec(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(fsm_storage, "msgpack", None)
+    elif fsm_storage.msgpack is None:
+        pytest.skip("msgpack не установлен")
+    return request.param
+
+
+def _storage() -> CompactRedisStorage:
+    return CompactRedisStorage(fake_aioredis.FakeRedis(), state_ttl=STATE_TTL, data_ttl=DATA_TTL)
+
+
+def test_state_set_get_and_ttl(codec):
+    async def scenario():
+        storage = _storage()
+        await storage.set_state(KEY, TripPlanning.waiting_for_location)
+        assert await storage.get_state(KEY) == TripPlanning.waiting_for_location.state
+        assert 0 < await storage.redis.ttl(storage.key_builder.build(KEY, "state")) <= STATE_TTL
+
+        await storage.set_state(KEY, None)
+        assert await storage.get_state(KEY) is None
+        assert not await storage.redis.exists(storage.key_builder.build(KEY, "state"))
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_data_set_update_get_and_ttl(codec):
+    async def scenario():
+        storage = _storage()
+        await storage.set_data(KEY, {"user_language": "ru", "current_session_shown_ids": ["a", "b"]})
+        updated = await storage.update_data(KEY, {"user_budget": "средний", "user_location_geo": [48.85, 2.35]})
+        assert updated == {"user_language": "ru", "current_session_shown_ids": ["a", "b"],
+                           "user_budget": "средний", "user_location_geo": [48.85, 2.35]}
+        assert await storage.get_data(KEY) == updated
+        assert await storage.get_value(KEY, "user_language") == "ru"
+        assert await storage.get_value(KEY, "missing", "default") == "default"
+
+        data_key = storage.key_builder.build(KEY, "data")
+        raw = await storage.redis.hget(data_key, "user_language")
+        assert raw[:1] == (b"m" if codec == "msgpack" else b"j")
+        # У данных свой TTL, длиннее, чем у состояния
+        assert STATE_TTL < await storage.redis.ttl(data_key) <= DATA_TTL
+
+        await storage.set_data(KEY, {"user_language": "en"})  # set_data заменяет словарь целиком
+        assert await storage.get_data(KEY) == {"user_language": "en"}
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_json_values_stay_readable_after_enabling_msgpack(monkeypatch):
+    if fsm_storage.msgpack is None:
+        pytest.skip("msgpack не установлен")
+
+    async def scenario():
+        storage = _storage()
+        with monkeypatch.context() as patch:  # Воркер без msgpack
+            patch.setattr(fsm_storage, "msgpack", None)
+            await storage.set_data(KEY, {"user_language": "fr"})
+        # Воркер с msgpack дописывает данные и читает оба формата
+        assert await storage.update_data(KEY, {"user_budget": "эконом"}) == {"user_language": "fr",
+                                                                           "user_budget": "эконом"}
+        data_key = storage.key_builder.build(KEY, "data")
+        assert (await storage.redis.hget(data_key, "user_language"))[:1] == b"j"
+        assert (await storage.redis.hget(data_key, "user_budget"))[:1] == b"m"
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_fsm_context_clear_deletes_keys(codec):
+    async def scenario():
+        storage = _storage()
+        context = FSMContext(storage=storage, key=KEY)
+        await context.set_state(TripPlanning.waiting_for_interests)
+        await context.update_data(user_interests_text="музеи")
+        await context.clear()
+
+        assert await context.get_state() is None
+        assert await context.get_data() == {}
+        assert await storage.redis.keys("*") == []
+        await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_create_fsm_storage_uses_redis_when_configured(monkeypatch):
+    monkeypatch.setattr(fsm_storage, "FSM_STORAGE", "redis")
+    monkeypatch.setattr(fsm_storage, "Redis", fake_aioredis.FakeRedis)
+    storage = create_fsm_storage()
+    assert isinstance(storage, CompactRedisStorage)
+    assert (storage.state_ttl, storage.data_ttl) == (fsm_storage.FSM_STATE_TTL_SECONDS,
+                                                     fsm_storage.FSM_DATA_TTL_SECONDS)
+
+    monkeypatch.setattr(fsm_storage, "Redis", None)  # Без пакета redis - откат на MemoryStorage
+    assert not isinstance(create_fsm_storage(), CompactRedisStorage)
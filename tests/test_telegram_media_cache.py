@@ -0,0 +1,54 @@
+import json
+
+from utils.telegram_media_cache import TelegramMediaCache
+
+
+def _cache(path) -> TelegramMediaCache:
+    return TelegramMediaCache(str(path), max_entries=100, negative_ttl_seconds=3600, save_interval_seconds=30)
+
+
+def test_workers_sharing_one_file_keep_each_others_entries(tmp_path):
+    path = tmp_path / "telegram_media_cache.json"
+    worker_a, worker_b = _cache(path), _cache(path)  # Оба загрузились, пока файла еще нет
+
+    worker_a.remember_file_id("https://img/a.jpg", "file-a")
+    worker_b.remember_file_id("https://img/b.jpg", "file-b")
+    worker_b.mark_broken("https://img/broken.jpg")
+    worker_a.flush()
+    worker_b.flush()  # Последним пишет B - записи A не должны пропасть
+
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert saved["file_ids"] == {"https://img/a.jpg": "file-a", "https://img/b.jpg": "file-b"}
+    assert list(saved["broken"]) == ["https://img/broken.jpg"]
+    # B подхватил file_id, который узнал A
+    assert worker_b.get_file_id("https://img/a.jpg") == "file-a"
+
+
+def test_forgotten_file_id_is_not_restored_from_disk(tmp_path):
+    path = tmp_path / "telegram_media_cache.json"
+    worker_a = _cache(path)
+    worker_a.remember_file_id("https://img/a.jpg", "file-a")
+    worker_a.flush()
+
+    worker_b = _cache(path)
+    worker_b.forget_file_id("https://img/a.jpg")
+    worker_b.flush()
+    worker_a.remember_file_id("https://img/c.jpg", "file-c")
+    worker_a.flush()
+
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert saved["file_ids"] == {"https://img/c.jpg": "file-c"}
+    assert worker_b.get_file_id("https://img/a.jpg") is None
+
+
+def test_working_url_clears_negative_entry_of_other_worker(tmp_path):
+    path = tmp_path / "telegram_media_cache.json"
+    worker_a, worker_b = _cache(path), _cache(path)
+    worker_a.mark_broken("https://img/a.jpg")
+    worker_a.flush()
+    worker_b.remember_file_id("https://img/a.jpg", "file-a")
+    worker_b.flush()
+
+    saved = json.loads(path.read_text(encoding="utf-8"))
+    assert saved["broken"] == {}
+    assert saved["file_ids"] == {"https://img/a.jpg": "file-a"}
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import webhook_server
+from webhook_server import WebhookFanout, build_app, consume_updates, shard_key
+
+SECRET = "test-secret"
+UPDATES = json.loads((Path(__file__).parent / "data" / "webhook_updates.json").read_text(encoding="utf-8"))
+ANNA, PAUL = 111111111, 222222222
+
+
+def _close(fanout: WebhookFanout) -> None:
+    for worker_queue in fanout.queues:
+        worker_queue.close()
+        worker_queue.join_thread()
+
+
+async def _post(client: TestClient, update: dict, secret: str = SECRET) -> int:
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    response = await client.post(webhook_server.WEBHOOK_PATH, data=json.dumps(update), headers=headers)
+    return response.status
+
+
+def test_shard_key_uses_sender_of_recorded_updates():
+    assert [shard_key(update) for update in UPDATES] == [ANNA, ANNA, PAUL, ANNA]
+
+
+def test_secret_token_is_required():
+    async def scenario():
+        fanout = WebhookFanout(workers=1, queue_size=10, secret=SECRET)
+        async with TestClient(TestServer(build_app(fanout))) as client:
+            assert await _post(client, UPDATES[0], secret="") == 401
+            assert await _post(client, UPDATES[0], secret="wrong") == 401
+            assert await _post(client, UPDATES[0]) == 200
+        assert fanout.stats["rejected_auth"] == 2
+        assert fanout.stats["received"] == 1
+        _close(fanout)
+
+    asyncio.run(scenario())
+
+
+def test_full_worker_queue_returns_503():
+    async def scenario():
+        fanout = WebhookFanout(workers=1, queue_size=1, secret=SECRET)
+        async with TestClient(TestServer(build_app(fanout))) as client:
+            assert await _post(client, UPDATES[0]) == 200
+            assert await _post(client, UPDATES[1]) == 503
+        assert fanout.stats["rejected_full"] == 1
+        _close(fanout)
+
+    asyncio.run(scenario())
+
+
+def test_same_user_updates_run_in_order_and_stop_drains_queue():
+    async def scenario():
+        fanout = WebhookFanout(workers=1, queue_size=100, secret=SECRET)
+        timeline = {}
+
+        async def process(raw_update: bytes) -> None:
+            update = json.loads(raw_update)
+            started = time.monotonic()
+            # Первый апдейт Анны долгий: второй не должен начаться раньше, а Поль не должен его ждать
+            await asyncio.sleep(0.3 if update["update_id"] == UPDATES[0]["update_id"] else 0.01)
+            timeline[update["update_id"]] = (started, time.monotonic())
+
+        consumer = asyncio.create_task(consume_updates(0, fanout.queues[0], process, drain_timeout=5))
+        async with TestClient(TestServer(build_app(fanout))) as client:
+            for update in UPDATES:
+                assert await _post(client, update) == 200
+            await fanout.drain()  # _STOP: воркер дорабатывает уже принятые апдейты и завершается
+            assert await _post(client, UPDATES[0]) == 503  # После остановки новые апдейты не принимаются
+        stats = await asyncio.wait_for(consumer, timeout=5)
+
+        assert stats["processed"] == len(UPDATES)
+        assert stats["dropped_on_stop"] == 0
+        anna_ids = [update["update_id"] for update in UPDATES if shard_key(update) == ANNA]
+        for previous, following in zip(anna_ids, anna_ids[1:]):
+            assert timeline[following][0] >= timeline[previous][1]
+        paul_id = UPDATES[2]["update_id"]
+        assert timeline[paul_id][1] < timeline[anna_ids[0]][1]
+        _close(fanout)
+
+    asyncio.run(scenario())
+
+
+def test_stop_cancels_updates_that_exceed_drain_timeout():
+    async def scenario():
+        fanout = WebhookFanout(workers=1, queue_size=100, secret=SECRET)
+
+        async def process(raw_update: bytes) -> None:
+            await asyncio.sleep(10)
+
+        for update in UPDATES[:2]:  # Два апдейта одного пользователя: второй ждет первый
+            fanout.queues[0].put((shard_key(update), json.dumps(update).encode()))
+        fanout.queues[0].put(webhook_server._STOP)
+        stats = await asyncio.wait_for(consume_updates(0, fanout.queues[0], process, drain_timeout=0.1), timeout=5)
+
+        assert stats["processed"] == 0
+        assert stats["dropped_on_stop"] == 2
+        _close(fanout)
+
+    asyncio.run(scenario())
@@ -0,0 +1,170 @@
+# utils/ai_cache.py
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# Настройки кэша читаются из окружения (load_dotenv() вызывается в main.py до импортов)
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "512"))
+AI_CACHE_TTL_SECONDS = float(os.getenv("AI_CACHE_TTL_SECONDS", str(6 * 60 * 60)))
+AI_CACHE_DIR = os.getenv("AI_CACHE_DIR", "")  # Пусто - дисковый уровень выключен
+# Сколько хранить устаревшие записи как запасной ответ на время недоступности AI
+AI_CACHE_STALE_TTL_SECONDS = float(os.getenv("AI_CACHE_STALE_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+def make_cache_key(prepared_data: Dict[str, Any]) -> str:
+    """
+    Строит канонический ключ кэша по результату _prepare_user_data_for_prompt.
+    В ключ входят history и previously_shown_ids, поэтому ответы разных пользователей
+    смешиваются только при полностью совпадающих входных данных.
+    """
+    canonical = json.dumps(prepared_data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class RecommendationCache:
+    """
+    Двухуровневый кэш ответов AI: LRU в памяти процесса и (опционально) файлы на диске.
+    Записи старше ttl_seconds считаются устаревшими; до возраста stale_ttl_seconds они еще
+    хранятся и отдаются только по явному запросу (allow_stale=True), после - удаляются.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 6 * 60 * 60, disk_dir: Optional[str] = None,
+                 stale_ttl_seconds: float = 0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stale_ttl_seconds = max(stale_ttl_seconds, ttl_seconds)
+        self.disk_dir = disk_dir or None
+        self._memory: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            "hits_memory": 0,
+            "hits_disk": 0,
+            "hits_stale": 0,
+            "misses": 0,
+            "expired": 0,
+            "stores": 0,
+            "evictions": 0,
+        }
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+            except OSError as e:
+                logging.error(f"AI Cache: Не удалось создать каталог дискового кэша '{self.disk_dir}': {e}")
+                self.disk_dir = None
+
+    def _is_fresh(self, created_at: float) -> bool:
+        return (time.time() - created_at) < self.ttl_seconds
+
+    def _is_usable_stale(self, created_at: float) -> bool:
+        return (time.time() - created_at) < self.stale_ttl_seconds
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Tuple[float, Any]]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+            return float(record["created_at"]), record["value"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"AI Cache: Поврежденная запись дискового кэша {path}: {e}. Удаляем.")
+            self._remove_disk(key)
+            return None
+
+    def _write_disk(self, key: str, created_at: float, value: Any) -> None:
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": created_at, "value": value}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)  # Атомарная замена, чтобы не читать наполовину записанный файл
+        except (OSError, TypeError, ValueError) as e:
+            logging.warning(f"AI Cache: Не удалось записать дисковый кэш {path}: {e}")
+
+    def _remove_disk(self, key: str) -> None:
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _remember_in_memory(self, key: str, created_at: float, value: Any) -> None:
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get(self, key: str, allow_stale: bool = False) -> Optional[Any]:
+        """
+        Возвращает копию закэшированного значения или None (промах/устарело).
+        allow_stale=True разрешает вернуть устаревшую (но не старше stale_ttl_seconds) запись -
+        для ответа, когда AI недоступен.
+        """
+        entry = self._memory.get(key)
+        if entry is None and self.disk_dir:
+            entry = await asyncio.to_thread(self._read_disk, key)
+            if entry is not None and self._is_usable_stale(entry[0]):
+                self._remember_in_memory(key, entry[0], entry[1])
+                if self._is_fresh(entry[0]):
+                    self.stats["hits_disk"] += 1
+                    return copy.deepcopy(entry[1])
+            elif entry is not None:
+                await asyncio.to_thread(self._remove_disk, key)
+                entry = None
+        elif entry is not None and self._is_fresh(entry[0]):
+            self._memory.move_to_end(key)
+            self.stats["hits_memory"] += 1
+            return copy.deepcopy(entry[1])
+
+        if entry is not None:
+            created_at, value = entry
+            if not self._is_usable_stale(created_at):
+                self._memory.pop(key, None)
+                if self.disk_dir:
+                    await asyncio.to_thread(self._remove_disk, key)
+            elif allow_stale:
+                self.stats["hits_stale"] += 1
+                return copy.deepcopy(value)
+            self.stats["expired"] += 1
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Any) -> None:
+        """Сохраняет значение в памяти и, если включено, на диске."""
+        created_at = time.time()
+        stored_value = copy.deepcopy(value)
+        self._remember_in_memory(key, created_at, stored_value)
+        self.stats["stores"] += 1
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, created_at, stored_value)
+
+    def clear(self) -> None:
+        """Очищает уровень в памяти (дисковые файлы истекут по TTL)."""
+        self._memory.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        hits = self.stats["hits_memory"] + self.stats["hits_disk"]
+        total = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hits": hits,
+            "hit_rate": (hits / total) if total else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+
+recommendation_cache: Optional[RecommendationCache] = (
+    RecommendationCache(max_entries=AI_CACHE_MAX_ENTRIES, ttl_seconds=AI_CACHE_TTL_SECONDS, disk_dir=AI_CACHE_DIR,
+                        stale_ttl_seconds=AI_CACHE_STALE_TTL_SECONDS)
+    if AI_CACHE_ENABLED else None
+)
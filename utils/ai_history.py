@@ -0,0 +1,217 @@
+# utils/ai_history.py
+import json
+import logging
+import os
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from utils.ai_schema import RECOMMENDATION_TYPES
+
+# Бюджет (в токенах) на history + previously_shown_ids в промпте. 0 - без ограничения.
+AI_HISTORY_TOKEN_BUDGET = int(os.getenv("AI_HISTORY_TOKEN_BUDGET", "400"))
+# Сколько последних ID из каждого списка сохраняется в промпте при любом бюджете
+AI_HISTORY_MIN_RECENT_IDS = int(os.getenv("AI_HISTORY_MIN_RECENT_IDS", "5"))
+# Сколько последних показанных рекомендаций помнить для извлечения признаков (кухня и т.п.)
+AI_HISTORY_INDEX_SIZE = int(os.getenv("AI_HISTORY_INDEX_SIZE", "5000"))
+
+# Порядок урезания: сначала лайки (их суть сохраняется в сводке предпочтений), затем показанные
+# (повторы все равно отфильтрует хэндлер), дизлайки - последними: это жесткие ограничения для модели.
+_TRIM_ORDER = ("liked", "shown", "disliked")
+# Для лайков и дизлайков - список с противоположным фидбеком (для оценки информативности ID)
+_OPPOSITE = {"liked": "disliked", "disliked": "liked"}
+
+
+def estimate_tokens(value: Any) -> int:
+    """Та же грубая оценка, что и для TPM-лимита: ~4 символа JSON на токен."""
+    return len(json.dumps(value, ensure_ascii=False)) // 4
+
+
+class RecommendationIndex:
+    """
+    Ограниченный LRU-индекс недавно сгенерированных рекомендаций: id -> краткие признаки.
+    Нужен, чтобы свернуть старые лайки в сигналы вроде "любит итальянскую кухню":
+    сам ID несет только тип (по префиксу), а кухня есть лишь в полном ответе модели.
+    """
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def remember(self, recommendations: Iterable[Any]) -> None:
+        for rec in recommendations or []:
+            if not isinstance(rec, dict) or not isinstance(rec.get("id"), str):
+                continue
+            details = rec.get("details") if isinstance(rec.get("details"), dict) else {}
+            cuisines = details.get("cuisine_type")
+            self._entries[rec["id"]] = {
+                "type": rec.get("type") if isinstance(rec.get("type"), str) else None,
+                "cuisines": [c for c in cuisines if isinstance(c, str)] if isinstance(cuisines, list) else [],
+            }
+            self._entries.move_to_end(rec["id"])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, rec_id: str) -> Optional[Dict[str, Any]]:
+        return self._entries.get(rec_id)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+recommendation_index = RecommendationIndex(max_entries=AI_HISTORY_INDEX_SIZE)
+
+history_stats: Dict[str, int] = {"requests": 0, "compacted": 0, "tokens_before": 0, "tokens_after": 0,
+                                  "tokens_saved": 0, "ids_summarized": 0}
+
+
+def _type_of(rec_id: str) -> Optional[str]:
+    indexed = recommendation_index.get(rec_id)
+    if indexed and indexed.get("type"):
+        return indexed["type"]
+    prefix = rec_id.split("_", 1)[0]  # ID вида "hotel_le_bristol_paris_01"
+    return prefix if prefix in RECOMMENDATION_TYPES else None
+
+
+def _features(rec_id: str) -> Set[str]:
+    rec_type = _type_of(rec_id)
+    features = {f"type:{rec_type}"} if rec_type else set()
+    indexed = recommendation_index.get(rec_id)
+    if indexed:
+        features.update(f"cuisine:{name}" for name in indexed.get("cuisines") or [])
+    return features
+
+
+def _drop_order(ids: List[str], keep_recent: int, opposite_ids: Optional[List[str]]) -> List[int]:
+    """
+    Индексы ID, которые можно отбросить (все, кроме keep_recent последних), от наименее информативных.
+    Показанные ID (opposite_ids=None) отбрасываются просто от старых к новым. Для лайков и дизлайков
+    информативность = насколько ID противоречит противоположному списку (дизлайк ресторана у того,
+    кто в основном лайкает рестораны) + редкость его типа/кухни в своем списке: такие ID сводка
+    "preference_summary" не передаст, а типичные она описывает и так. При равной оценке первыми
+    отбрасываются более старые.
+    """
+    droppable = range(len(ids) - keep_recent)
+    if opposite_ids is None:
+        return list(droppable)
+    features = [_features(rec_id) for rec_id in ids]
+    own_counts = Counter(feature for rec_features in features for feature in rec_features)
+    opposite_counts = Counter(feature for rec_id in opposite_ids for feature in _features(rec_id))
+    opposite_total = max(len(opposite_ids), 1)
+
+    def informativeness(index: int) -> float:
+        rec_features = features[index]
+        contradiction = max((opposite_counts[f] / opposite_total for f in rec_features), default=0.0)
+        rarity = max((1.0 / own_counts[f] for f in rec_features), default=0.0)
+        return contradiction + rarity
+
+    return sorted(droppable, key=lambda index: (informativeness(index), index))
+
+
+def _summarize(ids: List[str]) -> Tuple[Dict[str, int], List[str]]:
+    types: Counter = Counter()
+    cuisines: Counter = Counter()
+    for rec_id in ids:
+        rec_type = _type_of(rec_id)
+        if rec_type:
+            types[rec_type] += 1
+        indexed = recommendation_index.get(rec_id)
+        if indexed:
+            cuisines.update(indexed.get("cuisines") or [])
+    return dict(types.most_common()), [name for name, _ in cuisines.most_common(5)]
+
+
+def _build_history(liked: List[str], disliked: List[str], summarized_liked: List[str],
+                   summarized_disliked: List[str]) -> List[Dict[str, Any]]:
+    history: List[Dict[str, Any]] = []
+    if liked:
+        history.append({"type": "user_feedback_positive", "item_ids": liked})
+    if disliked:
+        history.append({"type": "user_feedback_negative", "item_ids": disliked})
+    if summarized_liked or summarized_disliked:
+        summary: Dict[str, Any] = {"type": "preference_summary"}
+        if summarized_liked:
+            liked_types, liked_cuisines = _summarize(summarized_liked)
+            summary["older_likes_count"] = len(summarized_liked)
+            summary["liked_types"] = liked_types
+            if liked_cuisines:
+                summary["liked_cuisines"] = liked_cuisines
+        if summarized_disliked:
+            disliked_types, disliked_cuisines = _summarize(summarized_disliked)
+            summary["older_dislikes_count"] = len(summarized_disliked)
+            summary["disliked_types"] = disliked_types
+            if disliked_cuisines:
+                summary["disliked_cuisines"] = disliked_cuisines
+        history.append(summary)
+    return history
+
+
+def compact_history(liked_ids: List[str], disliked_ids: List[str], shown_ids: List[str],
+                    token_budget: Optional[int] = None,
+                    min_recent: Optional[int] = None) -> Tuple[List[Dict[str, Any]], List[str], Dict[str, int]]:
+    """
+    Укладывает историю фидбека и список показанных ID в бюджет токенов.
+    Списки упорядочены от старых к новым; при превышении бюджета из них отбрасываются ID
+    (в порядке _TRIM_ORDER, но не меньше min_recent последних в каждом списке): из показанных -
+    самые старые, из лайков и дизлайков - наименее информативные (см. _drop_order). Отброшенные
+    лайки и дизлайки сворачиваются в запись "preference_summary" с типами и кухнями, оставшиеся
+    ID идут в промпт в исходном порядке. Возвращает (history, previously_shown_ids, отчет о сжатии).
+    """
+    token_budget = AI_HISTORY_TOKEN_BUDGET if token_budget is None else token_budget
+    min_recent = AI_HISTORY_MIN_RECENT_IDS if min_recent is None else min_recent
+    lists: Dict[str, List[str]] = {
+        "liked": list(dict.fromkeys(liked_ids)),  # Дубликаты убираем, порядок сохраняем
+        "disliked": list(dict.fromkeys(disliked_ids)),
+        "shown": list(dict.fromkeys(shown_ids)),
+    }
+    full_history = _build_history(lists["liked"], lists["disliked"], [], [])
+    tokens_before = estimate_tokens(full_history) + estimate_tokens(lists["shown"])
+    history_stats["requests"] += 1
+    report = {"tokens_before": tokens_before, "tokens_after": tokens_before, "tokens_saved": 0, "ids_dropped": 0}
+    if token_budget <= 0 or tokens_before <= token_budget:
+        return full_history, lists["shown"], report
+
+    # Стоимость каждого ID в символах: сам ID в кавычках и разделитель ", "
+    costs = {key: [len(json.dumps(rec_id, ensure_ascii=False)) + 2 for rec_id in ids] for key, ids in lists.items()}
+    drop_order = {key: _drop_order(ids, min(min_recent, len(ids)),
+                                   lists[_OPPOSITE[key]] if key in _OPPOSITE else None)
+                  for key, ids in lists.items()}
+    cut = {key: 0 for key in lists}  # Сколько ID отброшено из начала drop_order каждого списка
+    split: Dict[str, Tuple[List[str], List[str]]] = {}
+    tokens_after = tokens_before
+    while tokens_after > token_budget:
+        # Сводка предпочтений сама занимает место, поэтому после каждого прохода бюджет перепроверяется
+        excess_chars = (tokens_after - token_budget) * 4
+        trimmed = False
+        for key in _TRIM_ORDER:
+            while excess_chars > 0 and cut[key] < len(drop_order[key]):
+                excess_chars -= costs[key][drop_order[key][cut[key]]]
+                cut[key] += 1
+                trimmed = True
+        for key, ids in lists.items():  # (оставленные, отброшенные) - оба в хронологическом порядке
+            dropped = set(drop_order[key][:cut[key]])
+            split[key] = ([rec_id for i, rec_id in enumerate(ids) if i not in dropped],
+                          [rec_id for i, rec_id in enumerate(ids) if i in dropped])
+        history = _build_history(split["liked"][0], split["disliked"][0], split["liked"][1], split["disliked"][1])
+        shown = split["shown"][0]
+        tokens_after = estimate_tokens(history) + estimate_tokens(shown)
+        if not trimmed:
+            break  # Дальше урезать нельзя: остались только min_recent последних ID
+
+    report = {
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": max(tokens_before - tokens_after, 0),
+        "ids_dropped": sum(cut.values()),
+    }
+    history_stats["compacted"] += 1
+    history_stats["tokens_before"] += tokens_before
+    history_stats["tokens_after"] += tokens_after
+    history_stats["tokens_saved"] += report["tokens_saved"]
+    history_stats["ids_summarized"] += cut["liked"] + cut["disliked"]
+    logging.info(f"AI History: История сжата с ~{tokens_before} до ~{tokens_after} токенов "
+                 f"(отброшено ID: лайки {cut['liked']}, дизлайки {cut['disliked']}, показанные {cut['shown']}).")
+    return history, shown, report
+
+
+def get_history_stats() -> Dict[str, int]:
+    return {**history_stats, "indexed_recommendations": len(recommendation_index)}
@@ -1,8 +1,30 @@
+import asyncio
 import json
 import logging
 import os
+import time
 import google.generativeai as genai
-from typing import Tuple, Dict, Any, List, Optional
+from google.api_core import exceptions as google_exceptions
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Tuple, Dict, Any, List, Optional, AsyncIterator
+
+from utils.ai_cache import recommendation_cache, make_cache_key
+from utils.single_flight import SingleFlight
+from utils.json_stream import RecommendationStreamParser
+from utils.ai_json import decode_model_json, ModelJSONError
+from utils.ai_schema import RECOMMENDATIONS_RESPONSE_SCHEMA
+from utils.ai_history import compact_history, recommendation_index
+from utils import recommendation_catalog
+from utils.recommendation_catalog import AI_CATALOG_ENABLED, AI_CATALOG_TARGET_COUNT
+from utils.localization import get_text
+from utils.logging_setup import LogPayload
+from utils.metrics import ai_prompt_chars, ai_request_duration, ai_response_chars, ai_response_failures
+from utils.ai_scheduler import (ai_scheduler, AIQueueFullError, QueuePositionCallback,
+                                PRIORITY_INITIAL, PRIORITY_MORE_OPTIONS)
+from utils.ai_resilience import (ai_circuit_breaker, ai_hedged_caller, ai_latency, current_hedge_delay,
+                                 AI_REQUEST_DEADLINE_SECONDS)
+from utils.ai_routing import (ModelRouter, load_routes, AI_ROUTE_MAX_ERROR_RATE, AI_ROUTE_MIN_SAMPLES,
+                              AI_ROUTE_RETRY_SECONDS, AI_ROUTE_EWMA_ALPHA)
 
 # Настройка логирования должна быть в main.py (глобально, до импортов)
 
@@ -18,6 +40,28 @@ if GEMINI_API_KEY:
 else:
     logging.warning("AI Integration: GEMINI_API_KEY не найден в переменных окружения. API Gemini не будет работать.")
 
+# Потоковая выдача рекомендаций в чат по мере генерации (включается явно).
+# Карточки при этом идут в порядке ответа AI: локальное ранжирование (utils.ranking) работает только без потока.
+AI_STREAMING_ENABLED = os.getenv("AI_STREAMING_ENABLED", "0").lower() in ("1", "true", "yes")
+
+# Структурированный вывод: форма JSON задается схемой (response_schema), а не описанием в промпте.
+# Если модель/SDK его не поддерживают, при первом отказе выполняется откат на текстовый режим.
+AI_STRUCTURED_OUTPUT = os.getenv("AI_STRUCTURED_OUTPUT", "0").lower() in ("1", "true", "yes")
+
+# Ожидаемый размер ответа в токенах - для оценки TPM в планировщике
+AI_EXPECTED_OUTPUT_TOKENS = int(os.getenv("AI_EXPECTED_OUTPUT_TOKENS", "2000"))
+
+_REQUEST_PRIORITIES: Dict[str, int] = {
+    "initial": PRIORITY_INITIAL,
+    "more_options": PRIORITY_MORE_OPTIONS,
+}
+
+AI_OVERLOADED_ERROR_TEXT = "Сервис AI сейчас перегружен: очередь запросов заполнена. Попробуйте чуть позже."
+AI_UNAVAILABLE_ERROR_TEXT = "Сервис AI временно недоступен. Попробуйте чуть позже."
+
+# Общий для процесса реестр выполняющихся запросов к Gemini (по ключу подготовленных данных)
+ai_single_flight = SingleFlight(name="AI Integration single-flight")
+
 
 def _prepare_user_data_for_prompt(user_data_raw: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -78,40 +122,163 @@ def _prepare_user_data_for_prompt(user_data_raw: Dict[str, Any]) -> Dict[str, An
         prepared_data['previously_shown_ids'] = []
     # --- Конец нового/уточненного ---
 
-    history_for_ai = []
+    string_liked_ids: List[str] = []
     liked_ids = user_data_raw.get('liked_recommendation_ids', [])
     if liked_ids and isinstance(liked_ids, list):
         # Убедимся, что ID в истории это строки
         string_liked_ids = [str(item_id) for item_id in liked_ids if isinstance(item_id, (str, int))]
-        if string_liked_ids:
-            history_for_ai.append({"type": "user_feedback_positive", "item_ids": string_liked_ids})
 
+    string_disliked_ids: List[str] = []
     disliked_ids = user_data_raw.get('disliked_recommendation_ids', [])
     if disliked_ids and isinstance(disliked_ids, list):
         string_disliked_ids = [str(item_id) for item_id in disliked_ids if isinstance(item_id, (str, int))]
-        if string_disliked_ids:
-            history_for_ai.append({"type": "user_feedback_negative", "item_ids": string_disliked_ids})
 
-    prepared_data['history'] = history_for_ai
+    # Длинная история укладывается в бюджет токенов: старые лайки/дизлайки сворачиваются в сводку предпочтений
+    prepared_data['history'], prepared_data['previously_shown_ids'], _compaction = compact_history(
+        string_liked_ids, string_disliked_ids, prepared_data['previously_shown_ids'])
 
-    # Используем json.dumps для отладки, чтобы видеть строки как есть, без одинарных кавычек Python
-    logging.debug(
-        f"AI Integration: Подготовленные данные для промпта: {json.dumps(prepared_data, ensure_ascii=False, indent=2)}")
+    # LogPayload сериализует в JSON (строки как есть, без одинарных кавычек Python) только если DEBUG включен
+    logging.debug("AI Integration: Подготовленные данные для промпта: %s", LogPayload(prepared_data))
     return prepared_data
 
 
 async def get_travel_recommendations(
-        user_data_raw: Dict[str, Any]
+        user_data_raw: Dict[str, Any],
+        on_queued: Optional[QueuePositionCallback] = None,
+        priority: Optional[int] = None,
+        session: Optional[AsyncSession] = None
 ) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Возвращает (structured_recommendations, textual_summary) или (None, текст ошибки).
+    on_queued(позиция) вызывается, если запрос встал в глубокую очередь к AI.
+    priority переопределяет приоритет в планировщике (по умолчанию - по request_type).
+    С session сначала используется каталог рекомендаций в БД: при полном наборе AI не вызывается,
+    при частичном - у AI запрашивается только недостающее.
+    """
     if not GEMINI_API_KEY:
         logging.error("AI Integration: API ключ для Gemini не настроен или невалиден.")
         return None, "Ошибка конфигурации: API ключ для AI не найден или не работает. Проверьте настройки."
 
-    logging.info(
-        f"AI Integration: Получены сырые данные от пользователя для get_travel_recommendations: {user_data_raw}")
+    logging.info("AI Integration: Получены сырые данные от пользователя для get_travel_recommendations: %s",
+                 LogPayload(user_data_raw))
     prepared = _prepare_user_data_for_prompt(user_data_raw)
 
-    prompt_template = f"""<role>
+    location_key, catalog_items, prepared = await _consult_catalog(session, user_data_raw, prepared)
+    if len(catalog_items) >= AI_CATALOG_TARGET_COUNT:
+        return _catalog_response(prepared, catalog_items)
+
+    # Ключ строится по подготовленным данным целиком (включая history и previously_shown_ids).
+    # При сжатой истории самые старые ID в ключ не входят - их повторы отфильтровывает хэндлер.
+    request_key = make_cache_key(prepared)
+    structured, summary = None, None
+    if recommendation_cache:
+        cached = await recommendation_cache.get(request_key)
+        if cached is not None:
+            logging.info("AI Integration: Ответ взят из кэша (key=%.12s). Статистика кэша: %s",
+                         request_key, LogPayload(recommendation_cache.get_stats(), sample_rate=1.0))
+            structured, summary = cached["structured"], cached["summary"]
+
+    if structured is None:
+        # Одинаковые запросы, пришедшие пока первый еще выполняется, ждут его результат
+        structured, summary = await ai_single_flight.run(
+            request_key, lambda: _generate_and_cache(prepared, request_key, on_queued, priority))
+        if structured is not None and location_key:
+            await recommendation_catalog.store(session, location_key, prepared['user_language'],
+                                               prepared['user_preferences'].get('budget'),
+                                               structured.get("recommendations"))
+
+    if structured is not None and catalog_items:
+        structured = _merge_catalog_items(structured, catalog_items)
+    return structured, summary
+
+
+async def _consult_catalog(
+        session: Optional[AsyncSession],
+        user_data_raw: Dict[str, Any],
+        prepared: Dict[str, Any]
+) -> Tuple[Optional[str], List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Ищет в каталоге свежие рекомендации для места назначения, которые пользователь еще не видел и не дизлайкал.
+    Возвращает (ключ места или None, найденные рекомендации, подготовленные данные). Если рекомендаций
+    меньше полного набора, в данные для промпта добавляются их ID и число недостающих (requested_count).
+    """
+    if session is None or not AI_CATALOG_ENABLED:
+        return None, [], prepared
+    location_key = recommendation_catalog.make_location_key(user_data_raw)
+    if not location_key:
+        return None, [], prepared
+
+    excluded_ids = set(str(i) for i in user_data_raw.get('current_session_shown_ids') or [])
+    excluded_ids.update(str(i) for i in user_data_raw.get('disliked_recommendation_ids') or [])
+    catalog_items = await recommendation_catalog.lookup(
+        session, location_key, prepared['user_language'], prepared['user_preferences'].get('budget'),
+        excluded_ids, limit=AI_CATALOG_TARGET_COUNT)
+    if catalog_items and len(catalog_items) < AI_CATALOG_TARGET_COUNT:
+        logging.info("AI Integration: В каталоге %d рекомендаций для '%s', у AI запрашиваем недостающие %d.",
+                     len(catalog_items), location_key, AI_CATALOG_TARGET_COUNT - len(catalog_items))
+        prepared = {
+            **prepared,
+            'catalog_item_ids': [item.get("id") for item in catalog_items],
+            'requested_count': AI_CATALOG_TARGET_COUNT - len(catalog_items),
+        }
+    return location_key, catalog_items, prepared
+
+
+def _catalog_response(prepared: Dict[str, Any],
+                      catalog_items: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], str]:
+    """Ответ целиком из каталога - в том же формате, что и ответ AI."""
+    logging.info("AI Integration: Запрос обслужен из каталога (%d рекомендаций), AI не вызывается.",
+                 len(catalog_items))
+    structured = {
+        "query_summary": {
+            "location_interpreted": prepared['user_location'],
+            "trip_days": None,
+            "main_interests": prepared['user_preferences'].get('interests', []),
+        },
+        "recommendations": catalog_items,
+    }
+    summary = get_text("catalog_summary_text", prepared['user_language'], location=prepared['user_location'])
+    return structured, summary
+
+
+def _merge_catalog_items(structured: Dict[str, Any], catalog_items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Добавляет к ответу AI рекомендации из каталога (они идут первыми, дубликаты по id убираются)."""
+    catalog_ids = {item.get("id") for item in catalog_items}
+    ai_items = [rec for rec in structured.get("recommendations") or []
+                if not (isinstance(rec, dict) and rec.get("id") in catalog_ids)]
+    return {**structured, "recommendations": catalog_items + ai_items}
+
+
+async def _generate_and_cache(
+        prepared: Dict[str, Any],
+        request_key: str,
+        on_queued: Optional[QueuePositionCallback] = None,
+        priority: Optional[int] = None
+) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    if not ai_circuit_breaker.allow():
+        # Upstream нездоров: не ждем заведомо неудачный запрос, а отвечаем из устаревшего кэша, если есть
+        if recommendation_cache:
+            stale = await recommendation_cache.get(request_key, allow_stale=True)
+            if stale is not None:
+                logging.warning("AI Integration: Предохранитель разомкнут, отдаем устаревший ответ из кэша.")
+                return stale["structured"], stale["summary"]
+        logging.warning("AI Integration: Предохранитель разомкнут, запрос к Gemini не отправляется.")
+        return None, AI_UNAVAILABLE_ERROR_TEXT
+
+    structured, summary = await _request_recommendations_from_gemini(prepared, on_queued, priority)
+    if structured is not None:
+        recommendation_index.remember(structured.get("recommendations"))
+
+    # Кэшируем только успешные ответы: ошибки должны перезапрашиваться
+    if recommendation_cache and structured is not None:
+        await recommendation_cache.set(request_key, {"structured": structured, "summary": summary})
+    return structured, summary
+
+
+# Статическая часть промпта (роль, правила, спецификация JSON и пример) не зависит от пользователя.
+# Она собирается один раз при импорте и передается модели как system_instruction,
+# а в каждом запросе отправляется только блок входных данных (см. _build_prompt).
+_PROMPT_HEADER = """<role>
 Ты — «Travel Bot», высококлассный AI-ассистент для путешественников. Твоя главная цель — предоставлять персонализированные, полезные и вдохновляющие рекомендации. 
 Ты должен строго следовать инструкциям по формату ответа и содержанию.
 </role>
@@ -121,13 +288,12 @@ async def get_travel_recommendations(
 </task>
 
 ## ОБЯЗАТЕЛЬНЫЕ ИНСТРУКЦИИ ДЛЯ ТЕБЯ, AI:
-1.  **ФОРМАТ ОТВЕТА**: Твой ответ ДОЛЖЕН БЫТЬ ТОЛЬКО ОДНИМ JSON объектом. Никакого текста до или после этого JSON. Никакой Markdown разметки (типа ```json ... ```) вокруг JSON.
-2.  **ЯЗЫК ОТВЕТА**: АБСОЛЮТНО ВЕСЬ текст в твоем ответе (все строковые значения в JSON и текст в `textual_summary`) ДОЛЖЕН БЫТЬ СТРОГО на языке, указанном в поле `user_language` во Входных данных. Это КРИТИЧЕСКИ ВАЖНО.
-3.  **СТРУКТУРА JSON**: JSON объект должен иметь ДВА ключа на верхнем уровне:
-    *   `"structured_recommendations"`: JSON объект, содержащий `query_summary` и список `recommendations`.
-    *   `"textual_summary"`: Строка с дружелюбным и полезным сопроводительным текстом для пользователя (2-4 абзаца) на языке `user_language`, кратко суммирующим предложенный план.
-4.  **ЭКРАНИРОВАНИЕ В JSON**: Если внутри строковых значений JSON (например, в полях "name", "description", "address") встречаются символы кавычек ("), ты ОБЯЗАН экранировать их как \\". Например: "name": "Отель \\"Цитадель\\"" - правильно. "name": "Отель "Цитадель"" - НЕПРАВИЛЬНО.
-5.  **КАЧЕСТВО И РАЗНООБРАЗИЕ РЕКОМЕНДАЦИЙ**:
+"""
+
+_PROMPT_LANGUAGE_RULE = """2.  **ЯЗЫК ОТВЕТА**: АБСОЛЮТНО ВЕСЬ текст в твоем ответе (все строковые значения в JSON и текст в `textual_summary`) ДОЛЖЕН БЫТЬ СТРОГО на языке, указанном в поле `user_language` во Входных данных. Это КРИТИЧЕСКИ ВАЖНО.
+"""
+
+_PROMPT_CONTENT_RULES = """5.  **КАЧЕСТВО И РАЗНООБРАЗИЕ РЕКОМЕНДАЦИЙ**:
     *   Предлагай РАЗНООБРАЗНЫЕ, ИНТЕРЕСНЫЕ и РЕЛЕВАНТНЫЕ варианты, соответствующие `user_preferences`.
     *   Если по какому-то критерию качественных вариантов мало (например, низкий бюджет в дорогом городе), лучше предложи меньше (или даже ни одного для этой категории), но честно укажи на это в `textual_summary` и, возможно, предложи более широкие альтернативы.
     *   Старайся предлагать 1-2 варианта для отелей, 1-2 для ресторанов, и 2-3 для достопримечательностей/маршрутов/активностей, если это возможно и соответствует запросу.
@@ -137,6 +303,7 @@ async def get_travel_recommendations(
 7.  **УЧЕТ ИСТОРИИ ПОЛЬЗОВАТЕЛЯ (`history`)**:
     *   Если в `history` есть записи с `type: "user_feedback_negative"`, **КАТЕГОРИЧЕСКИ ИЗБЕГАЙ** предложений рекомендаций с `id` из списка `item_ids` этого фидбека.
     *   Если в `history` есть записи с `type: "user_feedback_positive"`, рассматривай `item_ids` как примеры того, что нравится пользователю. Постарайся предложить НОВЫЕ, но ПОХОЖИЕ по духу/типу/ценовой категории рекомендации. **Не предлагай те же самые ID повторно, если только нет других подходящих вариантов.**
+    *   Запись с `type: "preference_summary"` - сводка более старого фидбека: `liked_types`/`disliked_types` (сколько раз понравились/не понравились рекомендации каждого типа) и `liked_cuisines`/`disliked_cuisines`. Учитывай ее как сигналы предпочтений наравне с `item_ids`.
 8.  **ОБРАБОТКА ТИПА ЗАПРОСА (`request_type` и `previously_shown_ids`):**
     *   Если `request_type` равен `"initial"`, генерируй первоначальный набор рекомендаций.
     *   Если `request_type` равен `"more_options"`, это запрос на ДОПОЛНИТЕЛЬНЫЕ рекомендации. В этом случае:
@@ -145,18 +312,21 @@ async def get_travel_recommendations(
         *   Старайся предложить НОВЫЕ варианты, которые дополняют или расширяют предыдущие предложения, но соответствуют интересам и предпочтениям пользователя.
         *   Учитывай `history` (лайки/дизлайки) как обычно.
     *   Если `previously_shown_ids` пуст, даже при `request_type: "more_options"`, веди себя как при `initial`.
+    *   Если во входных данных есть `catalog_item_ids` и `requested_count`, эти рекомендации у пользователя уже есть: НЕ повторяй их `id` и верни НЕ БОЛЬШЕ `requested_count` новых рекомендаций, дополняющих их по типам.
 
-### Входные данные от пользователя (АНАЛИЗИРУЙ ИХ ВНИМАТЕЛЬНО)
-user_location: "{prepared['user_location']}"
-user_preferences: {json.dumps(prepared['user_preferences'], ensure_ascii=False)}
-trip_duration_text: "{prepared['trip_duration_text']}"
-transport_preferences: {json.dumps(prepared['transport_preferences'], ensure_ascii=False)}
-history: {json.dumps(prepared['history'], ensure_ascii=False)} 
-user_language: "{prepared['user_language']}"
-request_type: "{prepared['request_type']}"
-previously_shown_ids: {json.dumps(prepared['previously_shown_ids'], ensure_ascii=False)}
+"""
 
-### ДЕТАЛЬНАЯ СПЕЦИФИКАЦИЯ для JSON объекта в "structured_recommendations"
+# Правила формата для обычного (текстового) режима: форма JSON описана словами
+_PROMPT_TEXT_FORMAT_RULE = """1.  **ФОРМАТ ОТВЕТА**: Твой ответ ДОЛЖЕН БЫТЬ ТОЛЬКО ОДНИМ JSON объектом. Никакого текста до или после этого JSON. Никакой Markdown разметки (типа ```json ... ```) вокруг JSON.
+"""
+
+_PROMPT_TEXT_STRUCTURE_RULES = """3.  **СТРУКТУРА JSON**: JSON объект должен иметь ДВА ключа на верхнем уровне:
+    *   `"structured_recommendations"`: JSON объект, содержащий `query_summary` и список `recommendations`.
+    *   `"textual_summary"`: Строка с дружелюбным и полезным сопроводительным текстом для пользователя (2-4 абзаца) на языке `user_language`, кратко суммирующим предложенный план.
+4.  **ЭКРАНИРОВАНИЕ В JSON**: Если внутри строковых значений JSON (например, в полях "name", "description", "address") встречаются символы кавычек ("), ты ОБЯЗАН экранировать их как \\". Например: "name": "Отель \\"Цитадель\\"" - правильно. "name": "Отель "Цитадель"" - НЕПРАВИЛЬНО.
+"""
+
+_PROMPT_TEXT_JSON_SPEC = """### ДЕТАЛЬНАЯ СПЕЦИФИКАЦИЯ для JSON объекта в "structured_recommendations"
 #### 1. Поле `query_summary` (JSON объект):
 - `"location_interpreted"`: Строка. Город/регион, который ты определил (на языке `user_language`).
 - `"trip_days"`: Строка. Примерное количество дней (например, "3 дня") или JSON `null`.
@@ -170,12 +340,12 @@ previously_shown_ids: {json.dumps(prepared['previously_shown_ids'], ensure_ascii
 - `"address"`: Строка. Адрес (на языке `user_language`) или JSON `null`.
 - `"coordinates"`: **Список из ДВУХ ЧИСЕЛ** [широта, долгота] (например, [48.8584, 2.2945]) ИЛИ JSON `null`. **КАТЕГОРИЧЕСКИ НЕ ИСПОЛЬЗУЙ строки "null" или списки типа `["null"]`**.
 - `"description"`: Строка. Краткое (2-4 предложения), но привлекательное описание (на языке `user_language`).
-- `"details"`: JSON объект. Дополнительная информация. Если деталей нет, используй пустой объект `{{}}`.
-    - Для `"type": "route"`: `{{ "route_type": "<пеший/автомобильный/велосипедный>", "stops": [{{ "name": "<Название Остановки>", "coordinates": [48.8600, 2.3350], "description": "<Краткое описание остановки>" }}] }}` (в `stops` может быть несколько объектов).
-    - Для `"type": "hotel"`: `{{ "stars": <число от 1 до 5 ИЛИ null>, "amenities": ["<Удобство 1>", "<Удобство 2>"] }}` (список строк).
-    - Для `"type": "restaurant"`: `{{ "cuisine_type": ["<Тип кухни 1>", "<Тип кухни 2>"], "average_bill": "<Примерный средний счет, например '20-40 EUR'>" }}`.
-    - Для `"type": "event"`: `{{ "event_dates": ["<YYYY-MM-DD>"], "ticket_info": "<Информация о билетах, например 'От 25 EUR'>" }}`.
-    - Для `"type": "museum"` или `"type": "activity"`: `{{ "ticket_info": "<Информация о билетах или 'Бесплатно'>" }}` (если платно).
+- `"details"`: JSON объект. Дополнительная информация. Если деталей нет, используй пустой объект `{}`.
+    - Для `"type": "route"`: `{ "route_type": "<пеший/автомобильный/велосипедный>", "stops": [{ "name": "<Название Остановки>", "coordinates": [48.8600, 2.3350], "description": "<Краткое описание остановки>" }] }` (в `stops` может быть несколько объектов).
+    - Для `"type": "hotel"`: `{ "stars": <число от 1 до 5 ИЛИ null>, "amenities": ["<Удобство 1>", "<Удобство 2>"] }` (список строк).
+    - Для `"type": "restaurant"`: `{ "cuisine_type": ["<Тип кухни 1>", "<Тип кухни 2>"], "average_bill": "<Примерный средний счет, например '20-40 EUR'>" }`.
+    - Для `"type": "event"`: `{ "event_dates": ["<YYYY-MM-DD>"], "ticket_info": "<Информация о билетах, например 'От 25 EUR'>" }`.
+    - Для `"type": "museum"` или `"type": "activity"`: `{ "ticket_info": "<Информация о билетах или 'Бесплатно'>" }` (если платно).
 - `"distance_or_time"`: Строка (например, "500 м от центра", "Около 3 часов") или JSON `null`.
 - `"price_estimate"`: Строка (например, "Бесплатно", "20-30 EUR с человека") или JSON `null`.
 - `"rating"`: Число от 1.0 до 5.0 (например, 4.7) или JSON `null`.
@@ -184,146 +354,559 @@ previously_shown_ids: {json.dumps(prepared['previously_shown_ids'], ensure_ascii
 - `"images"`: **Список URL картинок (строки). Предпочтительны ссылки на Wikimedia Commons или официальные сайты. Если РЕАЛЬНЫХ и РАБОЧИХ ссылок нет, верни ПУСТОЙ СПИСОК `[]`. НЕ ИСПОЛЬЗУЙ строки "null", ["null"] или недействительные URL.**
 
 ### Пример твоего ИДЕАЛЬНОГО ответа (ТОЛЬКО этот JSON, строго на языке `user_language` (пример ниже на русском для наглядности структуры)):
-{{
-  "structured_recommendations": {{
-    "query_summary": {{
+{
+  "structured_recommendations": {
+    "query_summary": {
       "location_interpreted": "Париж, Франция", 
       "trip_days": "2 дня",
       "main_interests": ["искусство", "гастрономия"]
-    }},
+    },
     "recommendations": [
-      {{
+      {
         "id": "hotel_le_bristol_paris_01",
         "type": "hotel",
         "name": "Отель Le Bristol Paris",
         "address": "112 Rue du Faubourg Saint-Honoré, 75008 Париж, Франция",
         "coordinates": [48.8725, 2.3153],
         "description": "Один из самых престижных дворцовых отелей Парижа, известный своим исключительным сервисом и изысканными интерьерами.",
-        "details": {{ "stars": 5, "amenities": ["Бассейн на крыше", "Спа-центр Epicure", "Три ресторана Мишлен"] }},
+        "details": { "stars": 5, "amenities": ["Бассейн на крыше", "Спа-центр Epicure", "Три ресторана Мишлен"] },
         "distance_or_time": "Рядом с Елисейскими Полями",
         "price_estimate": "От 1200 EUR/ночь",
         "rating": 4.9,
         "opening_hours": "Круглосуточно",
         "booking_link": "https://www.oetkercollection.com/hotels/le-bristol-paris/booking/",
         "images": ["https://upload.wikimedia.org/wikipedia/commons/thumb/a/a7/Le_Bristol_Paris_Exterior.jpg/800px-Le_Bristol_Paris_Exterior.jpg"]
-      }},
-      {{
+      },
+      {
         "id": "route_montmartre_discovery_02",
         "type": "route",
         "name": "Открытие Монмартра",
         "address": "Монмартр, Париж, Франция",
         "coordinates": [48.8867, 2.3431],
         "description": "Живописный пешеходный маршрут по богемному району Монмартр, включая базилику Сакре-Кёр и площадь Тертр.",
-        "details": {{ 
+        "details": { 
             "route_type": "пеший", 
             "stops": [
-                {{ "name": "Базилика Сакре-Кёр", "coordinates": [48.8867, 2.3431], "description": "Начните с потрясающего вида на город." }}, 
-                {{ "name": "Площадь Тертр", "coordinates": [48.8865, 2.3406], "description": "Площадь художников." }}
+                { "name": "Базилика Сакре-Кёр", "coordinates": [48.8867, 2.3431], "description": "Начните с потрясающего вида на город." }, 
+                { "name": "Площадь Тертр", "coordinates": [48.8865, 2.3406], "description": "Площадь художников." }
             ] 
-        }},
+        },
         "distance_or_time": "Около 2-3 часов",
         "price_estimate": "Бесплатно (кроме сувениров)",
         "rating": 4.7,
         "opening_hours": null,
         "booking_link": null,
         "images": [] 
-      }}
+      }
     ]
-  }},
+  },
   "textual_summary": "Для вашей поездки в Париж, предлагаю вам окунуться в роскошь отеля Le Bristol и исследовать очаровательные улочки Монмартра. Это сочетание элегантности и парижского шарма сделает ваше путешествие незабываемым. Рекомендую проверить часы работы достопримечательностей перед посещением."
-}}
+}
+"""
+
+_SYSTEM_INSTRUCTION = (_PROMPT_HEADER + _PROMPT_TEXT_FORMAT_RULE + _PROMPT_LANGUAGE_RULE + _PROMPT_TEXT_STRUCTURE_RULES
+                       + _PROMPT_CONTENT_RULES + _PROMPT_TEXT_JSON_SPEC)
+
+# Правила для режима структурированного вывода: форму JSON гарантирует схема (utils/ai_schema.py),
+# поэтому вместо спецификации и примера остается только то, что схемой не выразить
+_PROMPT_SCHEMA_FORMAT_RULE = """1.  **ФОРМАТ ОТВЕТА**: Ответ - один JSON объект строго по заданной схеме ответа. Схема задает форму JSON, ниже описан только смысл полей.
+"""
+
+_PROMPT_SCHEMA_FIELD_RULES = """3.  **СТРУКТУРА JSON**: `structured_recommendations` содержит `query_summary` (как ты понял запрос) и список `recommendations`. `textual_summary` - дружелюбный и полезный сопроводительный текст (2-4 абзаца) на языке `user_language`, кратко суммирующий предложенный план.
+4.  **ЗНАЧЕНИЯ ПОЛЕЙ**:
+    *   `id` - уникальный, только латиница, цифры и подчеркивания (например, "hotel_grand_paris_01").
+    *   `coordinates` - [широта, долгота] или null. `rating` - число от 1.0 до 5.0 или null. `description` - 2-4 предложения.
+    *   `booking_link` - URL на ОФИЦИАЛЬНЫЙ сайт или ИЗВЕСТНЫЙ агрегатор, иначе null. `images` - только РЕАЛЬНЫЕ рабочие URL картинок (предпочтительно Wikimedia Commons или официальные сайты), иначе пустой список. НЕ ВЫДУМЫВАЙ URL.
+    *   В `details` заполняй только поля, относящиеся к `type`: route - `route_type` и `stops`; hotel - `stars` и `amenities`; restaurant - `cuisine_type` и `average_bill`; event - `event_dates` (YYYY-MM-DD) и `ticket_info`; museum/activity - `ticket_info`.
+"""
+
+_STRUCTURED_SYSTEM_INSTRUCTION = (_PROMPT_HEADER + _PROMPT_SCHEMA_FORMAT_RULE + _PROMPT_LANGUAGE_RULE
+                                  + _PROMPT_SCHEMA_FIELD_RULES + _PROMPT_CONTENT_RULES)
+
+class GeminiModelRegistry:
+    """
+    Долгоживущий реестр объектов genai.GenerativeModel.
+    Модель создается один раз на пару (имя модели, назначение) и переиспользуется между запросами,
+    вместе с ее асинхронным транспортным клиентом, который genai создает при первом вызове.
+    Для каждого назначения (request_type) можно задать свой generation_config.
+    """
+
+    def __init__(self, default_model_name: str, system_instruction: str,
+                 generation_configs: Optional[Dict[str, Dict[str, Any]]] = None,
+                 common_generation_config: Optional[Dict[str, Any]] = None):
+        self.default_model_name = default_model_name
+        self.system_instruction = system_instruction
+        self.generation_configs: Dict[str, Dict[str, Any]] = dict(generation_configs or {})
+        # Общие для всех назначений настройки (например, схема ответа); настройки назначения их дополняют
+        self.common_generation_config: Dict[str, Any] = dict(common_generation_config or {})
+        self._models: Dict[Tuple[str, str], genai.GenerativeModel] = {}
+        self._usage: Dict[Tuple[str, str], int] = {}
+        self.stats: Dict[str, int] = {"created": 0, "reused": 0}
+
+    def configure_purpose(self, purpose: str, **generation_config: Any) -> None:
+        """Задает generation_config для назначения. Уже созданные модели этого назначения пересоздадутся."""
+        self.generation_configs[purpose] = generation_config
+        for key in [k for k in self._models if k[1] == purpose]:
+            del self._models[key]
+
+    def get(self, purpose: str = "default", model_name: Optional[str] = None) -> genai.GenerativeModel:
+        key = (model_name or self.default_model_name, purpose)
+        model = self._models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name=key[0],
+                system_instruction=self.system_instruction,
+                generation_config={**self.common_generation_config,
+                                   **(self.generation_configs.get(purpose) or {})} or None)
+            self._models[key] = model
+            self.stats["created"] += 1
+            logging.info(f"AI Integration: Создана модель Gemini '{key[0]}' для назначения '{purpose}'.")
+        else:
+            self.stats["reused"] += 1
+        self._usage[key] = self._usage.get(key, 0) + 1
+        return model
+
+    def warm_up(self, purposes: Optional[List[str]] = None) -> None:
+        """Заранее создает модели для перечисленных назначений (по умолчанию - для всех настроенных)."""
+        for purpose in purposes or list(self.generation_configs):
+            self.get(purpose)
+        # warm_up не считается реальным использованием модели
+        self._usage = {key: 0 for key in self._models}
+        self.stats["reused"] = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "pooled_models": len(self._models),
+            "usage": {f"{name}:{purpose}": count for (name, purpose), count in self._usage.items()},
+        }
+
+
+AI_MODEL_NAME = os.getenv("AI_MODEL_NAME", "gemini-1.5-flash-latest")  # Используем более новую модель, если доступна
+
+# Настройки генерации по назначению запроса (request_type). По умолчанию - настройки модели.
+# Переопределяются JSON-ом в AI_GENERATION_CONFIGS, например: {"more_options": {"temperature": 0.9}}
+AI_GENERATION_CONFIGS: Dict[str, Dict[str, Any]] = {"initial": {}, "more_options": {}}
+try:
+    AI_GENERATION_CONFIGS.update(json.loads(os.getenv("AI_GENERATION_CONFIGS", "{}")))
+except (json.JSONDecodeError, TypeError, ValueError) as e:
+    logging.error(f"AI Integration: Некорректный JSON в AI_GENERATION_CONFIGS: {e}. Используются настройки по умолчанию.")
+
+gemini_models = GeminiModelRegistry(AI_MODEL_NAME, _SYSTEM_INSTRUCTION, AI_GENERATION_CONFIGS)
+gemini_structured_models = GeminiModelRegistry(
+    AI_MODEL_NAME, _STRUCTURED_SYSTEM_INSTRUCTION, AI_GENERATION_CONFIGS,
+    common_generation_config={"response_mime_type": "application/json",
+                              "response_schema": RECOMMENDATIONS_RESPONSE_SCHEMA})
+
+# Выбор модели по назначению запроса: первичный план - основная модель, "еще варианты" - самая быстрая
+model_router = ModelRouter(load_routes(AI_MODEL_NAME), AI_MODEL_NAME, max_error_rate=AI_ROUTE_MAX_ERROR_RATE,
+                           min_samples=AI_ROUTE_MIN_SAMPLES, retry_seconds=AI_ROUTE_RETRY_SECONDS,
+                           alpha=AI_ROUTE_EWMA_ALPHA)
+
+# Сбрасывается при первом отказе модели/SDK от структурированного вывода и до перезапуска не включается
+_structured_output_supported = True
+
+
+def _structured_output_active() -> bool:
+    return AI_STRUCTURED_OUTPUT and _structured_output_supported
+
+
+def _disable_structured_output(error: Exception) -> None:
+    global _structured_output_supported
+    if _structured_output_supported:
+        logging.warning(f"AI Integration: Структурированный вывод не поддерживается ({type(error).__name__}: {error}). "
+                        f"Переключаемся на текстовый режим с описанием JSON в промпте.")
+    _structured_output_supported = False
+
+
+def _is_structured_output_rejection(error: Exception) -> bool:
+    """Отказ API от response_schema/response_mime_type (старая модель или версия API)."""
+    if isinstance(error, google_exceptions.InvalidArgument):
+        message = str(error).lower()
+        return "schema" in message or "mime" in message
+    return False
+
+
+def _create_model(purpose: str = "initial", model_name: Optional[str] = None) -> genai.GenerativeModel:
+    """
+    Возвращает модель Gemini из реестра (со статическими инструкциями в system_instruction).
+    В режиме AI_STRUCTURED_OUTPUT - модель со схемой ответа, если SDK ее принимает.
+    model_name - модель, выбранная маршрутизатором (по умолчанию AI_MODEL_NAME).
+    """
+    if _structured_output_active():
+        try:
+            return gemini_structured_models.get(purpose, model_name)
+        except (TypeError, ValueError, KeyError) as e:  # Старый SDK не знает response_schema
+            _disable_structured_output(e)
+    return gemini_models.get(purpose, model_name)
+
+
+def _active_system_instruction() -> str:
+    return _STRUCTURED_SYSTEM_INSTRUCTION if _structured_output_active() else _SYSTEM_INSTRUCTION
+
+
+def _build_prompt(prepared: Dict[str, Any]) -> str:
+    """Строит пользовательскую часть промпта: только входные данные конкретного запроса."""
+    prompt_template = f"""### Входные данные от пользователя (АНАЛИЗИРУЙ ИХ ВНИМАТЕЛЬНО)
+user_location: "{prepared['user_location']}"
+user_preferences: {json.dumps(prepared['user_preferences'], ensure_ascii=False)}
+trip_duration_text: "{prepared['trip_duration_text']}"
+transport_preferences: {json.dumps(prepared['transport_preferences'], ensure_ascii=False)}
+history: {json.dumps(prepared['history'], ensure_ascii=False)} 
+user_language: "{prepared['user_language']}"
+request_type: "{prepared['request_type']}"
+previously_shown_ids: {json.dumps(prepared['previously_shown_ids'], ensure_ascii=False)}
+"""
+    if prepared.get('requested_count'):
+        prompt_template += f"""catalog_item_ids: {json.dumps(prepared['catalog_item_ids'], ensure_ascii=False)}
+requested_count: {prepared['requested_count']}
 """
     # Раскомментируйте для детальной отладки самого промпта перед отправкой
     # logging.info(f"AI Integration DEBUG PROMPT:\n{prompt_template}")
+    return prompt_template
+
+
+def _extract_response_text(response: Any) -> str:
+    """Извлекает текст из ответа (или из чанка потокового ответа) Gemini. Пустая строка, если текста нет."""
+    ai_text = ''
+    # Улучшенная логика извлечения текста из ответа Gemini
+    try:
+        if hasattr(response, 'text') and response.text:
+            ai_text = response.text
+        elif hasattr(response,
+                     'parts') and response.parts:  # Для некоторых моделей ответ может быть в response.parts
+            ai_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
+        elif hasattr(response, 'candidates') and response.candidates and \
+                response.candidates[0].content and response.candidates[0].content.parts:
+            ai_text = "".join(p.text for p in response.candidates[0].content.parts if hasattr(p, 'text'))
+        else:  # Попытка извлечь из более глубокой структуры, если предыдущие не сработали
+            ai_text = response.candidates[0].content.parts[0].text
+    except (AttributeError, IndexError, TypeError, ValueError) as e_extract:
+        logging.warning("AI Integration: Не удалось стандартными способами извлечь текст из ответа Gemini. "
+                        "Ошибка: %s. Сырой ответ: %s", str(e_extract), LogPayload(response, sample_rate=1.0))
+        # Если ничего не извлеклось, ai_text останется пустым
+    return ai_text
+
+
+def _parse_ai_response_text(ai_text: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Разбирает JSON из текста ответа Gemini (с починкой типичных дефектов, см. utils.ai_json) и валидирует структуру.
+    Возвращает (structured_recommendations, textual_summary) или (None, текст ошибки).
+    """
+    logging.info("AI Integration: Текст от Gemini (ожидаем JSON): %s", LogPayload(ai_text))
 
     try:
-        model = genai.GenerativeModel(
-            model_name='gemini-1.5-flash-latest')  # Используем более новую модель, если доступна
-        logging.info("AI Integration: Отправка запроса к Gemini...")
+        data, repairs = decode_model_json(ai_text)
+    except ModelJSONError as e:
+        ai_response_failures.inc(reason="invalid_json")
+        logging.error("AI Integration: Ошибка декодирования JSON от Gemini: %s. "
+                      "Ответ Gemini, который не удалось распарсить:\n%s", str(e),
+                      LogPayload(ai_text, max_chars=1000, sample_rate=1.0))
+        return None, f"AI вернул некорректный JSON. (Ошибка: {e})"
+    if repairs:
+        logging.warning(f"AI Integration: JSON от Gemini разобран после починок: {', '.join(repairs)}.")
+
+    # Валидация основной структуры ответа
+    structured = data.get('structured_recommendations') if isinstance(data, dict) else None
+    summary = data.get('textual_summary') if isinstance(data, dict) else None
+
+    if not isinstance(structured, dict):
+        ai_response_failures.inc(reason="bad_structure")
+        logging.error("AI Integration: 'structured_recommendations' отсутствует или не словарь. Получено: %s. "
+                      "Ответ: %s", type(structured).__name__, LogPayload(data, sample_rate=1.0))
+        return None, "AI вернул 'structured_recommendations' в неожиданном формате."
+    if not isinstance(summary, str):
+        ai_response_failures.inc(reason="bad_structure")
+        logging.error("AI Integration: 'textual_summary' отсутствует или не строка. Получено: %s. Ответ: %s",
+                      type(summary).__name__, LogPayload(data, sample_rate=1.0))
+        return None, "AI вернул 'textual_summary' в неожиданном формате."
+
+    query_summary_val = structured.get("query_summary")
+    recommendations_list = structured.get("recommendations")
+
+    if not isinstance(query_summary_val, dict) or not isinstance(recommendations_list, list):
+        ai_response_failures.inc(reason="bad_structure")
+        logging.error("AI Integration: Неверная внутренняя структура 'structured_recommendations'. "
+                      "query_summary: %s, recommendations: %s. Ответ: %s", type(query_summary_val).__name__,
+                      type(recommendations_list).__name__, LogPayload(structured, sample_rate=1.0))
+        return None, "AI вернул 'structured_recommendations' с неверной внутренней структурой."
+
+    if not recommendations_list:  # Если список рекомендаций пуст
+        logging.info("AI Integration: Gemini вернул пустой список 'recommendations'.")
+        # Это не ошибка, а нормальный ответ, если AI ничего не нашел.
+        # structured и summary будут возвращены, хэндлер решит, что делать.
+
+    # Опциональная дополнительная валидация каждой рекомендации
+    for idx, rec_item in enumerate(recommendations_list):
+        if not isinstance(rec_item, dict):
+            logging.warning("AI Integration: Элемент #%d в 'recommendations' не является словарем: %s",
+                            idx, LogPayload(rec_item, sample_rate=1.0))
+            # Можно обработать: удалить элемент, вернуть ошибку и т.д.
+        else:
+            # Пример проверки обязательных полей
+            if not rec_item.get("id") or not rec_item.get("type") or not rec_item.get("name"):
+                logging.warning(
+                    f"AI Integration: Элемент #{idx} в 'recommendations' не содержит обязательных полей id/type/name: ID='{rec_item.get('id')}', Type='{rec_item.get('type')}', Name='{rec_item.get('name')}'")
 
-        response = await model.generate_content_async(prompt_template)
+    logging.info("AI Integration: Успешно получили и распарсили рекомендации от Gemini.")
+    return structured, summary
 
-        ai_text = ''
-        # Улучшенная логика извлечения текста из ответа Gemini
-        try:
-            if hasattr(response, 'text') and response.text:
-                ai_text = response.text
-            elif hasattr(response,
-                         'parts') and response.parts:  # Для некоторых моделей ответ может быть в response.parts
-                ai_text = "".join(part.text for part in response.parts if hasattr(part, 'text'))
-            elif hasattr(response, 'candidates') and response.candidates and \
-                    response.candidates[0].content and response.candidates[0].content.parts:
-                ai_text = "".join(p.text for p in response.candidates[0].content.parts if hasattr(p, 'text'))
-            else:  # Попытка извлечь из более глубокой структуры, если предыдущие не сработали
-                ai_text = response.candidates[0].content.parts[0].text
-        except (AttributeError, IndexError, TypeError) as e_extract:
-            logging.warning(
-                f"AI Integration: Не удалось стандартными способами извлечь текст из ответа Gemini. Ошибка: {e_extract}. Сырой ответ: {response}")
-            # Если ничего не извлеклось, ai_text останется пустым
 
-        if not ai_text:  # Проверка после всех попыток извлечения
-            logging.error(
-                f"AI Integration: Ответ Gemini пустой или не содержит извлекаемого текста. Сырой ответ: {response}")
-            return None, "AI не смог сгенерировать текстовый ответ. Пожалуйста, проверьте логи."
+def _estimate_request_tokens(prompt_template: str) -> int:
+    """Грубая оценка токенов запроса (вход + ожидаемый выход) для TPM-лимита: ~4 символа на токен."""
+    return (len(_active_system_instruction()) + len(prompt_template)) // 4 + AI_EXPECTED_OUTPUT_TOKENS
 
-        ai_text = ai_text.strip()
-        # Очистка от Markdown JSON-обертки
-        if ai_text.startswith('```json'):
-            ai_text = ai_text[len('```json'):].strip()
-        if ai_text.endswith('```'):
-            ai_text = ai_text[:-len('```')].strip()
 
-        logging.info(
-            f"AI Integration: Очищенный текст от Gemini (ожидаем JSON, первые 500 символов): {ai_text[:500]}...")
+def _request_priority(prepared: Dict[str, Any]) -> int:
+    return _REQUEST_PRIORITIES.get(prepared.get('request_type'), PRIORITY_MORE_OPTIONS)
+
+
+def _record_model_failure(model_name: str, error: Exception) -> None:
+    if not _is_structured_output_rejection(error):  # Отказ от схемы ответа - не признак деградации модели
+        ai_circuit_breaker.record_failure()
+        model_router.record(model_name, None, success=False)
 
-        try:
-            data = json.loads(ai_text)
-        except json.JSONDecodeError as e:
-            logging.error(f"AI Integration: Ошибка декодирования JSON от Gemini: {e}. "
-                          f"Ответ Gemini, который не удалось распарсить (первые 1000 символов):\n{ai_text[:1000]}")
-            return None, f"AI вернул некорректный JSON. (Ошибка: {e})"
-
-        # Валидация основной структуры ответа
-        structured = data.get('structured_recommendations')
-        summary = data.get('textual_summary')
-
-        if not isinstance(structured, dict):
-            logging.error(
-                f"AI Integration: 'structured_recommendations' отсутствует или не словарь. Получено: {type(structured)}. Ответ: {data}")
-            return None, "AI вернул 'structured_recommendations' в неожиданном формате."
-        if not isinstance(summary, str):
-            logging.error(
-                f"AI Integration: 'textual_summary' отсутствует или не строка. Получено: {type(summary)}. Ответ: {data}")
-            return None, "AI вернул 'textual_summary' в неожиданном формате."
-
-        query_summary_val = structured.get("query_summary")
-        recommendations_list = structured.get("recommendations")
-
-        if not isinstance(query_summary_val, dict) or not isinstance(recommendations_list, list):
-            logging.error(
-                f"AI Integration: Неверная внутренняя структура 'structured_recommendations'. query_summary: {type(query_summary_val)}, recommendations: {type(recommendations_list)}. Ответ: {structured}")
-            return None, "AI вернул 'structured_recommendations' с неверной внутренней структурой."
-
-        if not recommendations_list:  # Если список рекомендаций пуст
-            logging.info("AI Integration: Gemini вернул пустой список 'recommendations'.")
-            # Это не ошибка, а нормальный ответ, если AI ничего не нашел.
-            # structured и summary будут возвращены, хэндлер решит, что делать.
-
-        # Опциональная дополнительная валидация каждой рекомендации
-        for idx, rec_item in enumerate(recommendations_list):
-            if not isinstance(rec_item, dict):
-                logging.warning(f"AI Integration: Элемент #{idx} в 'recommendations' не является словарем: {rec_item}")
-                # Можно обработать: удалить элемент, вернуть ошибку и т.д.
-            else:
-                # Пример проверки обязательных полей
-                if not rec_item.get("id") or not rec_item.get("type") or not rec_item.get("name"):
-                    logging.warning(
-                        f"AI Integration: Элемент #{idx} в 'recommendations' не содержит обязательных полей id/type/name: ID='{rec_item.get('id')}', Type='{rec_item.get('type')}', Name='{rec_item.get('name')}'")
-
-        logging.info("AI Integration: Успешно получили и распарсили рекомендации от Gemini.")
-        return structured, summary
 
+def _record_model_success(model_name: str, latency: float) -> None:
+    ai_latency.record(latency)
+    ai_circuit_breaker.record_success()
+    model_router.record(model_name, latency, success=True)
+
+
+async def _call_gemini(model: genai.GenerativeModel, prompt_template: str, model_name: str) -> Any:
+    """
+    Один запрос к Gemini с дедлайном и страхующим дублем; результат учитывается
+    предохранителем и маршрутизатором моделей.
+    """
+    ai_prompt_chars.observe(len(prompt_template), model=model_name)
+    started_at = time.monotonic()
+    try:
+        response = await ai_hedged_caller.call(
+            lambda: model.generate_content_async(prompt_template),
+            deadline=AI_REQUEST_DEADLINE_SECONDS,
+            hedge_after=current_hedge_delay())
+    except Exception as e:
+        _record_model_failure(model_name, e)
+        ai_request_duration.observe(time.monotonic() - started_at, model=model_name, mode="batch",
+                                    outcome=type(e).__name__)
+        raise
+    latency = time.monotonic() - started_at
+    _record_model_success(model_name, latency)
+    ai_request_duration.observe(latency, model=model_name, mode="batch", outcome="ok")
+    return response
+
+
+async def _request_recommendations_from_gemini(
+        prepared: Dict[str, Any],
+        on_queued: Optional[QueuePositionCallback] = None,
+        priority: Optional[int] = None
+) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Строит промпт по подготовленным данным, отправляет его в Gemini и валидирует ответ.
+    Возвращает (structured_recommendations, textual_summary) или (None, текст ошибки).
+    """
+    prompt_template = _build_prompt(prepared)
+    request_type = prepared['request_type']
+    request_tokens = _estimate_request_tokens(prompt_template)
+
+    try:
+        model_name = model_router.choose(request_type, request_tokens)
+        model = _create_model(request_type, model_name)
+        structured_mode = _structured_output_active()
+
+        request_priority = priority if priority is not None else _request_priority(prepared)
+        async with ai_scheduler.slot(request_priority, request_tokens, on_queued):
+            logging.info("AI Integration: Отправка запроса к Gemini (модель '%s')...", model_name)
+            try:
+                response = await _call_gemini(model, prompt_template, model_name)
+            except Exception as e:
+                if structured_mode and _is_structured_output_rejection(e):
+                    _disable_structured_output(e)
+                else:
+                    # После таймаута дедлайн запроса исчерпан - повторять на другой модели поздно
+                    fallback_model = None if isinstance(e, asyncio.TimeoutError) else \
+                        model_router.fallback_for(request_type, model_name, request_tokens)
+                    if fallback_model is None:
+                        raise
+                    logging.warning(f"AI Integration: Модель '{model_name}' вернула ошибку ({type(e).__name__}), "
+                                    f"повторяем запрос на '{fallback_model}'.")
+                    model_name = fallback_model
+                model = _create_model(request_type, model_name)
+                response = await _call_gemini(model, prompt_template, model_name)
+
+        ai_text = _extract_response_text(response)
+        ai_response_chars.observe(len(ai_text), model=model_name, mode="batch")
+        if not ai_text:  # Проверка после всех попыток извлечения
+            ai_response_failures.inc(reason="empty")
+            logging.error("AI Integration: Ответ Gemini пустой или не содержит извлекаемого текста. Сырой ответ: %s",
+                          LogPayload(response, sample_rate=1.0))
+            return None, "AI не смог сгенерировать текстовый ответ. Пожалуйста, проверьте логи."
+
+        return _parse_ai_response_text(ai_text)
+
+    except AIQueueFullError as e:
+        logging.warning(f"AI Integration: Запрос отклонен планировщиком: {e}")
+        return None, AI_OVERLOADED_ERROR_TEXT
+    except asyncio.TimeoutError as e:
+        logging.error(f"AI Integration: Gemini не ответил в срок: {e}")
+        return None, AI_UNAVAILABLE_ERROR_TEXT
     except Exception as e:
         # Логируем с exc_info=True для полного трейсбека
         logging.error(f"AI Integration: Непредвиденная ошибка при работе с Gemini API: {e}", exc_info=True)
-        return None, f"Непредвиденная ошибка при обращении к AI: {type(e).__name__}. Детали в логах сервера."
\ No newline at end of file
+        return None, f"Непредвиденная ошибка при обращении к AI: {type(e).__name__}. Детали в логах сервера."
+
+
+_STREAM_END = object()  # Производитель закончил (успешно или с ошибкой - ее вернет сама задача)
+
+
+async def _produce_stream(prepared: Dict[str, Any], prompt_template: str, request_tokens: int,
+                          on_queued: Optional[QueuePositionCallback], stream_parser: RecommendationStreamParser,
+                          rec_queue: "asyncio.Queue[Any]") -> None:
+    """
+    Читает поток Gemini и кладет готовые рекомендации в rec_queue. Слот планировщика, дедлайн
+    и замер задержки модели относятся только к этой задаче: потребитель очереди на них не влияет.
+    """
+    try:
+        model_name = model_router.choose(prepared['request_type'], request_tokens)
+        model = _create_model(prepared['request_type'], model_name)
+        ai_prompt_chars.observe(len(prompt_template), model=model_name)
+        structured_mode = _structured_output_active()
+        # Слот планировщика занят на все время чтения потока
+        async with ai_scheduler.slot(_request_priority(prepared), request_tokens, on_queued):
+            logging.info("AI Integration: Отправка потокового запроса к Gemini (модель '%s')...", model_name)
+            loop = asyncio.get_running_loop()
+            deadline_at = loop.time() + AI_REQUEST_DEADLINE_SECONDS
+            started_at = time.monotonic()
+            try:
+                # Дедлайн общий на весь поток, а не на каждый отдельный фрагмент
+                try:
+                    response = await asyncio.wait_for(model.generate_content_async(prompt_template, stream=True),
+                                                      timeout=max(deadline_at - loop.time(), 0))
+                except Exception as e:
+                    if not (structured_mode and _is_structured_output_rejection(e)):
+                        raise
+                    _disable_structured_output(e)
+                    model = _create_model(prepared['request_type'], model_name)
+                    response = await asyncio.wait_for(model.generate_content_async(prompt_template, stream=True),
+                                                      timeout=max(deadline_at - loop.time(), 0))
+                chunks = response.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(deadline_at - loop.time(), 0))
+                    except StopAsyncIteration:
+                        break
+                    chunk_text = _extract_response_text(chunk)
+                    if not chunk_text:
+                        continue
+                    for rec_item in stream_parser.feed(chunk_text):
+                        rec_queue.put_nowait(rec_item)
+            except Exception as e:
+                _record_model_failure(model_name, e)
+                ai_request_duration.observe(time.monotonic() - started_at, model=model_name, mode="stream",
+                                            outcome=type(e).__name__)
+                raise
+            latency = time.monotonic() - started_at
+            _record_model_success(model_name, latency)
+            ai_request_duration.observe(latency, model=model_name, mode="stream", outcome="ok")
+            ai_response_chars.observe(len(stream_parser.text), model=model_name, mode="stream")
+    finally:
+        rec_queue.put_nowait(_STREAM_END)
+
+
+async def stream_travel_recommendations(
+        user_data_raw: Dict[str, Any],
+        on_queued: Optional[QueuePositionCallback] = None,
+        session: Optional[AsyncSession] = None
+) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Потоковый вариант get_travel_recommendations. Асинхронно отдает события:
+      ("recommendation", dict) - очередная полностью сгенерированная рекомендация;
+      ("done", (structured, summary)) - итоговый провалидированный ответ (в конце);
+      ("error", str) - текст ошибки (в конце, вместо "done").
+    Рекомендации отдаются по мере генерации, не дожидаясь конца JSON документа.
+    """
+    if not GEMINI_API_KEY:
+        logging.error("AI Integration: API ключ для Gemini не настроен или невалиден.")
+        yield "error", "Ошибка конфигурации: API ключ для AI не найден или не работает. Проверьте настройки."
+        return
+
+    logging.info("AI Integration: Получены сырые данные от пользователя для stream_travel_recommendations: %s",
+                 LogPayload(user_data_raw))
+    prepared = _prepare_user_data_for_prompt(user_data_raw)
+
+    location_key, catalog_items, prepared = await _consult_catalog(session, user_data_raw, prepared)
+    for rec_item in catalog_items:  # Рекомендации из каталога отдаем сразу, AI генерирует только недостающие
+        yield "recommendation", rec_item
+    if len(catalog_items) >= AI_CATALOG_TARGET_COUNT:
+        yield "done", _catalog_response(prepared, catalog_items)
+        return
+
+    request_key = make_cache_key(prepared)
+    if recommendation_cache:
+        cached = await recommendation_cache.get(request_key)
+        if cached is not None:
+            logging.info("AI Integration: Потоковый ответ взят из кэша (key=%.12s).", request_key)
+            for rec_item in cached["structured"].get("recommendations", []):
+                yield "recommendation", rec_item
+            yield "done", (_merge_catalog_items(cached["structured"], catalog_items), cached["summary"])
+            return
+
+    if not ai_circuit_breaker.allow():
+        stale = await recommendation_cache.get(request_key, allow_stale=True) if recommendation_cache else None
+        if stale is None:
+            logging.warning("AI Integration: Предохранитель разомкнут, потоковый запрос к Gemini не отправляется.")
+            yield "error", AI_UNAVAILABLE_ERROR_TEXT
+            return
+        logging.warning("AI Integration: Предохранитель разомкнут, отдаем устаревший ответ из кэша.")
+        for rec_item in stale["structured"].get("recommendations", []):
+            yield "recommendation", rec_item
+        yield "done", (_merge_catalog_items(stale["structured"], catalog_items), stale["summary"])
+        return
+
+    prompt_template = _build_prompt(prepared)
+    request_tokens = _estimate_request_tokens(prompt_template)
+    stream_parser = RecommendationStreamParser()
+    rec_queue: "asyncio.Queue[Any]" = asyncio.Queue()
+    producer = asyncio.create_task(_produce_stream(prepared, prompt_template, request_tokens, on_queued,
+                                                   stream_parser, rec_queue))
+    try:
+        # Читаем очередь, а не поток модели: пока потребитель отправляет карточки в Telegram,
+        # слот и дедлайн остаются у производителя и не зависят от скорости отправки
+        while (rec_item := await rec_queue.get()) is not _STREAM_END:
+            yield "recommendation", rec_item
+        await producer  # Пробрасывает ошибку производителя
+    except AIQueueFullError as e:
+        logging.warning(f"AI Integration: Потоковый запрос отклонен планировщиком: {e}")
+        yield "error", AI_OVERLOADED_ERROR_TEXT
+        return
+    except asyncio.TimeoutError as e:
+        logging.error(f"AI Integration: Потоковый ответ Gemini не уложился в {AI_REQUEST_DEADLINE_SECONDS:g} с: {e}")
+        yield "error", AI_UNAVAILABLE_ERROR_TEXT
+        return
+    except Exception as e:
+        logging.error(f"AI Integration: Непредвиденная ошибка при потоковой работе с Gemini API: {e}", exc_info=True)
+        yield "error", f"Непредвиденная ошибка при обращении к AI: {type(e).__name__}. Детали в логах сервера."
+        return
+    finally:
+        if not producer.done():  # Потребитель бросил поток (например, отмена хэндлера) - освобождаем слот
+            producer.cancel()
+
+    if not stream_parser.text.strip():
+        ai_response_failures.inc(reason="empty")
+        logging.error("AI Integration: Потоковый ответ Gemini пустой.")
+        yield "error", "AI не смог сгенерировать текстовый ответ. Пожалуйста, проверьте логи."
+        return
+
+    structured, summary = _parse_ai_response_text(stream_parser.text)
+    if structured is None:
+        yield "error", summary
+        return
+
+    recommendation_index.remember(structured.get("recommendations"))
+    if recommendation_cache:
+        await recommendation_cache.set(request_key, {"structured": structured, "summary": summary})
+    if location_key:
+        await recommendation_catalog.store(session, location_key, prepared['user_language'],
+                                           prepared['user_preferences'].get('budget'),
+                                           structured.get("recommendations"))
+    yield "done", (_merge_catalog_items(structured, catalog_items), summary)
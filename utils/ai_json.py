@@ -0,0 +1,276 @@
+# utils/ai_json.py
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.json_stream import RecommendationStreamParser
+
+try:  # orjson заметно быстрее стандартного json; без него работаем на json
+    import orjson
+
+    def _loads(text: str) -> Any:
+        return orjson.loads(text)
+
+    JSON_BACKEND = "orjson"
+except ImportError:
+    def _loads(text: str) -> Any:
+        return json.loads(text)
+
+    JSON_BACKEND = "json"
+
+# Ошибки разбора обоих бэкендов (orjson.JSONDecodeError наследует json.JSONDecodeError/ValueError)
+JSONDecodeErrors = (ValueError,)
+
+_FENCE_RE = re.compile(r"^\s*```[a-zA-Z0-9_-]*\s*\n?(.*?)\n?\s*```\s*$", re.DOTALL)
+_CLOSERS = {"{": "}", "[": "]"}
+
+# Сколько раз срабатывала каждая починка; отдается в метрики через get_decode_stats()
+decode_stats: Dict[str, int] = {
+    "decoded": 0,
+    "fast_path": 0,
+    "repaired": 0,
+    "failed": 0,
+    "fence_stripped": 0,
+    "object_extracted": 0,
+    "trailing_commas": 0,
+    "control_chars": 0,
+    "unescaped_quotes": 0,
+    "truncated_salvaged": 0,
+    "salvaged_recommendations": 0,
+}
+
+
+class ModelJSONError(ValueError):
+    """Ответ модели не удалось превратить в JSON даже после починок."""
+
+    def __init__(self, message: str, original_error: Optional[Exception] = None):
+        super().__init__(message)
+        self.original_error = original_error
+
+
+def _strip_fence(text: str) -> str:
+    match = _FENCE_RE.match(text)
+    if match:
+        return match.group(1).strip()
+    # Обрезанный ответ: открывающая обертка есть, закрывающей нет
+    if text.startswith("```"):
+        first_newline = text.find("\n")
+        return text[first_newline + 1:].strip() if first_newline != -1 else ""
+    return text
+
+
+def _extract_object(text: str) -> str:
+    """
+    Вырезает корневой JSON объект из окружающего текста ("Вот ваш JSON: {...} Надеюсь, помог").
+    Если объект не закрыт (ответ обрезан), возвращает все от первой "{" до конца.
+    """
+    start = text.find("{")
+    if start == -1:
+        return text
+    depth = 0
+    in_string = False
+    escape = False
+    for pos in range(start, len(text)):
+        ch = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:pos + 1]
+    return text[start:]
+
+
+def _next_significant(text: str, pos: int) -> str:
+    length = len(text)
+    while pos < length and text[pos] in " \t\r\n":
+        pos += 1
+    return text[pos] if pos < length else ""
+
+
+def _repair(text: str) -> Tuple[str, List[str]]:
+    """
+    Один проход по тексту с учетом строк, исправляющий типичные дефекты ответа модели:
+    висячие запятые перед } и ], неэкранированные переводы строк/табы внутри строк и
+    неэкранированные кавычки внутри строк (кавычка, за которой не идет , : } ] или конец, считается
+    частью значения). Возвращает исправленный текст и список примененных починок.
+    """
+    out: List[str] = []
+    repairs = set()
+    in_string = False
+    escape = False
+    length = len(text)
+    pos = 0
+    while pos < length:
+        ch = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+                out.append(ch)
+            elif ch == "\\":
+                escape = True
+                out.append(ch)
+            elif ch == '"':
+                if _next_significant(text, pos + 1) in (",", ":", "}", "]", ""):
+                    in_string = False
+                    out.append(ch)
+                else:
+                    repairs.add("unescaped_quotes")
+                    out.append('\\"')
+            elif ch in "\n\r\t":
+                repairs.add("control_chars")
+                out.append({"\n": "\\n", "\r": "\\r", "\t": "\\t"}[ch])
+            else:
+                out.append(ch)
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch == "," and _next_significant(text, pos + 1) in ("}", "]"):
+            repairs.add("trailing_commas")
+        else:
+            out.append(ch)
+        pos += 1
+    return "".join(out), sorted(repairs)
+
+
+def _close_truncated(text: str) -> Optional[Any]:
+    """
+    Пытается разобрать обрезанный JSON: отрезает текст по последней границе завершенного
+    элемента (запятая или открывающая скобка вне строки) и дописывает недостающие закрывающие скобки.
+    """
+    stack: List[str] = []
+    cut_points: List[Tuple[int, str]] = []  # (позиция среза, закрывающие скобки)
+    in_string = False
+    escape = False
+    for pos, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+            cut_points.append((pos + 1, "".join(_CLOSERS[c] for c in reversed(stack))))
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            cut_points.append((pos + 1, "".join(_CLOSERS[c] for c in reversed(stack))))
+        elif ch == ",":
+            cut_points.append((pos, "".join(_CLOSERS[c] for c in reversed(stack))))
+
+    for cut_pos, closers in reversed(cut_points[-50:]):
+        try:
+            return _loads(text[:cut_pos] + closers)
+        except JSONDecodeErrors:
+            continue
+    return None
+
+
+def _salvage_truncated(text: str) -> Optional[Dict[str, Any]]:
+    """
+    Спасает обрезанный по лимиту токенов ответ: берет все полностью сгенерированные рекомендации
+    (через тот же разборщик, что и потоковый режим) и то, что удалось разобрать из остального документа.
+    Недописанная последняя рекомендация отбрасывается.
+    """
+    stream_parser = RecommendationStreamParser()
+    complete_recommendations = stream_parser.feed(text)
+    if not complete_recommendations:
+        return None
+
+    data = _close_truncated(text)
+    if not isinstance(data, dict):
+        data = {}
+    structured = data.get("structured_recommendations")
+    if not isinstance(structured, dict):
+        structured = {}
+    if not isinstance(structured.get("query_summary"), dict):
+        structured["query_summary"] = {}
+    structured["recommendations"] = complete_recommendations
+    data["structured_recommendations"] = structured
+    if not isinstance(data.get("textual_summary"), str):
+        data["textual_summary"] = ""
+    return data
+
+
+def _count(repairs: List[str]) -> None:
+    decode_stats["decoded"] += 1
+    if not repairs:
+        decode_stats["fast_path"] += 1
+        return
+    decode_stats["repaired"] += 1
+    for repair in repairs:
+        decode_stats[repair] = decode_stats.get(repair, 0) + 1
+
+
+def decode_model_json(raw_text: str) -> Tuple[Any, List[str]]:
+    """
+    Разбирает JSON из ответа модели. Сначала пробует текст как есть, затем по очереди:
+    снимает ```-обертку, вырезает объект из окружающего текста, чинит типичные дефекты и,
+    наконец, спасает рекомендации из обрезанного ответа.
+    Возвращает (данные, список примененных починок). Бросает ModelJSONError, если ничего не помогло.
+    """
+    text = raw_text.strip()
+    repairs: List[str] = []
+    try:
+        data = _loads(text)
+        _count(repairs)
+        return data, repairs
+    except JSONDecodeErrors as e:
+        first_error = e
+
+    stripped = _strip_fence(text)
+    if stripped != text:
+        repairs.append("fence_stripped")
+        text = stripped
+    extracted = _extract_object(text)
+    if extracted != text:
+        repairs.append("object_extracted")
+        text = extracted
+    if repairs:
+        try:
+            data = _loads(text)
+            _count(repairs)
+            return data, repairs
+        except JSONDecodeErrors:
+            pass
+
+    repaired_text, text_repairs = _repair(text)
+    if text_repairs:
+        repairs.extend(text_repairs)
+        try:
+            data = _loads(repaired_text)
+            _count(repairs)
+            return data, repairs
+        except JSONDecodeErrors:
+            pass
+
+    salvaged = _salvage_truncated(repaired_text)
+    if salvaged is not None:
+        repairs.append("truncated_salvaged")
+        decode_stats["salvaged_recommendations"] += len(salvaged["structured_recommendations"]["recommendations"])
+        _count(repairs)
+        logging.warning(f"AI JSON: Ответ модели обрезан, спасено рекомендаций: "
+                        f"{len(salvaged['structured_recommendations']['recommendations'])}.")
+        return salvaged, repairs
+
+    decode_stats["failed"] += 1
+    raise ModelJSONError(str(first_error), original_error=first_error)
+
+
+def get_decode_stats() -> Dict[str, Any]:
+    return {**decode_stats, "backend": JSON_BACKEND}
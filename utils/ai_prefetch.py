@@ -0,0 +1,189 @@
+# utils/ai_prefetch.py
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from utils.ai_integration import get_travel_recommendations
+from utils.ai_scheduler import PRIORITY_PREFETCH
+
+AI_PREFETCH_ENABLED = os.getenv("AI_PREFETCH_ENABLED", "0").lower() in ("1", "true", "yes")
+AI_PREFETCH_TTL_SECONDS = float(os.getenv("AI_PREFETCH_TTL_SECONDS", "600"))
+# Сколько предзагрузок может выполняться одновременно на весь процесс
+AI_PREFETCH_MAX_IN_FLIGHT = int(os.getenv("AI_PREFETCH_MAX_IN_FLIGHT", "4"))
+# Сколько предзагрузок допускается за одну сессию планирования (/plan_trip) одного пользователя
+AI_PREFETCH_MAX_PER_SESSION = int(os.getenv("AI_PREFETCH_MAX_PER_SESSION", "1"))
+# Сколько пользователей со счетчиком бюджета хранить (самые давние вытесняются)
+AI_PREFETCH_MAX_SESSIONS = int(os.getenv("AI_PREFETCH_MAX_SESSIONS", "10000"))
+
+RecommendationsResult = Tuple[Optional[Dict[str, Any]], Optional[str]]
+
+# Поля запроса, которые не участвуют в сравнении: лайки/дизлайки могут измениться
+# между предзагрузкой и нажатием кнопки, дизлайки отфильтровываются из результата отдельно.
+_FINGERPRINT_IGNORED_FIELDS = ("liked_recommendation_ids", "disliked_recommendation_ids")
+
+
+def _request_fingerprint(request_data: Dict[str, Any]) -> str:
+    relevant = {k: v for k, v in request_data.items() if k not in _FINGERPRINT_IGNORED_FIELDS}
+    if isinstance(relevant.get("current_session_shown_ids"), list):
+        relevant["current_session_shown_ids"] = sorted(str(i) for i in relevant["current_session_shown_ids"])
+    return json.dumps(relevant, ensure_ascii=False, sort_keys=True, default=str)
+
+
+class RecommendationPrefetcher:
+    """
+    Фоновая предзагрузка следующего набора рекомендаций ("more_options") для пользователя.
+    На пользователя хранится не более одной предзагрузки; она живет ttl_seconds и
+    отменяется при новом /plan_trip.
+    Счетчик бюджета сессии удаляется при новом /plan_trip, а также если пользователь не запускал
+    предзагрузок дольше ttl_seconds (его предзагрузка к этому времени все равно устарела);
+    всего хранится не больше max_sessions счетчиков.
+    """
+
+    def __init__(self, fetch: Callable[..., Awaitable[RecommendationsResult]], enabled: bool = False,
+                 ttl_seconds: float = 600, max_in_flight: int = 4, max_per_session: int = 1,
+                 max_sessions: int = 10000):
+        self._fetch = fetch
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.max_in_flight = max_in_flight
+        self.max_per_session = max_per_session
+        self.max_sessions = max_sessions
+        self._entries: Dict[int, Dict[str, Any]] = {}
+        # Пользователь -> (число предзагрузок в сессии, время последней); порядок - от давних к недавним
+        self._session_counts: "OrderedDict[int, Tuple[int, float]]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            "scheduled": 0,
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "mismatched": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "skipped_budget": 0,
+        }
+
+    def _in_flight_count(self) -> int:
+        return sum(1 for entry in self._entries.values() if not entry["task"].done())
+
+    def schedule(self, user_id: int, request_data: Dict[str, Any]) -> bool:
+        """Запускает предзагрузку для пользователя. Возвращает False, если она выключена или бюджет исчерпан."""
+        if not self.enabled:
+            return False
+        self._prune_expired()
+        self._drop(user_id, count_as_cancelled=True)
+        if self._session_counts.get(user_id, (0, 0.0))[0] >= self.max_per_session or \
+                self._in_flight_count() >= self.max_in_flight:
+            self.stats["skipped_budget"] += 1
+            logging.info(f"AI Prefetch: Бюджет предзагрузки исчерпан, пропускаем для пользователя {user_id}.")
+            return False
+
+        task = asyncio.ensure_future(self._fetch(request_data, priority=PRIORITY_PREFETCH))
+        task.add_done_callback(self._consume_task_exception)
+        self._entries[user_id] = {
+            "task": task,
+            "fingerprint": _request_fingerprint(request_data),
+            "created_at": time.monotonic(),
+        }
+        self._session_counts[user_id] = (self._session_counts.get(user_id, (0, 0.0))[0] + 1, time.monotonic())
+        self._session_counts.move_to_end(user_id)
+        while len(self._session_counts) > self.max_sessions:
+            self._session_counts.popitem(last=False)
+        self.stats["scheduled"] += 1
+        logging.info(f"AI Prefetch: Запущена предзагрузка 'еще рекомендаций' для пользователя {user_id}.")
+        return True
+
+    async def take(self, user_id: int, request_data: Dict[str, Any]) -> Optional[RecommendationsResult]:
+        """
+        Забирает предзагруженный результат, если он свежий и построен для тех же данных.
+        Если предзагрузка еще идет, дожидается ее - это все равно быстрее нового запроса.
+        Возвращает None, если результата нет: тогда вызывающий делает обычный запрос к AI.
+        """
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            if self.enabled:
+                self.stats["misses"] += 1
+            return None
+
+        task = entry["task"]
+        if time.monotonic() - entry["created_at"] > self.ttl_seconds:
+            task.cancel()
+            self.stats["expired"] += 1
+            return None
+        if entry["fingerprint"] != _request_fingerprint(request_data):
+            task.cancel()
+            self.stats["mismatched"] += 1
+            logging.info(f"AI Prefetch: Данные пользователя {user_id} изменились, предзагрузка не используется.")
+            return None
+
+        try:
+            structured, summary = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                self.stats["cancelled"] += 1
+                return None
+            raise
+        except Exception as e:
+            logging.warning(f"AI Prefetch: Предзагрузка для пользователя {user_id} завершилась ошибкой: {e}")
+            self.stats["failed"] += 1
+            return None
+
+        if structured is None:
+            self.stats["failed"] += 1
+            return None
+
+        disliked_ids = set(str(i) for i in request_data.get("disliked_recommendation_ids") or [])
+        recommendations = structured.get("recommendations")
+        if disliked_ids and isinstance(recommendations, list):
+            structured["recommendations"] = [rec for rec in recommendations
+                                             if not (isinstance(rec, dict) and rec.get("id") in disliked_ids)]
+        self.stats["hits"] += 1
+        logging.info(f"AI Prefetch: Использована предзагрузка для пользователя {user_id}.")
+        return structured, summary
+
+    def _prune_expired(self) -> None:
+        now = time.monotonic()
+        for user_id in [uid for uid, entry in self._entries.items()
+                        if now - entry["created_at"] > self.ttl_seconds]:
+            self._drop(user_id)
+            self.stats["expired"] += 1
+        # Счетчики упорядочены по времени последней предзагрузки - устаревшие всегда в начале
+        while self._session_counts:
+            user_id, (_, last_scheduled_at) = next(iter(self._session_counts.items()))
+            if now - last_scheduled_at <= self.ttl_seconds:
+                break
+            del self._session_counts[user_id]
+
+    def cancel(self, user_id: int) -> None:
+        """Отменяет предзагрузку пользователя и сбрасывает его бюджет (начало новой сессии планирования)."""
+        self._drop(user_id, count_as_cancelled=True)
+        self._session_counts.pop(user_id, None)
+
+    def _drop(self, user_id: int, count_as_cancelled: bool = False) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None and not entry["task"].done():
+            entry["task"].cancel()
+            if count_as_cancelled:
+                self.stats["cancelled"] += 1
+
+    @staticmethod
+    def _consume_task_exception(task: "asyncio.Task[Any]") -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"AI Prefetch: Фоновая предзагрузка упала: {task.exception()}")
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "entries": len(self._entries), "in_flight": self._in_flight_count(),
+                "sessions": len(self._session_counts)}
+
+
+recommendation_prefetcher = RecommendationPrefetcher(
+    fetch=get_travel_recommendations,
+    enabled=AI_PREFETCH_ENABLED,
+    ttl_seconds=AI_PREFETCH_TTL_SECONDS,
+    max_in_flight=AI_PREFETCH_MAX_IN_FLIGHT,
+    max_per_session=AI_PREFETCH_MAX_PER_SESSION,
+    max_sessions=AI_PREFETCH_MAX_SESSIONS,
+)
@@ -0,0 +1,178 @@
+# utils/ai_resilience.py
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+AI_REQUEST_DEADLINE_SECONDS = float(os.getenv("AI_REQUEST_DEADLINE_SECONDS", "60"))
+AI_HEDGE_ENABLED = os.getenv("AI_HEDGE_ENABLED", "0").lower() in ("1", "true", "yes")
+# Второй (страхующий) запрос отправляется, если первый дольше этого перцентиля задержек
+AI_HEDGE_PERCENTILE = float(os.getenv("AI_HEDGE_PERCENTILE", "95"))
+AI_HEDGE_MIN_SAMPLES = int(os.getenv("AI_HEDGE_MIN_SAMPLES", "20"))
+AI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("AI_CIRCUIT_FAILURE_THRESHOLD", "5"))
+AI_CIRCUIT_RESET_SECONDS = float(os.getenv("AI_CIRCUIT_RESET_SECONDS", "30"))
+
+
+class LatencyTracker:
+    """Скользящее окно последних задержек (в секундах) с расчетом перцентилей."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """p-й перцентиль (0-100) или None, если замеров пока слишком мало."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "samples": len(self._samples),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class CircuitBreaker:
+    """
+    Предохранитель с тремя состояниями:
+      closed    - запросы идут как обычно, подряд идущие ошибки считаются;
+      open      - после failure_threshold ошибок подряд запросы сразу отклоняются на reset_timeout секунд;
+      half_open - по истечении reset_timeout пропускается один пробный запрос:
+                  успех замыкает предохранитель, ошибка снова размыкает его.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30, name: str = "AI Circuit Breaker"):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started_at = 0.0
+        self.stats: Dict[str, int] = {"successes": 0, "failures": 0, "rejected": 0, "opened": 0}
+
+    def allow(self) -> bool:
+        """Можно ли сейчас отправить запрос. В half_open пропускает только один пробный."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self.stats["rejected"] += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+            logging.info(f"{self.name}: Переход в half_open, пропускаем пробный запрос.")
+        if self.state == self.HALF_OPEN:
+            # Пробный запрос, не сообщивший результат за reset_timeout (например, отклонен очередью), не держит блокировку
+            if self._probe_in_flight and time.monotonic() - self._probe_started_at < self.reset_timeout:
+                self.stats["rejected"] += 1
+                return False
+            self._probe_in_flight = True
+            self._probe_started_at = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.stats["successes"] += 1
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            logging.info(f"{self.name}: Upstream восстановился, предохранитель замкнут.")
+        self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        self.stats["failures"] += 1
+        self._consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.stats["opened"] += 1
+                logging.warning(f"{self.name}: Предохранитель разомкнут после {self._consecutive_failures} "
+                                f"ошибок подряд на {self.reset_timeout} с.")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "state": self.state, "consecutive_failures": self._consecutive_failures}
+
+
+class HedgedCaller:
+    """
+    Выполняет запрос с общим дедлайном и (опционально) страхующим дублем:
+    если первый запрос не ответил за hedge_after секунд, параллельно отправляется второй,
+    и используется тот ответ, что пришел первым. Проигравший запрос отменяется.
+    """
+
+    def __init__(self):
+        self.stats: Dict[str, int] = {"calls": 0, "timeouts": 0, "hedges_started": 0, "hedges_won": 0}
+
+    async def call(self, factory: Callable[[], Awaitable[Any]], deadline: float,
+                   hedge_after: Optional[float] = None) -> Any:
+        """Бросает asyncio.TimeoutError, если ни один запрос не уложился в deadline."""
+        self.stats["calls"] += 1
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + deadline
+        primary = asyncio.ensure_future(factory())
+        pending = {primary}
+        hedge: Optional[asyncio.Future] = None
+        last_error: Optional[BaseException] = None
+
+        try:
+            while pending:
+                remaining = deadline_at - loop.time()
+                if remaining <= 0:
+                    break
+                wait_for = remaining
+                if hedge is None and hedge_after is not None:
+                    wait_for = min(remaining, max(hedge_after - (deadline - remaining), 0))
+
+                done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is None:
+                        if finished is hedge:
+                            self.stats["hedges_won"] += 1
+                        return finished.result()
+                    last_error = finished.exception()
+
+                if hedge is None and hedge_after is not None and not done and pending \
+                        and loop.time() < deadline_at:
+                    logging.info(f"AI Resilience: Ответа нет дольше {hedge_after:.2f} с, отправляем страхующий запрос.")
+                    hedge = asyncio.ensure_future(factory())
+                    pending.add(hedge)
+                    self.stats["hedges_started"] += 1
+
+            if last_error is not None and not pending:
+                raise last_error
+            self.stats["timeouts"] += 1
+            raise asyncio.TimeoutError(f"AI не ответил за {deadline:g} с.")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self.stats)
+
+
+ai_latency = LatencyTracker(min_samples=AI_HEDGE_MIN_SAMPLES)
+ai_circuit_breaker = CircuitBreaker(failure_threshold=AI_CIRCUIT_FAILURE_THRESHOLD,
+                                    reset_timeout=AI_CIRCUIT_RESET_SECONDS)
+ai_hedged_caller = HedgedCaller()
+
+
+def current_hedge_delay() -> Optional[float]:
+    """Через сколько секунд отправлять страхующий запрос (None - не отправлять)."""
+    if not AI_HEDGE_ENABLED:
+        return None
+    return ai_latency.percentile(AI_HEDGE_PERCENTILE)
@@ -0,0 +1,155 @@
+# utils/ai_routing.py
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+# Быстрая/дешевая модель для "еще вариантов" (пусто - использовать основную модель)
+AI_FAST_MODEL_NAME = os.getenv("AI_FAST_MODEL_NAME", "gemini-1.5-flash-8b")
+# Модель считается деградировавшей при доле ошибок выше порога (после min_samples запросов)
+AI_ROUTE_MAX_ERROR_RATE = float(os.getenv("AI_ROUTE_MAX_ERROR_RATE", "0.5"))
+AI_ROUTE_MIN_SAMPLES = int(os.getenv("AI_ROUTE_MIN_SAMPLES", "5"))
+# Через сколько секунд деградировавшей модели снова дается пробный запрос
+AI_ROUTE_RETRY_SECONDS = float(os.getenv("AI_ROUTE_RETRY_SECONDS", "60"))
+# Вес нового замера в EWMA задержки и доли ошибок
+AI_ROUTE_EWMA_ALPHA = float(os.getenv("AI_ROUTE_EWMA_ALPHA", "0.2"))
+
+
+class ModelHealth:
+    """Скользящие (EWMA) задержка и доля ошибок одной модели."""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latency_ewma: Optional[float] = None
+        self.error_rate_ewma = 0.0
+        self.samples = 0
+        self.degraded_since: Optional[float] = None
+
+    def record(self, latency: Optional[float], success: bool) -> None:
+        self.samples += 1
+        self.error_rate_ewma += self.alpha * ((0.0 if success else 1.0) - self.error_rate_ewma)
+        if success and latency is not None:
+            self.latency_ewma = latency if self.latency_ewma is None else \
+                self.latency_ewma + self.alpha * (latency - self.latency_ewma)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"latency_ewma": self.latency_ewma, "error_rate_ewma": round(self.error_rate_ewma, 4),
+                "samples": self.samples, "degraded": self.degraded_since is not None}
+
+
+class ModelRouter:
+    """
+    Выбирает модель Gemini для запроса по маршруту (request_type), размеру промпта
+    и наблюдаемому здоровью моделей.
+
+    Маршрут: {"models": [...], "strategy": "ordered" | "fastest", "slo_seconds": 30,
+              "large_prompt_tokens": 6000, "large_prompt_models": [...]}.
+    ordered - первая здоровая модель из списка, fastest - здоровая с наименьшей EWMA задержкой.
+    Модель деградировала, если ее доля ошибок выше max_error_rate или EWMA задержка выше SLO маршрута;
+    такая модель пропускается (с пробным запросом раз в retry_seconds), пока есть здоровые.
+    """
+
+    def __init__(self, routes: Dict[str, Dict[str, Any]], default_model: str, max_error_rate: float = 0.5,
+                 min_samples: int = 5, retry_seconds: float = 60, alpha: float = 0.2):
+        self.routes = routes
+        self.default_model = default_model
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.retry_seconds = retry_seconds
+        self.alpha = alpha
+        self._health: Dict[str, ModelHealth] = {}
+        self.stats: Dict[str, int] = {"routed": 0, "fallbacks": 0, "probes": 0}
+        self._route_counts: Dict[str, int] = {}
+
+    def _health_of(self, model_name: str) -> ModelHealth:
+        health = self._health.get(model_name)
+        if health is None:
+            health = self._health[model_name] = ModelHealth(self.alpha)
+        return health
+
+    def _is_degraded(self, model_name: str, slo_seconds: Optional[float]) -> bool:
+        health = self._health_of(model_name)
+        degraded = health.samples >= self.min_samples and (
+                health.error_rate_ewma > self.max_error_rate
+                or (slo_seconds is not None and health.latency_ewma is not None and health.latency_ewma > slo_seconds))
+        if not degraded:
+            if health.degraded_since is not None:
+                logging.info(f"AI Routing: Модель '{model_name}' снова в норме.")
+            health.degraded_since = None
+            return False
+        now = time.monotonic()
+        if health.degraded_since is None:
+            health.degraded_since = now
+            logging.warning(f"AI Routing: Модель '{model_name}' деградировала: {health.snapshot()}.")
+            return True
+        if now - health.degraded_since >= self.retry_seconds:
+            health.degraded_since = now  # Пробный запрос, следующий - не раньше чем через retry_seconds
+            self.stats["probes"] += 1
+            return False
+        return True
+
+    def candidates(self, request_type: str, prompt_tokens: int = 0) -> List[str]:
+        """Модели маршрута в порядке попыток: сначала здоровые (по стратегии), затем деградировавшие."""
+        route = self.routes.get(request_type) or {}
+        models = route.get("models") or [self.default_model]
+        large_threshold = route.get("large_prompt_tokens")
+        if large_threshold and prompt_tokens >= large_threshold and route.get("large_prompt_models"):
+            models = route["large_prompt_models"]
+        models = list(dict.fromkeys(models))
+
+        if route.get("strategy") == "fastest":
+            # Модели без замеров идут первыми, чтобы получить для них статистику
+            models.sort(key=lambda name: self._health_of(name).latency_ewma or 0.0)
+        slo_seconds = route.get("slo_seconds")
+        healthy = [name for name in models if not self._is_degraded(name, slo_seconds)]
+        degraded = [name for name in models if name not in healthy]
+        degraded.sort(key=lambda name: self._health_of(name).error_rate_ewma)
+        return healthy + degraded
+
+    def choose(self, request_type: str, prompt_tokens: int = 0) -> str:
+        ordered = self.candidates(request_type, prompt_tokens)
+        model_name = ordered[0]
+        self.stats["routed"] += 1
+        route_key = f"{request_type}:{model_name}"
+        self._route_counts[route_key] = self._route_counts.get(route_key, 0) + 1
+        return model_name
+
+    def fallback_for(self, request_type: str, failed_model: str, prompt_tokens: int = 0) -> Optional[str]:
+        """Следующая модель маршрута после неудачной (None, если других нет)."""
+        for model_name in self.candidates(request_type, prompt_tokens):
+            if model_name != failed_model:
+                self.stats["fallbacks"] += 1
+                logging.warning(f"AI Routing: Переключаемся с '{failed_model}' на '{model_name}' ({request_type}).")
+                return model_name
+        return None
+
+    def record(self, model_name: str, latency: Optional[float], success: bool) -> None:
+        self._health_of(model_name).record(latency, success)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "routes": dict(self._route_counts),
+            "models": {name: health.snapshot() for name, health in self._health.items()},
+        }
+
+
+def load_routes(default_model: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Маршруты по умолчанию: первичный план - основная модель, "еще варианты" - самая быстрая
+    из быстрой и основной. Переопределяются JSON-ом в AI_MODEL_ROUTES (ключи маршрутов заменяются целиком).
+    """
+    fast_models = [AI_FAST_MODEL_NAME, default_model] if AI_FAST_MODEL_NAME else [default_model]
+    routes: Dict[str, Dict[str, Any]] = {
+        "initial": {"models": [default_model], "strategy": "ordered", "slo_seconds": 40},
+        "more_options": {"models": fast_models, "strategy": "fastest", "slo_seconds": 20},
+    }
+    try:
+        overrides = json.loads(os.getenv("AI_MODEL_ROUTES", "{}"))
+        if not isinstance(overrides, dict):
+            raise ValueError("ожидается JSON объект")
+        routes.update(overrides)
+    except (json.JSONDecodeError, TypeError, ValueError) as e:
+        logging.error(f"AI Routing: Некорректный JSON в AI_MODEL_ROUTES: {e}. Используются маршруты по умолчанию.")
+    return routes
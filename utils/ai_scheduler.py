@@ -0,0 +1,186 @@
+# utils/ai_scheduler.py
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from utils.rate_limit import TokenBucket
+
+# Приоритеты: меньше - важнее. Первичный план идет раньше "еще вариантов",
+# а фоновая предзагрузка - после всех запросов, которых пользователь ждет прямо сейчас.
+PRIORITY_INITIAL = 0
+PRIORITY_MORE_OPTIONS = 10
+PRIORITY_PREFETCH = 20
+
+AI_RATE_LIMIT_RPM = float(os.getenv("AI_RATE_LIMIT_RPM", "60"))
+AI_RATE_LIMIT_TPM = float(os.getenv("AI_RATE_LIMIT_TPM", "1000000"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_MAX_QUEUE_SIZE = int(os.getenv("AI_MAX_QUEUE_SIZE", "200"))
+# С какой позиции в очереди пользователю сообщается "вы N-й в очереди"
+AI_QUEUE_NOTIFY_POSITION = int(os.getenv("AI_QUEUE_NOTIFY_POSITION", "3"))
+
+QueuePositionCallback = Callable[[int], Awaitable[Any]]
+
+
+class AIQueueFullError(Exception):
+    """Очередь запросов к AI переполнена - запрос отклонен сразу (backpressure)."""
+
+
+class AIRequestScheduler:
+    """
+    Асинхронный планировщик запросов к AI.
+    Ограничивает число запросов в минуту (RPM) и токенов в минуту (TPM) через token bucket,
+    число одновременных запросов и длину очереди. Из очереди первым выходит запрос
+    с наименьшим приоритетом, при равенстве - пришедший раньше.
+    """
+
+    def __init__(self, rpm: float, tpm: float, max_concurrency: int, max_queue_size: int,
+                 notify_position: int = 3, name: str = "AI Scheduler"):
+        self.name = name
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue_size = max_queue_size
+        self.notify_position = notify_position
+        self._rpm_bucket = TokenBucket(rate=rpm / 60.0, capacity=rpm)
+        self._tpm_bucket = TokenBucket(rate=tpm / 60.0, capacity=tpm)
+        self._heap: List[List[Any]] = []  # [priority, seq, tokens, future, enqueued_at]
+        self._seq = itertools.count()
+        self._active = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional["asyncio.Task[None]"] = None
+        self.stats: Dict[str, float] = {
+            "submitted": 0,
+            "started": 0,
+            "rejected": 0,
+            "cancelled": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "last_wait_seconds": 0.0,
+        }
+
+    def queue_depth(self) -> int:
+        return sum(1 for entry in self._heap if not entry[3].done())
+
+    def _position_of(self, entry: List[Any]) -> int:
+        return 1 + sum(1 for other in self._heap
+                       if not other[3].done() and (other[0], other[1]) < (entry[0], entry[1]))
+
+    def _wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _ensure_dispatcher(self) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch_loop())
+
+    async def _wait_for_wakeup(self, timeout: Optional[float] = None) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            # Отмененные ожидающие просто выбрасываются из головы очереди
+            while self._heap and self._heap[0][3].done():
+                heapq.heappop(self._heap)
+
+            if not self._heap or self._active >= self.max_concurrency:
+                await self._wait_for_wakeup()
+                continue
+
+            priority, _seq, tokens, future, _enqueued_at = self._heap[0]
+            delay = max(self._rpm_bucket.time_until(1), self._tpm_bucket.time_until(tokens))
+            if delay > 0:
+                await self._wait_for_wakeup(timeout=delay)
+                continue
+
+            heapq.heappop(self._heap)
+            self._rpm_bucket.consume(1)
+            self._tpm_bucket.consume(tokens)
+            self._active += 1
+            future.set_result(None)
+
+    async def acquire(self, priority: int, tokens: int,
+                      on_queued: Optional[QueuePositionCallback] = None) -> float:
+        """
+        Ждет своей очереди на запрос к AI. Возвращает время ожидания в секундах.
+        Если позиция в очереди не меньше notify_position, один раз вызывает on_queued(позиция).
+        При переполненной очереди сразу бросает AIQueueFullError.
+        """
+        if self.queue_depth() >= self.max_queue_size:
+            self.stats["rejected"] += 1
+            logging.warning(f"{self.name}: Очередь переполнена ({self.max_queue_size}), запрос отклонен.")
+            raise AIQueueFullError(f"Очередь запросов к AI переполнена ({self.max_queue_size}).")
+
+        self._ensure_dispatcher()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        enqueued_at = time.monotonic()
+        entry = [priority, next(self._seq), tokens, future, enqueued_at]
+        heapq.heappush(self._heap, entry)
+        self.stats["submitted"] += 1
+        self._wake()
+
+        try:
+            if on_queued is not None and not future.done():
+                position = self._position_of(entry)
+                if position >= self.notify_position:
+                    logging.info(f"{self.name}: Запрос в очереди на позиции {position} (глубина {self.queue_depth()}).")
+                    try:
+                        await on_queued(position)
+                    except Exception as e:
+                        logging.warning(f"{self.name}: Ошибка уведомления о позиции в очереди: {e}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Слот уже был выдан, но ожидающий отменен - возвращаем его
+            else:
+                future.cancel()
+                self.stats["cancelled"] += 1
+                self._wake()
+            raise
+
+        waited = time.monotonic() - enqueued_at
+        self.stats["started"] += 1
+        self.stats["wait_seconds_total"] += waited
+        self.stats["last_wait_seconds"] = waited
+        self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+        return waited
+
+    def release(self) -> None:
+        self._active = max(self._active - 1, 0)
+        self._wake()
+
+    @asynccontextmanager
+    async def slot(self, priority: int, tokens: int,
+                   on_queued: Optional[QueuePositionCallback] = None) -> AsyncIterator[float]:
+        """Контекстный менеджер: занимает слот на время запроса к AI и освобождает его после."""
+        waited = await self.acquire(priority, tokens, on_queued)
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        started = self.stats["started"]
+        return {
+            **self.stats,
+            "queue_depth": self.queue_depth(),
+            "active": self._active,
+            "wait_seconds_avg": (self.stats["wait_seconds_total"] / started) if started else 0.0,
+        }
+
+
+ai_scheduler = AIRequestScheduler(
+    rpm=AI_RATE_LIMIT_RPM,
+    tpm=AI_RATE_LIMIT_TPM,
+    max_concurrency=AI_MAX_CONCURRENCY,
+    max_queue_size=AI_MAX_QUEUE_SIZE,
+    notify_position=AI_QUEUE_NOTIFY_POSITION,
+)
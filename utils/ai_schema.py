@@ -0,0 +1,87 @@
+# utils/ai_schema.py
+from typing import Any, Dict
+
+# Схема ответа для режима структурированного вывода Gemini (response_mime_type="application/json").
+# Повторяет спецификацию JSON из текстового промпта (см. _PROMPT_TEXT_JSON_SPEC в utils/ai_integration.py):
+# форму ответа гарантирует сама модель, поэтому в промпте остается только смысл полей.
+# Формат - подмножество OpenAPI, которое принимает Gemini (типы в верхнем регистре, nullable вместо null-типа).
+
+RECOMMENDATION_TYPES = ["route", "hotel", "museum", "restaurant", "event", "activity"]
+
+_NULLABLE_STRING: Dict[str, Any] = {"type": "STRING", "nullable": True}
+
+_COORDINATES_SCHEMA: Dict[str, Any] = {
+    "type": "ARRAY",
+    "items": {"type": "NUMBER"},
+    "nullable": True,
+    "description": "[широта, долгота]",
+}
+
+_ROUTE_STOP_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "name": {"type": "STRING"},
+        "coordinates": _COORDINATES_SCHEMA,
+        "description": _NULLABLE_STRING,
+    },
+    "required": ["name"],
+}
+
+# Все поля details необязательны: модель заполняет те, что относятся к типу рекомендации
+_DETAILS_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "route_type": {"type": "STRING"},
+        "stops": {"type": "ARRAY", "items": _ROUTE_STOP_SCHEMA},
+        "stars": {"type": "INTEGER", "nullable": True},
+        "amenities": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "cuisine_type": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "average_bill": {"type": "STRING"},
+        "event_dates": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "ticket_info": {"type": "STRING"},
+    },
+}
+
+_RECOMMENDATION_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "id": {"type": "STRING"},
+        "type": {"type": "STRING", "enum": RECOMMENDATION_TYPES},
+        "name": {"type": "STRING"},
+        "address": _NULLABLE_STRING,
+        "coordinates": _COORDINATES_SCHEMA,
+        "description": {"type": "STRING"},
+        "details": _DETAILS_SCHEMA,
+        "distance_or_time": _NULLABLE_STRING,
+        "price_estimate": _NULLABLE_STRING,
+        "rating": {"type": "NUMBER", "nullable": True},
+        "opening_hours": _NULLABLE_STRING,
+        "booking_link": _NULLABLE_STRING,
+        "images": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["id", "type", "name", "description", "details", "images"],
+}
+
+RECOMMENDATIONS_RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "structured_recommendations": {
+            "type": "OBJECT",
+            "properties": {
+                "query_summary": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "location_interpreted": {"type": "STRING"},
+                        "trip_days": _NULLABLE_STRING,
+                        "main_interests": {"type": "ARRAY", "items": {"type": "STRING"}},
+                    },
+                    "required": ["location_interpreted", "main_interests"],
+                },
+                "recommendations": {"type": "ARRAY", "items": _RECOMMENDATION_SCHEMA},
+            },
+            "required": ["query_summary", "recommendations"],
+        },
+        "textual_summary": {"type": "STRING"},
+    },
+    "required": ["structured_recommendations", "textual_summary"],
+}
@@ -0,0 +1,248 @@
+# utils/card_renderer.py
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.localization import get_text
+
+try:  # orjson сериализует ключ кэша в несколько раз быстрее стандартного json
+    import orjson
+
+    def _fingerprint_bytes(fields: Dict[str, Any]) -> bytes:
+        try:
+            return orjson.dumps(fields, option=orjson.OPT_SORT_KEYS, default=str)
+        except TypeError:  # Нестроковые ключи в details и т.п. - редкость, считаем через json
+            return json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+except ImportError:
+    def _fingerprint_bytes(fields: Dict[str, Any]) -> bytes:
+        return json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+
+# Сколько отрендеренных карточек (рекомендация + язык) держать в памяти
+CARD_RENDER_CACHE_SIZE = int(os.getenv("CARD_RENDER_CACHE_SIZE", "5000"))
+
+_TYPE_ICONS = {"route": "🗺️", "hotel": "🏨", "museum": "🏛️", "restaurant": "🍽️", "event": "🎉",
+               "activity": "🤸", "transport_option": "🚌"}
+
+# Поля рекомендации, от которых зависит текст карточки (id, картинки и ссылки на него не влияют)
+_RENDERED_FIELDS = ("type", "name", "address", "description", "details", "distance_or_time", "price_estimate",
+                    "rating", "opening_hours")
+
+# Ключи локализации, которые подставляются в карточку; в шаблоне хранятся уже готовые HTML-префиксы
+_LABEL_KEYS = ("text_address", "text_details_header", "detail_route_type", "detail_stops", "detail_hotel_stars",
+               "detail_hotel_amenities", "detail_restaurant_cuisine", "detail_restaurant_avg_bill",
+               "detail_event_dates", "detail_ticket_info", "text_distance_time", "text_price", "text_rating",
+               "text_opening_hours")
+
+
+def _is_text(value: Any) -> bool:
+    """Непустая строка, не равная "null" (модель иногда присылает null строкой)."""
+    return bool(value) and isinstance(value, str) and value.lower() != "null" and value.strip() != ""
+
+
+class CardTemplate:
+    """Скомпилированный шаблон карточки для пары (язык, тип рекомендации)."""
+
+    __slots__ = ("icon", "no_name", "labels", "and_more", "details_header", "detail_renderer")
+
+    def __init__(self, lang: str, rec_type: Any,
+                 detail_renderer: Optional[Callable[[Dict[str, Any], "CardTemplate"], List[str]]]):
+        self.icon = _TYPE_ICONS.get(rec_type, "⭐")
+        self.no_name = get_text("text_no_name", lang)
+        self.labels = {key: f"<b>{get_text(key, lang)}:</b> " for key in _LABEL_KEYS}
+        self.and_more = get_text("text_and_more", lang)
+        self.details_header = f"\n<b>{get_text('text_details_header', lang)}:</b>\n"
+        self.detail_renderer = detail_renderer
+
+
+def _route_details(details: Dict[str, Any], template: CardTemplate) -> List[str]:
+    parts = []
+    route_type_val = details.get("route_type")
+    if route_type_val and isinstance(route_type_val, str) and route_type_val.strip():
+        parts.append(template.labels["detail_route_type"] + route_type_val)
+    stops_list = details.get("stops")
+    if stops_list and isinstance(stops_list, list):
+        stops_names = [s['name'] for s in stops_list[:3] if isinstance(s, dict) and s.get("name")]
+        if stops_names:
+            stops_text = " → ".join(stops_names)
+            if len(stops_list) > 3:
+                stops_text += f" {template.and_more}"
+            parts.append(template.labels["detail_stops"] + stops_text)
+    return parts
+
+
+def _hotel_details(details: Dict[str, Any], template: CardTemplate) -> List[str]:
+    parts = []
+    stars_value = details.get("stars")
+    if stars_value is not None and str(stars_value).lower() != 'null':
+        try:
+            stars_num = int(stars_value)
+            if 0 < stars_num <= 5:
+                parts.append(f"{template.labels['detail_hotel_stars']}{'⭐' * stars_num} ({stars_num})")
+            elif stars_num != 0:
+                parts.append(f"{template.labels['detail_hotel_stars']}{stars_value}")
+        except (ValueError, TypeError):
+            if isinstance(stars_value, str) and stars_value.strip():
+                parts.append(f"{template.labels['detail_hotel_stars']}{stars_value}")
+    amenities = details.get("amenities")
+    if amenities and isinstance(amenities, list):
+        amenities_text = ", ".join(amenities[:4])
+        if len(amenities) > 4:
+            amenities_text += f" {template.and_more}"
+        parts.append(template.labels["detail_hotel_amenities"] + amenities_text)
+    return parts
+
+
+def _list_or_text(value: Any) -> Optional[str]:
+    """Список через запятую или строка (кроме "null"); None - если выводить нечего."""
+    if not value:
+        return None
+    if isinstance(value, list):
+        return ", ".join(value)
+    if isinstance(value, str) and value.strip() and value.lower() != 'null':
+        return value
+    return None
+
+
+def _restaurant_details(details: Dict[str, Any], template: CardTemplate) -> List[str]:
+    parts = []
+    cuisines = _list_or_text(details.get("cuisine_type"))
+    if cuisines is not None:
+        parts.append(template.labels["detail_restaurant_cuisine"] + cuisines)
+    average_bill = details.get("average_bill")
+    if _is_text(average_bill):
+        parts.append(template.labels["detail_restaurant_avg_bill"] + average_bill)
+    return parts
+
+
+def _ticket_details(details: Dict[str, Any], template: CardTemplate) -> List[str]:
+    ticket_info = details.get("ticket_info")
+    if _is_text(ticket_info):
+        return [template.labels["detail_ticket_info"] + ticket_info]
+    return []
+
+
+def _event_details(details: Dict[str, Any], template: CardTemplate) -> List[str]:
+    parts = []
+    event_dates = _list_or_text(details.get("event_dates"))
+    if event_dates is not None:
+        parts.append(template.labels["detail_event_dates"] + event_dates)
+    return parts + _ticket_details(details, template)
+
+
+_DETAIL_RENDERERS: Dict[str, Callable[[Dict[str, Any], CardTemplate], List[str]]] = {
+    "route": _route_details,
+    "hotel": _hotel_details,
+    "restaurant": _restaurant_details,
+    "event": _event_details,
+    "museum": _ticket_details,
+    "activity": _ticket_details,
+}
+
+
+class CardRenderer:
+    """
+    Рендерер HTML-текста карточки рекомендации.
+    Шаблоны (локализованные подписи и набор полей деталей) компилируются один раз на пару
+    (язык, тип), а готовый текст запоминается в ограниченном LRU по хэшу содержимого
+    рекомендации и языку: одна и та же рекомендация из кэша/каталога рендерится один раз.
+    """
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self._templates: Dict[Tuple[str, Any], CardTemplate] = {}
+        self._rendered: "OrderedDict[Tuple[str, bytes], str]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "templates_compiled": 0}
+
+    def _template(self, lang: str, rec_type: Any) -> CardTemplate:
+        # Неизвестные типы делят один шаблон, чтобы произвольные строки от модели не раздували словарь
+        key = (lang, rec_type if isinstance(rec_type, str) and rec_type in _TYPE_ICONS else None)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = CardTemplate(lang, key[1], _DETAIL_RENDERERS.get(key[1]))
+            self.stats["templates_compiled"] += 1
+        return template
+
+    def render(self, recommendation: Dict[str, Any], lang: str = "ru") -> str:
+        fields = {field: recommendation[field] for field in _RENDERED_FIELDS if field in recommendation}
+        cache_key = (lang, hashlib.blake2b(_fingerprint_bytes(fields), digest_size=16).digest())
+        text = self._rendered.get(cache_key)
+        if text is not None:
+            self._rendered.move_to_end(cache_key)
+            self.stats["hits"] += 1
+            return text
+
+        self.stats["misses"] += 1
+        text = self._render(recommendation, lang)
+        self._rendered[cache_key] = text
+        if len(self._rendered) > self.max_entries:
+            self._rendered.popitem(last=False)
+        return text
+
+    def _render(self, recommendation: Dict[str, Any], lang: str) -> str:
+        rec_type = recommendation.get("type", "unknown")
+        template = self._template(lang, rec_type)
+        labels = template.labels
+        name_from_ai = recommendation.get('name', template.no_name)
+        text_parts = [f"<b>{template.icon}: {name_from_ai}</b>"]
+
+        address = recommendation.get('address')
+        if _is_text(address):
+            text_parts.append(f"📍 {labels['text_address']}{address}")
+        description = recommendation.get('description')
+        if description and isinstance(description, str) and description.strip() != "":
+            text_parts.append(f"📝 <i>{description}</i>")
+
+        details = recommendation.get("details")
+        if template.detail_renderer and details and isinstance(details, dict):
+            detail_str_parts = template.detail_renderer(details, template)
+            if detail_str_parts:
+                text_parts.append(template.details_header + "\n".join([f"  • {d}" for d in detail_str_parts]))
+
+        dist_time = recommendation.get('distance_or_time')
+        if _is_text(dist_time):
+            text_parts.append(f"🚗/🚶 {labels['text_distance_time']}{dist_time}")
+        price_est = recommendation.get('price_estimate')
+        if _is_text(price_est):
+            text_parts.append(f"💰 {labels['text_price']}{price_est}")
+        rating_text = self._rating_text(recommendation.get('rating'))
+        if rating_text is not None:
+            text_parts.append(f"🌟 {labels['text_rating']}{rating_text}")
+        opening_hours = recommendation.get('opening_hours')
+        if _is_text(opening_hours):
+            text_parts.append(f"⏰ {labels['text_opening_hours']}{opening_hours}")
+        return "\n\n".join(text_parts)
+
+    @staticmethod
+    def _rating_text(rating_val: Any) -> Optional[str]:
+        if rating_val is None or str(rating_val).lower() == "null":
+            return None
+        try:
+            rating_float = float(rating_val)
+        except (ValueError, TypeError):
+            if isinstance(rating_val, str) and rating_val.strip() and rating_val.strip().lower() != "null":
+                return rating_val
+            return None
+        if rating_float > 0:
+            return f"{rating_float:.1f}/5"
+        if isinstance(rating_val, str) and rating_val.strip() and rating_val.strip().lower() not in ["0", "0.0",
+                                                                                                     "null"]:
+            return rating_val
+        return None
+
+    def clear(self) -> None:
+        """Сбрасывает шаблоны и готовые карточки (например, после изменения текстов локализации)."""
+        self._templates.clear()
+        self._rendered.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / total if total else 0.0,
+            "cached_cards": len(self._rendered),
+        }
+
+
+card_renderer = CardRenderer(max_entries=CARD_RENDER_CACHE_SIZE)
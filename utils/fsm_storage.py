@@ -0,0 +1,151 @@
+# utils/fsm_storage.py
+import json
+import logging
+import os
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+try:
+    from redis.asyncio import Redis
+except ImportError:  # redis нужен только для FSM_STORAGE=redis
+    Redis = None
+
+try:  # msgpack компактнее и быстрее json; без него значения пишутся в json
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# memory - состояние в памяти процесса (один воркер), redis - общее для всех воркеров и переживает перезапуск
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory").lower()
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+FSM_REDIS_PREFIX = os.getenv("FSM_REDIS_PREFIX", "fsm")
+# TTL записей: брошенные на полпути сессии планирования не копятся в Redis вечно (0 - без TTL)
+FSM_STATE_TTL_SECONDS = int(os.getenv("FSM_STATE_TTL_SECONDS", "86400"))
+FSM_DATA_TTL_SECONDS = int(os.getenv("FSM_DATA_TTL_SECONDS", "2592000"))
+
+# Первый байт значения - кодек, так что воркеры с msgpack и без него читают данные друг друга
+_MSGPACK_MARK = b"m"
+_JSON_MARK = b"j"
+
+
+def encode_value(value: Any) -> bytes:
+    if msgpack is not None:
+        try:
+            return _MSGPACK_MARK + msgpack.packb(value, use_bin_type=True)
+        except (TypeError, ValueError, OverflowError):
+            pass  # Например, int больше 64 бит - такое json запишет
+    return _JSON_MARK + json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_value(raw: bytes) -> Any:
+    mark, payload = raw[:1], raw[1:]
+    if mark == _MSGPACK_MARK:
+        if msgpack is None:
+            raise RuntimeError("Значение FSM записано в msgpack, но пакет msgpack не установлен")
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    return json.loads(payload.decode("utf-8"))
+
+
+class CompactRedisStorage(BaseStorage):
+    """
+    FSM хранилище в Redis с компактной сериализацией.
+    Состояние - строка "<prefix>:...:state", данные - хэш "<prefix>:...:data", где каждый ключ данных
+    хранится отдельным полем (msgpack, иначе json). Благодаря этому update_data записывает только
+    переданные ключи (HSET) и вместе с продлением TTL и чтением результата укладывается в один
+    pipeline - один сетевой запрос вместо get + set целого словаря.
+    """
+
+    def __init__(self, redis: "Redis", key_builder: Optional[KeyBuilder] = None,
+                 state_ttl: Optional[int] = None, data_ttl: Optional[int] = None):
+        self.redis = redis
+        self.key_builder = key_builder or DefaultKeyBuilder(prefix=FSM_REDIS_PREFIX)
+        self.state_ttl = state_ttl or None
+        self.data_ttl = data_ttl or None
+        self.stats: Dict[str, int] = {"reads": 0, "writes": 0, "bytes_written": 0}
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs: Any) -> "CompactRedisStorage":
+        if Redis is None:
+            raise RuntimeError("Для FSM_STORAGE=redis нужен пакет redis (pip install redis)")
+        return cls(Redis.from_url(url), **kwargs)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        redis_key = self.key_builder.build(key, "state")
+        self.stats["writes"] += 1
+        if state is None:
+            await self.redis.delete(redis_key)
+            return
+        await self.redis.set(redis_key, state.state if isinstance(state, State) else state, ex=self.state_ttl)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        self.stats["reads"] += 1
+        value = await self.redis.get(self.key_builder.build(key, "state"))
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    def _encode_fields(self, data: Mapping[str, Any]) -> Dict[str, bytes]:
+        fields = {str(name): encode_value(value) for name, value in data.items()}
+        self.stats["bytes_written"] += sum(len(value) for value in fields.values())
+        return fields
+
+    @staticmethod
+    def _decode_fields(raw: Mapping[Any, bytes]) -> Dict[str, Any]:
+        return {(name.decode("utf-8") if isinstance(name, bytes) else name): decode_value(value)
+                for name, value in raw.items()}
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        redis_key = self.key_builder.build(key, "data")
+        self.stats["writes"] += 1
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(redis_key)
+            if data:
+                pipe.hset(redis_key, mapping=self._encode_fields(data))
+                if self.data_ttl:
+                    pipe.expire(redis_key, self.data_ttl)
+            await pipe.execute()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        self.stats["reads"] += 1
+        return self._decode_fields(await self.redis.hgetall(self.key_builder.build(key, "data")))
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Any = None) -> Any:
+        self.stats["reads"] += 1
+        raw = await self.redis.hget(self.key_builder.build(storage_key, "data"), dict_key)
+        return default if raw is None else decode_value(raw)
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        redis_key = self.key_builder.build(key, "data")
+        self.stats["writes"] += 1
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if data:
+                pipe.hset(redis_key, mapping=self._encode_fields(data))
+                if self.data_ttl:
+                    pipe.expire(redis_key, self.data_ttl)
+            pipe.hgetall(redis_key)
+            results = await pipe.execute()
+        return self._decode_fields(results[-1])
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "codec": "msgpack" if msgpack is not None else "json"}
+
+
+def create_fsm_storage() -> BaseStorage:
+    """Хранилище FSM по FSM_STORAGE: memory (по умолчанию) или redis (FSM_REDIS_URL)."""
+    if FSM_STORAGE == "redis":
+        try:
+            storage = CompactRedisStorage.from_url(FSM_REDIS_URL, state_ttl=FSM_STATE_TTL_SECONDS,
+                                                   data_ttl=FSM_DATA_TTL_SECONDS)
+        except (RuntimeError, ValueError) as e:
+            logging.error(f"FSM Storage: Не удалось создать Redis хранилище: {e}. Используется MemoryStorage.")
+            return MemoryStorage()
+        logging.info(f"FSM Storage: Redis хранилище ({FSM_REDIS_URL.rsplit('@', 1)[-1]}, "
+                     f"сериализация {'msgpack' if msgpack is not None else 'json'}).")
+        return storage
+    if FSM_STORAGE != "memory":
+        logging.warning(f"FSM Storage: Неизвестное значение FSM_STORAGE='{FSM_STORAGE}'. Используется MemoryStorage.")
+    return MemoryStorage()
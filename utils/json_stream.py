@@ -0,0 +1,134 @@
+# utils/json_stream.py
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+
+class RecommendationStreamParser:
+    """
+    Инкрементальный разборщик ответа Gemini вида
+    {"structured_recommendations": {"recommendations": [{...}, {...}]}, "textual_summary": "..."}.
+
+    Текст подается кусками через feed(); как только очередной объект из массива
+    structured_recommendations.recommendations закрывается, он разбирается и возвращается.
+    Весь накопленный текст доступен в .text для финального разбора документа целиком.
+    Текст до первой "{" (например, обертка ```json) пропускается.
+    """
+
+    RECOMMENDATIONS_KEY = "recommendations"
+    RECOMMENDATIONS_DEPTH = 2  # {"structured_recommendations": {"recommendations": [...]}}
+
+    def __init__(self):
+        self._buffer: List[str] = []
+        self._text = ""
+        self._pos = 0
+        self._started = False
+        self._finished = False
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        # Стек открытых контейнеров: dict(kind='obj'|'arr', key, expect_key, rec_array, item_start)
+        self._frames: List[Dict[str, Any]] = []
+        self.emitted_count = 0
+
+    @property
+    def text(self) -> str:
+        if self._buffer:
+            self._text += "".join(self._buffer)
+            self._buffer = []
+        return self._text
+
+    @property
+    def finished(self) -> bool:
+        """True, если корневой JSON объект уже закрыт."""
+        return self._finished
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """Добавляет кусок текста и возвращает рекомендации, завершившиеся в этом куске."""
+        self._buffer.append(chunk)
+        text = self.text
+        completed: List[Dict[str, Any]] = []
+
+        pos = self._pos
+        length = len(text)
+        while pos < length and not self._finished:
+            ch = text[pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._on_string_end(text, pos)
+                pos += 1
+                continue
+
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._frames.append(self._new_frame("obj"))
+                pos += 1
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif ch == "{":
+                self._on_container_open("obj", pos)
+            elif ch == "[":
+                self._on_container_open("arr", pos)
+            elif ch in "}]":
+                item = self._on_container_close(text, pos)
+                if item is not None:
+                    completed.append(item)
+            elif ch == ":":
+                if self._frames and self._frames[-1]["kind"] == "obj":
+                    self._frames[-1]["expect_key"] = False
+            elif ch == ",":
+                if self._frames and self._frames[-1]["kind"] == "obj":
+                    self._frames[-1]["expect_key"] = True
+            pos += 1
+
+        self._pos = pos
+        self.emitted_count += len(completed)
+        return completed
+
+    @staticmethod
+    def _new_frame(kind: str, rec_array: bool = False, item_start: Optional[int] = None) -> Dict[str, Any]:
+        return {"kind": kind, "key": None, "expect_key": kind == "obj", "rec_array": rec_array,
+                "item_start": item_start}
+
+    def _on_string_end(self, text: str, pos: int) -> None:
+        frame = self._frames[-1] if self._frames else None
+        if frame is not None and frame["kind"] == "obj" and frame["expect_key"]:
+            try:
+                frame["key"] = json.loads(text[self._string_start:pos + 1])
+            except json.JSONDecodeError:
+                frame["key"] = None
+
+    def _on_container_open(self, kind: str, pos: int) -> None:
+        parent = self._frames[-1] if self._frames else None
+        rec_array = (
+                kind == "arr" and parent is not None and parent["kind"] == "obj"
+                and parent["key"] == self.RECOMMENDATIONS_KEY and len(self._frames) == self.RECOMMENDATIONS_DEPTH
+        )
+        item_start = pos if (kind == "obj" and parent is not None and parent["rec_array"]) else None
+        self._frames.append(self._new_frame(kind, rec_array=rec_array, item_start=item_start))
+
+    def _on_container_close(self, text: str, pos: int) -> Optional[Dict[str, Any]]:
+        if not self._frames:
+            return None
+        frame = self._frames.pop()
+        if not self._frames:
+            self._finished = True
+        if frame["item_start"] is None:
+            return None
+        raw_item = text[frame["item_start"]:pos + 1]
+        try:
+            item = json.loads(raw_item)
+        except json.JSONDecodeError as e:
+            logging.warning(f"JSON Stream: Не удалось разобрать завершенную рекомендацию: {e}. Фрагмент: {raw_item[:300]}")
+            return None
+        return item if isinstance(item, dict) else None
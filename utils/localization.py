@@ -118,6 +118,11 @@ TRANSLATIONS: Dict[str, Dict[str, str]] = {
         "en": "Got it, thanks for your feedback.",
         "fr": "Compris, merci pour votre avis."
     },
+    "album_keyboard_text": {
+        "ru": "Оцените варианты из подборки выше:\n{recommendations}",
+        "en": "Rate the options from the album above:\n{recommendations}",
+        "fr": "Évaluez les options de l'album ci-dessus :\n{recommendations}"
+    },
     "text_no_name": {"ru": "Без названия", "en": "No Name", "fr": "Sans Nom"},
     "text_address": {"ru": "Адрес", "en": "Address", "fr": "Adresse"},
     "text_details_header": {"ru": "Детали", "en": "Details", "fr": "Détails"},
@@ -157,6 +162,31 @@ TRANSLATIONS: Dict[str, Dict[str, str]] = {
         "en": "An unexpected error occurred while contacting AI: {error_type}. Please inform the developer.",
         "fr": "Une erreur inattendue s'est produite lors de la communication avec l'IA : {error_type}. Veuillez informer le développeur."
     },
+    "ai_overloaded_text": {
+        "ru": "⏳ Сейчас очень много запросов к AI. Пожалуйста, попробуйте через минуту.",
+        "en": "⏳ The AI is very busy right now. Please try again in a minute.",
+        "fr": "⏳ L'IA est très sollicitée en ce moment. Veuillez réessayer dans une minute."
+    },
+    "ai_unavailable_text": {
+        "ru": "⚠️ Сервис AI временно недоступен. Пожалуйста, попробуйте через пару минут.",
+        "en": "⚠️ The AI service is temporarily unavailable. Please try again in a couple of minutes.",
+        "fr": "⚠️ Le service d'IA est temporairement indisponible. Veuillez réessayer dans quelques minutes."
+    },
+    "ai_queue_position_text": {
+        "ru": "⏳ Сейчас много запросов. Вы №{position} в очереди — рекомендации скоро будут готовы.",
+        "en": "⏳ Lots of requests right now. You're #{position} in line — your recommendations are coming soon.",
+        "fr": "⏳ Beaucoup de demandes en ce moment. Vous êtes n°{position} dans la file — vos recommandations arrivent bientôt."
+    },
+    "request_in_progress_text": {
+        "ru": "⏳ Уже подбираю рекомендации по вашему запросу — они появятся здесь через несколько секунд.",
+        "en": "⏳ Already working on your request — the recommendations will appear here in a few seconds.",
+        "fr": "⏳ Votre demande est déjà en cours — les recommandations apparaîtront ici dans quelques secondes."
+    },
+    "catalog_summary_text": {
+        "ru": "Вот подборка проверенных вариантов для направления «{location}». Цены и часы работы рекомендуем уточнять на официальных сайтах.",
+        "en": "Here is a selection of proven options for «{location}». We recommend checking prices and opening hours on the official websites.",
+        "fr": "Voici une sélection d'options éprouvées pour « {location} ». Nous vous recommandons de vérifier les prix et les horaires sur les sites officiels."
+    },
     "no_recommendations_in_response_text": {
         "ru": "К сожалению, в полученном ответе от AI нет раздела 'recommendations'.",
         "en": "Unfortunately, the AI response does not contain a 'recommendations' section.",
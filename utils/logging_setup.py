@@ -0,0 +1,200 @@
+# utils/logging_setup.py
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from typing import Any, Dict, Optional
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# json - одна JSON запись на строку (для сборщиков логов), text - прежний человекочитаемый формат
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_FILE = os.getenv("LOG_FILE")  # Дополнительно писать в файл (ротация по размеру)
+LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_FILE_BACKUP_COUNT = int(os.getenv("LOG_FILE_BACKUP_COUNT", "5"))
+# Записи, не поместившиеся в очередь (вывод не успевает), отбрасываются, а не блокируют event loop
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Больше этого числа символов большие данные (state, запросы к AI, ответы модели) в лог не попадают
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+# Доля записей, в которые большие данные попадают целиком (до LOG_PAYLOAD_MAX_CHARS); в остальных - только сводка
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+
+_TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Стандартные атрибуты LogRecord - все остальное пришло через extra={...} и попадает в JSON как есть
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime",
+                                                                                    "taskName"}
+_SAFE_ARG_TYPES = (str, int, float, bool, type(None))
+
+
+class LogPayload:
+    """
+    Ленивое представление больших данных для аргументов лога:
+        logging.info("Данные запроса: %s", LogPayload(request_data))
+    Сериализация и обрезка выполняются только если запись действительно пишется - и уже в потоке
+    записи логов, а не в event loop. Верхний уровень словаря/списка копируется при создании,
+    чтобы последующие изменения в хэндлере не попали в запись задним числом.
+    """
+
+    __slots__ = ("value", "max_chars", "sample_rate")
+
+    def __init__(self, value: Any, max_chars: Optional[int] = None, sample_rate: Optional[float] = None):
+        if isinstance(value, dict):
+            value = dict(value)
+        elif isinstance(value, list):
+            value = list(value)
+        self.value = value
+        self.max_chars = LOG_PAYLOAD_MAX_CHARS if max_chars is None else max_chars
+        self.sample_rate = LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    def _summary(self) -> str:
+        if isinstance(self.value, dict):
+            return f"<dict: {len(self.value)} ключей: {', '.join(map(str, list(self.value)[:20]))}>"
+        if isinstance(self.value, (list, tuple, set)):
+            return f"<{type(self.value).__name__}: {len(self.value)} элементов>"
+        if isinstance(self.value, str):
+            return f"<str: {len(self.value)} символов>"
+        return f"<{type(self.value).__name__}>"
+
+    def __str__(self) -> str:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return self._summary()
+        if isinstance(self.value, str):
+            text = self.value.strip()
+        else:
+            try:
+                text = json.dumps(self.value, ensure_ascii=False, default=str)
+            except (TypeError, ValueError):
+                text = repr(self.value)
+        if len(text) > self.max_chars:
+            return f"{text[:self.max_chars]}... (+{len(text) - self.max_chars} символов)"
+        return text
+
+    __repr__ = __str__
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись как одну строку JSON: время, уровень, логгер, сообщение, исключение и extra поля."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRS and not name.startswith("_"):
+                entry[name] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не форматирует запись в вызывающем потоке: в очередь уходит сам LogRecord,
+    а getMessage(), сериализация LogPayload, трейсбеки и запись в поток/файл выполняются в потоке QueueListener.
+    Считает, сколько времени логирование отнимает у вызывающего потока (event loop).
+    """
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]"):
+        super().__init__(log_queue)
+        self.stats: Dict[str, Any] = {"records": 0, "dropped": 0, "eager_formats": 0, "emit_seconds": 0.0,
+                                      "max_emit_seconds": 0.0, "max_queue_depth": 0}
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Изменяемые аргументы (dict/list и т.п.) могут поменяться до записи - их форматируем сразу.
+        # Строки, числа и LogPayload (сам копирует данные) безопасно форматировать позже.
+        args = record.args
+        if args and not all(isinstance(arg, _SAFE_ARG_TYPES + (LogPayload,))
+                            for arg in (args.values() if isinstance(args, dict) else args)):
+            record.msg = record.getMessage()
+            record.args = None
+            self.stats["eager_formats"] += 1
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def emit(self, record: logging.LogRecord) -> None:
+        started = time.perf_counter()
+        try:
+            self.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+        elapsed = time.perf_counter() - started
+        self.stats["records"] += 1
+        self.stats["emit_seconds"] += elapsed
+        if elapsed > self.stats["max_emit_seconds"]:
+            self.stats["max_emit_seconds"] = elapsed
+        depth = self.queue.qsize()
+        if depth > self.stats["max_queue_depth"]:
+            self.stats["max_queue_depth"] = depth
+
+    def get_stats(self) -> Dict[str, Any]:
+        records = self.stats["records"]
+        return {
+            **self.stats,
+            "avg_emit_us": self.stats["emit_seconds"] / records * 1e6 if records else 0.0,
+            "queue_depth": self.queue.qsize(),
+        }
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+log_handler: Optional[AsyncQueueHandler] = None
+
+
+def setup_logging() -> AsyncQueueHandler:
+    """
+    Настраивает корневой логгер: все записи идут через очередь в фоновый поток, который форматирует
+    (LOG_FORMAT=json|text) и пишет их в stderr и, если задан LOG_FILE, в файл. Повторный вызов ничего не делает.
+    """
+    global _listener, log_handler
+    if log_handler is not None:
+        return log_handler
+
+    formatter: logging.Formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(_TEXT_FORMAT)
+    output_handlers = [logging.StreamHandler(sys.stderr)]
+    if LOG_FILE:
+        log_dir = os.path.dirname(LOG_FILE)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        output_handlers.append(logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT, encoding="utf-8"))
+    for handler in output_handlers:
+        handler.setFormatter(formatter)
+
+    log_handler = AsyncQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _listener = logging.handlers.QueueListener(log_handler.queue, *output_handlers, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(log_handler)
+    root.setLevel(LOG_LEVEL)
+    atexit.register(shutdown_logging)  # Зарегистрирован после logging.shutdown, поэтому выполнится раньше него
+    return log_handler
+
+
+def shutdown_logging() -> None:
+    """Дописывает оставшиеся в очереди записи и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_stats() -> Dict[str, Any]:
+    return log_handler.get_stats() if log_handler is not None else {}
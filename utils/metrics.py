@@ -0,0 +1,261 @@
+# utils/metrics.py
+import logging
+import os
+import re
+import time
+import weakref
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:  # aiohttp нужен только для HTTP эндпоинта /metrics
+    from aiohttp import web
+except ImportError:
+    web = None
+
+# Порт эндпоинта /metrics в формате Prometheus (0 - не поднимать). Воркеры webhook используют METRICS_PORT + 1 + N.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# По умолчанию эндпоинт доступен только локально (сборщик метрик на той же машине или через туннель)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PREFIX = "travel_bot"
+
+# Границы бакетов (секунды): быстрые операции (БД, Bot API, хэндлеры без AI) и запросы к AI
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+AI_BUCKETS = (0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0)
+# Границы для размеров промпта/ответа AI (символы)
+SIZE_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+_INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+LabelValues = Tuple[str, ...]
+
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Монотонный счетчик с метками."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами и метками (как prometheus_client.Histogram, без зависимостей)."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = FAST_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Метки -> [счетчики по бакетам (последний - +Inf), сумма]
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик процесса. Кроме собственных счетчиков и гистограмм отдает в /metrics
+    статистику компонентов (их get_stats()) как gauge: числовые значения - как есть,
+    вложенные словари - с меткой key, строковые (например, состояние предохранителя) - меткой value.
+    """
+
+    def __init__(self, prefix: str = METRICS_PREFIX):
+        self.prefix = prefix
+        self._metrics: Dict[str, Any] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self.stats: Dict[str, int] = {"scrapes": 0, "collector_errors": 0}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self._metrics:
+            self._metrics[full_name] = Counter(full_name, documentation, labelnames)
+        return self._metrics[full_name]
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = FAST_BUCKETS) -> Histogram:
+        full_name = f"{self.prefix}_{name}"
+        if full_name not in self._metrics:
+            self._metrics[full_name] = Histogram(full_name, documentation, labelnames, buckets)
+        return self._metrics[full_name]
+
+    def add_collector(self, name: str, get_stats: Callable[[], Dict[str, Any]]) -> None:
+        """Регистрирует get_stats() компонента; вызывается при каждом запросе /metrics."""
+        self._collectors[name] = get_stats
+
+    def _render_collector(self, name: str, stats: Dict[str, Any]) -> List[str]:
+        samples: Dict[str, List[str]] = {}
+
+        def add(metric: str, labels: str, value: Any) -> None:
+            metric_name = _INVALID_NAME_CHARS.sub("_", f"{self.prefix}_{name}_{metric}")
+            samples.setdefault(metric_name, []).append(f"{metric_name}{labels} {_format_value(value)}")
+
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                add(key, "", int(value))
+            elif isinstance(value, (int, float)):
+                add(key, "", value)
+            elif isinstance(value, str):
+                add(key, _format_labels(("value",), (value,)), 1)
+            elif isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    label = _format_labels(("key",), (sub_key,))
+                    if isinstance(sub_value, (int, float)) and not isinstance(sub_value, bool):
+                        add(key, label, sub_value)
+                    elif isinstance(sub_value, dict):  # Например, здоровье каждой модели в маршрутизаторе
+                        for leaf, leaf_value in sub_value.items():
+                            if isinstance(leaf_value, (int, float)) and not isinstance(leaf_value, bool):
+                                add(f"{key}_{leaf}", label, leaf_value)
+        lines = []
+        for metric_name, metric_samples in samples.items():
+            lines.append(f"# TYPE {metric_name} gauge")
+            lines.extend(metric_samples)
+        return lines
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus (version 0.0.4)."""
+        self.stats["scrapes"] += 1
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for name, get_stats in self._collectors.items():
+            try:
+                stats = get_stats()
+            except Exception as e:
+                self.stats["collector_errors"] += 1
+                logging.error(f"Metrics: Ошибка сбора статистики '{name}': {e}")
+                continue
+            lines.extend(self._render_collector(name, stats or {}))
+        return "\n".join(lines) + "\n"
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "metrics": len(self._metrics), "collectors": len(self._collectors)}
+
+
+metrics = MetricsRegistry()
+
+# --- Метрики, которые пишут хэндлеры и интеграции ---
+
+handler_duration = metrics.histogram(
+    "handler_duration_seconds", "Длительность обработки апдейта хэндлером",
+    ("event_type", "handler", "outcome"))
+ai_request_duration = metrics.histogram(
+    "ai_request_duration_seconds", "Длительность запроса к Gemini (от отправки до последнего фрагмента)",
+    ("model", "mode", "outcome"), buckets=AI_BUCKETS)
+ai_prompt_chars = metrics.histogram(
+    "ai_prompt_chars", "Размер промпта, отправленного в Gemini (символы)", ("model",), buckets=SIZE_BUCKETS)
+ai_response_chars = metrics.histogram(
+    "ai_response_chars", "Размер текста ответа Gemini (символы)", ("model", "mode"), buckets=SIZE_BUCKETS)
+ai_response_failures = metrics.counter(
+    "ai_response_failures_total", "Ответы Gemini, которые не удалось использовать (по причине)", ("reason",))
+bot_api_duration = metrics.histogram(
+    "bot_api_duration_seconds", "Длительность вызова Telegram Bot API", ("method", "outcome"))
+db_query_duration = metrics.histogram(
+    "db_query_duration_seconds", "Длительность SQL запроса", ("operation", "outcome"))
+
+
+_instrumented_engines: "weakref.WeakSet[Any]" = weakref.WeakSet()
+
+
+def instrument_sqlalchemy_engine(engine: Any) -> None:
+    """Замеряет каждый SQL запрос движка (для AsyncEngine - через его sync_engine) в db_query_duration."""
+    from sqlalchemy import event
+
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if sync_engine in _instrumented_engines:  # У Engine нет .info (он есть только у Connection)
+        return
+    _instrumented_engines.add(sync_engine)
+
+    def operation_of(statement: str) -> str:
+        head = statement.lstrip().split(None, 1)
+        return head[0].upper() if head else "UNKNOWN"
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_query_started"].pop()
+        db_query_duration.observe(time.perf_counter() - started, operation=operation_of(statement), outcome="ok")
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(exception_context):
+        conn = exception_context.connection
+        started_stack = conn.info.get("metrics_query_started") if conn is not None else None
+        if started_stack:
+            db_query_duration.observe(time.perf_counter() - started_stack.pop(),
+                                      operation=operation_of(exception_context.statement or ""),
+                                      outcome=type(exception_context.original_exception).__name__)
+
+
+async def start_metrics_server(port: Optional[int] = None, host: str = METRICS_HOST) -> Optional[Any]:
+    """Поднимает HTTP эндпоинт /metrics. Возвращает web.AppRunner (для cleanup()) или None, если выключено."""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    if web is None:
+        logging.error("Metrics: Для METRICS_PORT нужен пакет aiohttp. Эндпоинт /metrics не запущен.")
+        return None
+
+    async def handle_metrics(request: "web.Request") -> "web.Response":
+        return web.Response(body=metrics.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logging.error(f"Metrics: Не удалось открыть {host}:{port}: {e}. Эндпоинт /metrics не запущен.")
+        await runner.cleanup()
+        return None
+    logging.info(f"Metrics: Эндпоинт Prometheus доступен на http://{host}:{port}/metrics")
+    return runner
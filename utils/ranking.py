@@ -0,0 +1,326 @@
+# utils/ranking.py
+import logging
+import os
+import re
+import time
+import zlib
+from functools import lru_cache
+from itertools import chain
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import crud
+from utils.ai_schema import RECOMMENDATION_TYPES
+from utils.ai_history import recommendation_index
+
+try:  # NumPy необязателен: без него рекомендации показываются в порядке ответа AI
+    import numpy as np
+except ImportError:
+    np = None
+
+AI_RANKING_ENABLED = os.getenv("AI_RANKING_ENABLED", "1").lower() in ("1", "true", "yes")
+# Веса слагаемых оценки: сходство с профилем лайков/дизлайков, рейтинг, близость к пользователю
+AI_RANKING_WEIGHT_PREFERENCE = float(os.getenv("AI_RANKING_WEIGHT_PREFERENCE", "1.0"))
+AI_RANKING_WEIGHT_RATING = float(os.getenv("AI_RANKING_WEIGHT_RATING", "0.3"))
+AI_RANKING_WEIGHT_DISTANCE = float(os.getenv("AI_RANKING_WEIGHT_DISTANCE", "0.3"))
+# Расстояние (км), на котором вклад близости падает в e раз
+AI_RANKING_DISTANCE_SCALE_KM = float(os.getenv("AI_RANKING_DISTANCE_SCALE_KM", "5"))
+# Кандидаты, почти совпадающие по признакам с дизлайкнутыми (косинус >= порога), отбрасываются
+AI_RANKING_DISLIKE_SIMILARITY = float(os.getenv("AI_RANKING_DISLIKE_SIMILARITY", "0.97"))
+# Сколько кандидатов оставить в любом случае, даже если все похожи на дизлайкнутые
+AI_RANKING_MIN_KEEP = int(os.getenv("AI_RANKING_MIN_KEEP", "3"))
+# Сколько рекомендаций хранить в кэше разобранных признаков (повторные кандидаты и фидбек не разбираются заново)
+AI_RANKING_FEATURE_CACHE_SIZE = int(os.getenv("AI_RANKING_FEATURE_CACHE_SIZE", "50000"))
+# Сколько последних лайков и дизлайков учитывать в профиле пользователя
+AI_RANKING_MAX_FEEDBACK = int(os.getenv("AI_RANKING_MAX_FEEDBACK", "200"))
+
+_HASH_DIM = 32  # Размерность хэшированных признаков кухни и удобств
+# Границы ценовых корзин по первому числу в price_estimate (валюта не учитывается - грубая оценка)
+_PRICE_EDGES = (20.0, 50.0, 150.0)
+_FREE_WORDS = ("бесплатно", "free", "gratuit")
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+_TYPE_OFFSET = 0
+_PRICE_OFFSET = _TYPE_OFFSET + len(RECOMMENDATION_TYPES)
+_PRICE_DIM = len(_PRICE_EDGES) + 2  # "бесплатно" + корзины
+_CUISINE_OFFSET = _PRICE_OFFSET + _PRICE_DIM
+_AMENITY_OFFSET = _CUISINE_OFFSET + _HASH_DIM
+FEATURE_DIM = _AMENITY_OFFSET + _HASH_DIM
+_TYPE_INDEX = {rec_type: i for i, rec_type in enumerate(RECOMMENDATION_TYPES)}
+
+# Разобранная рекомендация: номера ненулевых столбцов признаков и (рейтинг, широта, долгота)
+FeatureRow = Tuple[Tuple[int, ...], Tuple[float, float, float]]
+
+ranking_stats: Dict[str, float] = {"ranked": 0, "candidates": 0, "filtered": 0, "skipped_no_numpy": 0,
+                                   "skipped_no_feedback": 0, "feature_cache_hits": 0, "feature_cache_misses": 0,
+                                   "last_ms": 0.0, "max_ms": 0.0}
+
+
+def _price_bucket(price_estimate: Any) -> Optional[int]:
+    if not isinstance(price_estimate, str) or not price_estimate.strip():
+        return None
+    return _parse_price_bucket(price_estimate)
+
+
+# Строки цен и названий кухонь сильно повторяются между кандидатами - разбор и хэш кэшируются
+@lru_cache(maxsize=4096)
+def _parse_price_bucket(price_estimate: str) -> Optional[int]:
+    lowered = price_estimate.casefold()
+    if any(word in lowered for word in _FREE_WORDS):
+        return 0
+    match = _NUMBER_RE.search(lowered)
+    if not match:
+        return None
+    value = float(match.group(0).replace(",", "."))
+    return 1 + sum(1 for edge in _PRICE_EDGES if value >= edge)
+
+
+def _hashed_indices(values: Any, offset: int) -> List[int]:
+    if not isinstance(values, list):
+        return []
+    return [offset + _token_hash(v) for v in values if isinstance(v, str) and v]
+
+
+@lru_cache(maxsize=8192)
+def _token_hash(value: str) -> int:
+    return zlib.crc32(value.strip().casefold().encode("utf-8")) % _HASH_DIM
+
+
+def _coordinates(rec: Dict[str, Any]) -> Tuple[float, float]:
+    coords = rec.get("coordinates")
+    if isinstance(coords, list) and len(coords) == 2:
+        try:
+            return float(coords[0]), float(coords[1])
+        except (TypeError, ValueError):
+            pass
+    return float("nan"), float("nan")
+
+
+def _rating(rec: Dict[str, Any]) -> float:
+    try:
+        return float(rec.get("rating"))
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _feature_row(rec: Dict[str, Any]) -> FeatureRow:
+    """Разбирает рекомендацию один раз: дальше ранжирование работает только с массивами."""
+    columns: List[int] = []
+    type_index = _TYPE_INDEX.get(rec.get("type")) if isinstance(rec.get("type"), str) else None
+    if type_index is not None:
+        columns.append(_TYPE_OFFSET + type_index)
+    bucket = _price_bucket(rec.get("price_estimate"))
+    if bucket is not None:
+        columns.append(_PRICE_OFFSET + bucket)
+    details = rec.get("details")
+    if isinstance(details, dict):
+        columns.extend(_hashed_indices(details.get("cuisine_type"), _CUISINE_OFFSET))
+        columns.extend(_hashed_indices(details.get("amenities"), _AMENITY_OFFSET))
+    return tuple(columns), (_rating(rec),) + _coordinates(rec)
+
+
+class RecommendationRanker:
+    """
+    Локальное ранжирование кандидатов без обращения к AI.
+    Каждая рекомендация превращается в вектор признаков (тип, ценовая корзина, хэшированные кухни и удобства);
+    профиль пользователя - разность средних векторов лайкнутых и дизлайкнутых рекомендаций.
+    Оценка = сходство с профилем + рейтинг + близость к user_location_geo; все считается пакетно на NumPy.
+    Разбор словаря рекомендации - единственная работа на Python на каждый элемент, поэтому его результат
+    кэшируется по (id, name): одна и та же рекомендация приходит снова (каталог, фидбек, повторные
+    запросы), и тогда на кандидата остается один поиск в словаре.
+    """
+
+    def __init__(self, weight_preference: float = 1.0, weight_rating: float = 0.3, weight_distance: float = 0.3,
+                 distance_scale_km: float = 5.0, dislike_similarity: float = 0.97, min_keep: int = 3,
+                 max_feedback: int = 200, feature_cache_size: int = 50000):
+        self.weight_preference = weight_preference
+        self.weight_rating = weight_rating
+        self.weight_distance = weight_distance
+        self.distance_scale_km = distance_scale_km
+        self.dislike_similarity = dislike_similarity
+        self.min_keep = min_keep
+        self.max_feedback = max_feedback
+        self.feature_cache_size = feature_cache_size
+        # Название входит в ключ: у одной рекомендации на разных языках разные названия кухонь
+        self._feature_cache: Dict[Tuple[str, Any], FeatureRow] = {}
+
+    def _feature_rows(self, recommendations: Sequence[Dict[str, Any]]) -> List[FeatureRow]:
+        cache = self._feature_cache
+        rows: List[FeatureRow] = []
+        misses = 0
+        for rec in recommendations:
+            rec_id = rec.get("id")
+            key = (rec_id, rec.get("name"))
+            row = cache.get(key) if isinstance(rec_id, str) else None
+            if row is None:
+                row = _feature_row(rec)
+                misses += 1
+                if isinstance(rec_id, str) and self.feature_cache_size > 0:
+                    if len(cache) >= self.feature_cache_size:
+                        del cache[next(iter(cache))]  # Вытесняем самую давнюю запись
+                    cache[key] = row
+            rows.append(row)
+        ranking_stats["feature_cache_hits"] += len(rows) - misses
+        ranking_stats["feature_cache_misses"] += misses
+        return rows
+
+    @staticmethod
+    def _matrices(rows: Sequence[FeatureRow]) -> Tuple["np.ndarray", "np.ndarray"]:
+        """
+        Матрица признаков (кандидаты x FEATURE_DIM, строки нормированы по L2) и числовые поля
+        (кандидаты x [рейтинг, широта, долгота]) - обе строятся целиком, без цикла по строкам.
+        """
+        count = len(rows)
+        columns = [row[0] for row in rows]
+        lengths = np.fromiter(map(len, columns), dtype=np.int64, count=count)
+        flat_columns = np.fromiter(chain.from_iterable(columns), dtype=np.int64, count=int(lengths.sum()))
+        flat_indices = np.repeat(np.arange(count, dtype=np.int64) * FEATURE_DIM, lengths) + flat_columns
+        size = count * FEATURE_DIM
+        features = np.bincount(flat_indices, minlength=size)[:size].astype(np.float32).reshape(count, FEATURE_DIM)
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        np.divide(features, norms, out=features, where=norms > 0)
+        numeric = np.fromiter(chain.from_iterable(row[1] for row in rows), dtype=np.float64,
+                              count=count * 3).reshape(count, 3)
+        return features, numeric
+
+    def featurize(self, recommendations: Sequence[Dict[str, Any]]) -> "np.ndarray":
+        """Матрица признаков (кандидаты x FEATURE_DIM), строки нормированы по L2."""
+        return self._matrices(self._feature_rows(recommendations))[0]
+
+    def _proximity(self, coords: "np.ndarray", user_geo: Optional[Sequence[float]]) -> "np.ndarray":
+        try:
+            user_lat, user_lon = np.radians(float(user_geo[0])), np.radians(float(user_geo[1]))
+        except (TypeError, ValueError, IndexError):
+            return np.zeros(len(coords), dtype=np.float32)
+        coords = np.radians(coords)
+        # Формула гаверсинусов для всех кандидатов сразу
+        a = np.sin((coords[:, 0] - user_lat) / 2) ** 2 + \
+            np.cos(user_lat) * np.cos(coords[:, 0]) * np.sin((coords[:, 1] - user_lon) / 2) ** 2
+        distance_km = 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+        return np.nan_to_num(np.exp(-distance_km / self.distance_scale_km), nan=0.0).astype(np.float32)
+
+    def rank(self, candidates: List[Dict[str, Any]], liked: Sequence[Dict[str, Any]] = (),
+             disliked: Sequence[Dict[str, Any]] = (),
+             user_geo: Optional[Sequence[float]] = None) -> List[Dict[str, Any]]:
+        """Возвращает кандидатов, отсортированных по убыванию оценки (без почти-копий дизлайкнутых)."""
+        if np is None:
+            ranking_stats["skipped_no_numpy"] += 1
+            return candidates
+        if len(candidates) < 2 and not disliked:
+            return candidates
+
+        started_at = time.perf_counter()
+        if self.max_feedback > 0:
+            liked, disliked = liked[-self.max_feedback:], disliked[-self.max_feedback:]
+        features, numeric = self._matrices(self._feature_rows(candidates))
+        profile = np.zeros(FEATURE_DIM, dtype=np.float32)
+        if liked:
+            profile += self.featurize(liked).mean(axis=0)
+        disliked_features = self.featurize(disliked) if disliked else None
+        if disliked_features is not None:
+            profile -= disliked_features.mean(axis=0)
+
+        rating_score = np.nan_to_num((np.clip(numeric[:, 0], 1.0, 5.0) - 1.0) / 4.0, nan=0.5).astype(np.float32)
+        scores = (self.weight_preference * (features @ profile)
+                  + self.weight_rating * rating_score
+                  + self.weight_distance * self._proximity(numeric[:, 1:], user_geo))
+
+        keep = np.ones(len(candidates), dtype=bool)
+        if disliked_features is not None and len(candidates) > self.min_keep:
+            max_similarity = (features @ disliked_features.T).max(axis=1)
+            too_similar = max_similarity >= self.dislike_similarity
+            # Отбрасываем самые похожие, но не больше, чем позволяет min_keep
+            droppable = np.flatnonzero(too_similar)
+            allowed_drops = max(len(candidates) - self.min_keep, 0)
+            if len(droppable) > allowed_drops:
+                droppable = droppable[np.argsort(-max_similarity[droppable], kind="stable")[:allowed_drops]]
+            keep[droppable] = False
+
+        order = np.argsort(-scores, kind="stable")
+        order = order[keep[order]].tolist()
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        ranking_stats["ranked"] += 1
+        ranking_stats["candidates"] += len(candidates)
+        ranking_stats["filtered"] += int((~keep).sum())
+        ranking_stats["last_ms"] = elapsed_ms
+        ranking_stats["max_ms"] = max(ranking_stats["max_ms"], elapsed_ms)
+        return [candidates[i] for i in order]
+
+
+recommendation_ranker = RecommendationRanker(
+    weight_preference=AI_RANKING_WEIGHT_PREFERENCE,
+    weight_rating=AI_RANKING_WEIGHT_RATING,
+    weight_distance=AI_RANKING_WEIGHT_DISTANCE,
+    distance_scale_km=AI_RANKING_DISTANCE_SCALE_KM,
+    dislike_similarity=AI_RANKING_DISLIKE_SIMILARITY,
+    min_keep=AI_RANKING_MIN_KEEP,
+    max_feedback=AI_RANKING_MAX_FEEDBACK,
+    feature_cache_size=AI_RANKING_FEATURE_CACHE_SIZE,
+)
+
+
+async def load_feedback_payloads(session: Optional[AsyncSession], user_telegram_id: int,
+                                 liked_ids: Iterable[str],
+                                 disliked_ids: Iterable[str]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Собирает лайкнутые и дизлайкнутые рекомендации пользователя (из FSM и таблицы feedbacks).
+    Полные payload берутся из каталога рекомендаций; для тех, что в каталоге нет, -
+    тип и кухня из индекса недавних рекомендаций процесса.
+    Списки упорядочены от старых к новым: сначала история из БД, затем фидбек текущей сессии.
+    """
+    # dict вместо set: дубликаты убираются, порядок сохраняется (профиль строится по последним отзывам)
+    liked = dict.fromkeys(str(i) for i in liked_ids)
+    disliked = dict.fromkeys(str(i) for i in disliked_ids)
+    payloads: Dict[str, Dict[str, Any]] = {}
+    if session is not None:
+        try:
+            db_liked, db_disliked = await crud.get_user_feedback_history(session, user_telegram_id)
+            liked = dict.fromkeys([*db_liked, *liked])
+            disliked = dict.fromkeys([*db_disliked, *disliked])
+            # При расхождении FSM и БД последний дизлайк важнее
+            liked = dict.fromkeys(rec_id for rec_id in liked if rec_id not in disliked)
+            missing = [*liked, *disliked]
+            if missing:
+                for row in await crud.get_recommendations_by_ids(session, missing):
+                    if isinstance(row.payload, dict):
+                        payloads[row.id] = row.payload
+        except SQLAlchemyError as e:
+            logging.error(f"Ranking: Ошибка чтения фидбека пользователя {user_telegram_id}: {e}")
+            await session.rollback()
+    for rec_id in [*liked, *disliked]:
+        if rec_id in payloads:
+            continue
+        indexed = recommendation_index.get(rec_id)
+        if indexed:
+            payloads[rec_id] = {"id": rec_id, "type": indexed.get("type"),
+                                "details": {"cuisine_type": indexed.get("cuisines") or []}}
+    return ([payloads[i] for i in liked if i in payloads],
+            [payloads[i] for i in disliked if i in payloads])
+
+
+async def rank_for_user(candidates: List[Dict[str, Any]], session: Optional[AsyncSession], user_telegram_id: int,
+                        request_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Переупорядочивает рекомендации под пользователя; при выключенном ранжировании возвращает их как есть."""
+    if not AI_RANKING_ENABLED or np is None or not candidates:
+        if AI_RANKING_ENABLED and np is None:
+            ranking_stats["skipped_no_numpy"] += 1
+        return candidates
+    liked, disliked = await load_feedback_payloads(
+        session, user_telegram_id,
+        request_data.get('liked_recommendation_ids') or [],
+        request_data.get('disliked_recommendation_ids') or [])
+    user_geo = request_data.get('user_location_geo')
+    if not liked and not disliked and not user_geo:
+        ranking_stats["skipped_no_feedback"] += 1  # Нет сигналов о пользователе - оставляем порядок AI
+        return candidates
+    ranked = recommendation_ranker.rank(candidates, liked, disliked, user_geo)
+    if len(ranked) != len(candidates):
+        logging.info(f"Ranking: Для пользователя {user_telegram_id} отброшено {len(candidates) - len(ranked)} "
+                     f"рекомендаций, похожих на дизлайкнутые.")
+    return ranked
+
+
+def get_ranking_stats() -> Dict[str, float]:
+    return dict(ranking_stats)
@@ -0,0 +1,74 @@
+# utils/rate_limit.py
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Классический token bucket: емкость capacity, пополнение rate токенов в секунду.
+    rate <= 0 означает отсутствие ограничения.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    def available(self) -> float:
+        if self.unlimited:
+            return float("inf")
+        self._refill()
+        return self._tokens
+
+    def time_until(self, amount: float = 1.0) -> float:
+        """Сколько секунд ждать, пока в ведре наберется amount токенов (0 - можно сразу)."""
+        if self.unlimited:
+            return 0.0
+        amount = min(amount, self.capacity)  # Запрос больше емкости иначе не выполнится никогда
+        self._refill()
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def consume(self, amount: float = 1.0) -> None:
+        """Списывает токены без ожидания (вызывающий сам проверяет time_until)."""
+        if self.unlimited:
+            return
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+
+    def try_consume(self, amount: float = 1.0) -> bool:
+        if self.time_until(amount) > 0:
+            return False
+        self.consume(amount)
+        return True
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """Ждет, пока токенов хватит, и списывает их. Возвращает время ожидания в секундах."""
+        waited = 0.0
+        while True:
+            delay = self.time_until(amount)
+            if delay <= 0:
+                self.consume(amount)
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """Опустошает ведро так, чтобы следующий токен появился не раньше чем через seconds."""
+        if self.unlimited or seconds <= 0:
+            return
+        self._refill()
+        self._tokens = min(self._tokens, 0.0) - seconds * self.rate
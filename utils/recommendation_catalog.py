@@ -0,0 +1,145 @@
+# utils/recommendation_catalog.py
+import hashlib
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import crud
+
+# Каталог включается явно: рекомендации одного пользователя отдаются другим с тем же местом и профилем запроса
+AI_CATALOG_ENABLED = os.getenv("AI_CATALOG_ENABLED", "0").lower() in ("1", "true", "yes")
+# Сколько рекомендаций считается полным набором: если в каталоге есть столько подходящих - AI не вызывается
+AI_CATALOG_TARGET_COUNT = int(os.getenv("AI_CATALOG_TARGET_COUNT", "5"))
+# Рекомендации старше этого возраста не отдаются (цены и часы работы меняются)
+AI_CATALOG_MAX_AGE_HOURS = float(os.getenv("AI_CATALOG_MAX_AGE_HOURS", "72"))
+# Точность округления координат для ключа места (1 знак ~ 11 км)
+AI_CATALOG_GEO_PRECISION = int(os.getenv("AI_CATALOG_GEO_PRECISION", "1"))
+
+_NON_WORD_RE = re.compile(r"[^\w]+", re.UNICODE)
+
+catalog_stats: Dict[str, int] = {"lookups": 0, "full_hits": 0, "partial_hits": 0, "misses": 0,
+                                 "items_served": 0, "items_stored": 0, "errors": 0}
+
+
+# Поля запроса, от которых зависит подборка, кроме места, языка и бюджета (они фильтруются отдельно)
+_PROFILE_FIELDS = ('user_interests_text', 'user_dietary_restrictions', 'user_accessibility_needs',
+                   'user_trip_dates_text', 'user_preferred_pace')
+_PROFILE_HASH_LENGTH = 16
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(_NON_WORD_RE.sub(" ", text.casefold()).split())
+
+
+def _profile_key(user_data_raw: Dict[str, Any]) -> str:
+    """
+    Хэш нормализованных интересов, ограничений (диета, доступность), дат и темпа поездки:
+    рекомендации из каталога получают только пользователи с тем же профилем запроса.
+    """
+    parts = []
+    for field in _PROFILE_FIELDS:
+        value = user_data_raw.get(field)
+        if isinstance(value, str):
+            parts.append(_normalize_text(value))
+        elif isinstance(value, (list, tuple, set)):
+            parts.append(",".join(sorted(_normalize_text(str(item)) for item in value)))
+        else:
+            parts.append("")
+    return hashlib.blake2b("\x1f".join(parts).encode("utf-8"), digest_size=_PROFILE_HASH_LENGTH // 2).hexdigest()
+
+
+def make_location_key(user_data_raw: Dict[str, Any]) -> Optional[str]:
+    """
+    Нормализованный ключ места назначения и профиля запроса: "geo:48.9,2.3|p:<хэш>" для координат или
+    "text:париж франция|p:<хэш>" для текста (регистр, пунктуация и лишние пробелы не важны).
+    """
+    suffix = f"|p:{_profile_key(user_data_raw)}"
+    geo = user_data_raw.get('user_location_geo')
+    if geo and isinstance(geo, list) and len(geo) == 2:
+        try:
+            lat, lon = float(geo[0]), float(geo[1])
+        except (TypeError, ValueError):
+            return None
+        return f"geo:{round(lat, AI_CATALOG_GEO_PRECISION)},{round(lon, AI_CATALOG_GEO_PRECISION)}{suffix}"
+    text = user_data_raw.get('user_location_text')
+    if text and isinstance(text, str):
+        normalized = _normalize_text(text)
+        if normalized:
+            return f"text:{normalized}"[:255 - len(suffix)] + suffix
+    return None
+
+
+def _coordinates(rec: Dict[str, Any]) -> List[Optional[float]]:
+    coords = rec.get("coordinates")
+    if isinstance(coords, list) and len(coords) == 2:
+        try:
+            return [float(coords[0]), float(coords[1])]
+        except (TypeError, ValueError):
+            pass
+    return [None, None]
+
+
+async def lookup(session: AsyncSession, location_key: str, language: str, budget: Optional[str],
+                 exclude_ids: Iterable[str], limit: int) -> List[Dict[str, Any]]:
+    """Свежие подходящие рекомендации из каталога (payload). Ошибки БД не мешают запросу к AI."""
+    catalog_stats["lookups"] += 1
+    fresh_since = datetime.now(timezone.utc) - timedelta(hours=AI_CATALOG_MAX_AGE_HOURS)
+    try:
+        rows = await crud.get_catalog_recommendations(session, location_key, language, fresh_since,
+                                                      budget=budget, exclude_ids=exclude_ids, limit=limit)
+    except SQLAlchemyError as e:
+        catalog_stats["errors"] += 1
+        logging.error(f"Recommendation Catalog: Ошибка чтения каталога для '{location_key}': {e}")
+        await session.rollback()
+        return []
+
+    items = [row.payload for row in rows if isinstance(row.payload, dict)]
+    if not items:
+        catalog_stats["misses"] += 1
+    elif len(items) >= limit:
+        catalog_stats["full_hits"] += 1
+    else:
+        catalog_stats["partial_hits"] += 1
+    catalog_stats["items_served"] += len(items)
+    return items
+
+
+async def store(session: AsyncSession, location_key: str, language: str, budget: Optional[str],
+                recommendations: Iterable[Any]) -> None:
+    """Сохраняет (upsert по id, месту и языку) рекомендации, сгенерированные AI, в каталог."""
+    rows = []
+    for rec in recommendations or []:
+        if not isinstance(rec, dict) or not isinstance(rec.get("id"), str) or not rec["id"].strip():
+            continue
+        if not isinstance(rec.get("type"), str) or not rec.get("name"):
+            continue  # Неполные рекомендации в каталог не попадают
+        latitude, longitude = _coordinates(rec)
+        rows.append({
+            "id": rec["id"],
+            "location_key": location_key,
+            "language": language,
+            "budget": budget,
+            "type": rec["type"][:32],
+            "latitude": latitude,
+            "longitude": longitude,
+            "payload": rec,
+        })
+    if not rows:
+        return
+    # Один INSERT ... ON CONFLICT DO UPDATE не может дважды обновить одну строку, а модель иногда повторяет id
+    rows = list({row["id"]: row for row in rows}.values())
+    try:
+        catalog_stats["items_stored"] += await crud.upsert_recommendations(session, rows)
+    except SQLAlchemyError as e:
+        catalog_stats["errors"] += 1
+        logging.error(f"Recommendation Catalog: Ошибка сохранения {len(rows)} рекомендаций в каталог: {e}")
+        await session.rollback()
+
+
+def get_catalog_stats() -> Dict[str, int]:
+    return dict(catalog_stats)
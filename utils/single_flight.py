@@ -0,0 +1,69 @@
+# utils/single_flight.py
+import asyncio
+import copy
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """
+    Объединяет одинаковые одновременные запросы: пока выполняется запрос с ключом key,
+    все остальные вызовы с тем же ключом ждут его результат (или его исключение)
+    вместо того, чтобы запускать собственный.
+    """
+
+    def __init__(self, name: str = "single_flight"):
+        self.name = name
+        self._in_flight: Dict[str, "asyncio.Task[Any]"] = {}
+        self._waiters: Dict[str, int] = {}
+        self.stats: Dict[str, int] = {"leaders": 0, "followers": 0}
+
+    async def run(self, key: str, coro_factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет coro_factory() не более одного раза на ключ одновременно.
+        Ведомые вызовы получают глубокую копию результата ведущего, чтобы не делить изменяемые объекты.
+        Отмена одного из ожидающих не отменяет общий запрос; он отменяется, только когда
+        его перестали ждать все.
+        """
+        task = self._in_flight.get(key)
+        is_follower = task is not None
+        if is_follower:
+            self.stats["followers"] += 1
+            logging.info(f"{self.name}: Запрос {key[:12]} уже выполняется, ожидаем его результат.")
+        else:
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(coro_factory())
+            self._in_flight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda _t: self._forget(key, _t))
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._release_waiter(key) == 0:
+                task.cancel()  # Больше никто не ждет - незачем тратить запрос к модели
+            raise
+        self._release_waiter(key)
+        return copy.deepcopy(result) if is_follower else result
+
+    def _release_waiter(self, key: str) -> int:
+        remaining = self._waiters.get(key, 1) - 1
+        if key in self._waiters:
+            self._waiters[key] = remaining
+        return remaining
+
+    def _forget(self, key: str, task: "asyncio.Task[Any]") -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+            self._waiters.pop(key, None)
+        # Забираем исключение, чтобы asyncio не ругался "Task exception was never retrieved",
+        # если все ожидающие были отменены
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight_count(self) -> int:
+        return len(self._in_flight)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "in_flight": len(self._in_flight)}
@@ -0,0 +1,264 @@
+# utils/telegram_media_cache.py
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+try:  # Блокировка файла между процессами (POSIX)
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TELEGRAM_MEDIA_CACHE_ENABLED = os.getenv("TELEGRAM_MEDIA_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+# Относительный путь считается от корня проекта, а не от текущего каталога процесса (пустое значение - без файла)
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TELEGRAM_MEDIA_CACHE_PATH = os.getenv("TELEGRAM_MEDIA_CACHE_PATH", "data/telegram_media_cache.json")
+if TELEGRAM_MEDIA_CACHE_PATH:
+    TELEGRAM_MEDIA_CACHE_PATH = os.path.join(_PROJECT_ROOT, TELEGRAM_MEDIA_CACHE_PATH)
+TELEGRAM_MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("TELEGRAM_MEDIA_CACHE_MAX_ENTRIES", "20000"))
+# Сколько помнить, что картинка по ссылке не отправляется (битая ссылка, не картинка, слишком большая)
+TELEGRAM_MEDIA_NEGATIVE_TTL_SECONDS = float(os.getenv("TELEGRAM_MEDIA_NEGATIVE_TTL_SECONDS", "21600"))
+# Не чаще одного сохранения на диск за этот интервал
+TELEGRAM_MEDIA_CACHE_SAVE_INTERVAL_SECONDS = float(os.getenv("TELEGRAM_MEDIA_CACHE_SAVE_INTERVAL_SECONDS", "30"))
+
+
+class TelegramMediaCache:
+    """
+    Кэш доставки картинок в Telegram.
+    Положительный кэш: URL -> file_id, который Telegram вернул после первой отправки; повторная
+    отправка по file_id не заставляет Telegram заново скачивать картинку.
+    Отрицательный кэш: URL, которые Telegram не смог отправить, с временем истечения - такие
+    карточки сразу уходят текстом, без ожидания ошибки.
+    Оба кэша сохраняются в JSON файл (атомарной заменой) и переживают перезапуск. Файл общий для
+    всех процессов (воркеры webhook): при сохранении под файловой блокировкой перечитывается файл,
+    поверх него применяются только изменения этого процесса, а записи других процессов
+    подхватываются в память - ничьи file_id и битые ссылки не теряются.
+    """
+
+    def __init__(self, path: Optional[str], max_entries: int = 20000, negative_ttl_seconds: float = 21600,
+                 save_interval_seconds: float = 30):
+        self.path = path
+        self.max_entries = max_entries
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.save_interval_seconds = save_interval_seconds
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self._broken: Dict[str, float] = {}  # URL -> время истечения (time.time(), переживает перезапуск)
+        # Несохраненные изменения этого процесса: URL -> новое значение (None - запись удалена)
+        self._changes: Dict[str, Dict[str, Any]] = {"file_ids": {}, "broken": {}}
+        self._save_task: Optional["asyncio.Task[None]"] = None
+        self.stats: Dict[str, int] = {"file_id_hits": 0, "file_id_misses": 0, "file_id_stored": 0,
+                                      "file_id_invalidated": 0, "negative_hits": 0, "negative_stored": 0,
+                                      "saves": 0, "save_errors": 0, "merged_from_disk": 0}
+        self._load()
+
+    def _read_file(self) -> Dict[str, Any]:
+        """Содержимое файла кэша без истекших битых ссылок (пустой кэш, если файла нет или он поврежден)."""
+        if not self.path or not os.path.exists(self.path):
+            return {"file_ids": OrderedDict(), "broken": {}}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Telegram Media Cache: Не удалось прочитать {self.path}: {e}. Начинаем с пустого кэша.")
+            return {"file_ids": OrderedDict(), "broken": {}}
+        now = time.time()
+        file_ids = OrderedDict((url, file_id) for url, file_id in (data.get("file_ids") or {}).items()
+                               if isinstance(url, str) and isinstance(file_id, str))
+        broken = {url: expires_at for url, expires_at in (data.get("broken") or {}).items()
+                  if isinstance(expires_at, (int, float)) and expires_at > now}
+        return {"file_ids": file_ids, "broken": broken}
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        data = self._read_file()
+        self._file_ids = data["file_ids"]
+        self._broken = data["broken"]
+        self._trim()
+        logging.info(f"Telegram Media Cache: Загружено {len(self._file_ids)} file_id и "
+                     f"{len(self._broken)} битых ссылок из {self.path}.")
+
+    def _trim(self) -> None:
+        self._file_ids, self._broken = self._trimmed(self._file_ids, self._broken)
+
+    def _trimmed(self, file_ids: "OrderedDict[str, str]",
+                 broken: Dict[str, float]) -> Tuple["OrderedDict[str, str]", Dict[str, float]]:
+        while len(file_ids) > self.max_entries:
+            file_ids.popitem(last=False)
+        if len(broken) > self.max_entries:
+            # Оставляем записи, которые истекают позже всех
+            broken = dict(sorted(broken.items(), key=lambda item: item[1])[-self.max_entries:])
+        return file_ids, broken
+
+    def get_file_id(self, url: str) -> Optional[str]:
+        file_id = self._file_ids.get(url)
+        if file_id is None:
+            self.stats["file_id_misses"] += 1
+            return None
+        self._file_ids.move_to_end(url)
+        self.stats["file_id_hits"] += 1
+        return file_id
+
+    def remember_file_id(self, url: str, file_id: str) -> None:
+        if self._file_ids.get(url) == file_id:
+            return
+        self._file_ids[url] = file_id
+        self._file_ids.move_to_end(url)
+        self._broken.pop(url, None)
+        self.stats["file_id_stored"] += 1
+        self._trim()
+        self._record_change("file_ids", url, file_id)
+        self._record_change("broken", url, None)
+
+    def forget_file_id(self, url: str) -> None:
+        """file_id перестал приниматься Telegram - следующая отправка снова пойдет по URL."""
+        if self._file_ids.pop(url, None) is not None:
+            self.stats["file_id_invalidated"] += 1
+            self._record_change("file_ids", url, None)
+
+    def is_broken(self, url: str) -> bool:
+        expires_at = self._broken.get(url)
+        if expires_at is None:
+            return False
+        if expires_at <= time.time():
+            del self._broken[url]  # Истекшие записи отбрасываются и при чтении файла - сохранять нечего
+            return False
+        self.stats["negative_hits"] += 1
+        return True
+
+    def mark_broken(self, url: str) -> None:
+        expires_at = time.time() + self.negative_ttl_seconds
+        self._broken[url] = expires_at
+        self._file_ids.pop(url, None)
+        self.stats["negative_stored"] += 1
+        self._trim()
+        self._record_change("broken", url, expires_at)
+        self._record_change("file_ids", url, None)
+
+    def _record_change(self, kind: str, url: str, value: Any) -> None:
+        self._changes[kind][url] = value
+        if not self.path or self._save_task is not None:
+            return
+        try:
+            self._save_task = asyncio.get_running_loop().create_task(self._delayed_save())
+        except RuntimeError:  # Нет цикла событий (скрипты, импорт) - сохранится при flush()
+            pass
+
+    def _take_changes(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        if not any(self._changes.values()):
+            return None
+        changes, self._changes = self._changes, {"file_ids": {}, "broken": {}}
+        return changes
+
+    async def _delayed_save(self) -> None:
+        try:
+            # Изменения за интервал сохраняются одной записью
+            await asyncio.sleep(self.save_interval_seconds)
+        finally:
+            self._save_task = None
+        changes = self._take_changes()
+        if changes:
+            merged = await asyncio.get_running_loop().run_in_executor(None, self._merge_and_write, changes)
+            self._adopt(changes, merged)
+
+    @contextmanager
+    def _file_lock(self):
+        """Эксклюзивная блокировка файла кэша между процессами (на время чтения, слияния и записи)."""
+        if fcntl is None:  # Нет fcntl (Windows) - без блокировки, слияние все равно сохраняет чужие записи
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _merge_and_write(self, changes: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        Под блокировкой перечитывает файл, применяет к нему изменения этого процесса и атомарно
+        записывает результат (временный файл в той же папке и os.replace). Возвращает итоговое
+        содержимое файла или None при ошибке.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with self._file_lock():
+                data = self._read_file()
+                file_ids, broken = data["file_ids"], data["broken"]
+                for url, file_id in changes["file_ids"].items():
+                    file_ids.pop(url, None)
+                    if file_id is not None:
+                        file_ids[url] = file_id  # Свежие записи - в конец, вытесняются последними
+                for url, expires_at in changes["broken"].items():
+                    if expires_at is None:
+                        broken.pop(url, None)
+                    else:
+                        broken[url] = expires_at
+                file_ids, broken = self._trimmed(file_ids, broken)
+                fd, tmp_path = tempfile.mkstemp(prefix=".media_cache_", suffix=".tmp", dir=directory)
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump({"file_ids": file_ids, "broken": broken}, f, ensure_ascii=False)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            self.stats["saves"] += 1
+            return {"file_ids": file_ids, "broken": broken}
+        except OSError as e:
+            self.stats["save_errors"] += 1
+            logging.error(f"Telegram Media Cache: Ошибка сохранения кэша в {self.path}: {e}")
+            return None
+
+    def _adopt(self, changes: Dict[str, Dict[str, Any]], merged: Optional[Dict[str, Any]]) -> None:
+        """Добавляет в память записи, которые другие процессы сохранили в файл."""
+        if merged is None:
+            # Запись не удалась - изменения вернутся в очередь и попадут в следующее сохранение
+            for kind, kind_changes in changes.items():
+                for url, value in kind_changes.items():
+                    self._changes[kind].setdefault(url, value)
+            return
+        adopted = 0
+        for url, file_id in merged["file_ids"].items():
+            if url not in self._file_ids and url not in self._changes["file_ids"] and url not in self._broken:
+                self._file_ids[url] = file_id
+                self._file_ids.move_to_end(url, last=False)  # Чужие записи вытесняются раньше своих
+                adopted += 1
+        for url, expires_at in merged["broken"].items():
+            if url not in self._broken and url not in self._changes["broken"] and url not in self._file_ids:
+                self._broken[url] = expires_at
+                adopted += 1
+        self.stats["merged_from_disk"] += adopted
+        self._trim()
+
+    def flush(self) -> None:
+        """Синхронно сохраняет несохраненные изменения (при остановке бота)."""
+        if self._save_task is not None:
+            self._save_task.cancel()
+            self._save_task = None
+        changes = self._take_changes() if self.path else None
+        if changes:
+            self._adopt(changes, self._merge_and_write(changes))
+
+    def get_stats(self) -> Dict[str, Any]:
+        file_id_lookups = self.stats["file_id_hits"] + self.stats["file_id_misses"]
+        return {
+            **self.stats,
+            "file_ids": len(self._file_ids),
+            "broken_urls": len(self._broken),
+            "file_id_hit_rate": self.stats["file_id_hits"] / file_id_lookups if file_id_lookups else 0.0,
+        }
+
+
+telegram_media_cache = TelegramMediaCache(
+    TELEGRAM_MEDIA_CACHE_PATH,
+    max_entries=TELEGRAM_MEDIA_CACHE_MAX_ENTRIES,
+    negative_ttl_seconds=TELEGRAM_MEDIA_NEGATIVE_TTL_SECONDS,
+    save_interval_seconds=TELEGRAM_MEDIA_CACHE_SAVE_INTERVAL_SECONDS,
+) if TELEGRAM_MEDIA_CACHE_ENABLED else None
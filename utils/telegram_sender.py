@@ -0,0 +1,190 @@
+# utils/telegram_sender.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from utils.rate_limit import TokenBucket
+
+# Лимиты Bot API: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат, 20 в минуту в группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+# Короткий всплеск в личный чат (несколько карточек подряд) Telegram допускает
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))
+# Сколько раз отправка повторяется после 429 (retry_after), прежде чем ошибка уйдет вызывающему
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "3"))
+# Сколько простаивающих чатов хранить вместе с их token bucket
+TELEGRAM_SEND_MAX_IDLE_CHATS = int(os.getenv("TELEGRAM_SEND_MAX_IDLE_CHATS", "10000"))
+# Карточки с фото отправляются альбомами (sendMediaGroup) с одним общим сообщением-клавиатурой
+TELEGRAM_ALBUM_MODE = os.getenv("TELEGRAM_ALBUM_MODE", "0").lower() in ("1", "true", "yes")
+
+SendFactory = Callable[[], Awaitable[Any]]
+
+
+class _ChatQueue:
+    __slots__ = ("bucket", "jobs", "worker")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.jobs: Deque[Tuple[SendFactory, "asyncio.Future[Any]", float, float]] = deque()
+        self.worker: Optional["asyncio.Task[None]"] = None
+
+
+class TelegramSendScheduler:
+    """
+    Планировщик исходящих сообщений бота.
+    У каждого чата своя FIFO очередь и свой воркер: сообщения одного чата уходят строго по порядку,
+    а разные чаты отправляются параллельно. Перед каждой отправкой списывается токен из ведра чата
+    (личные чаты и группы - с разными лимитами) и из общего ведра бота. На 429 (TelegramRetryAfter)
+    чат ставится на паузу на retry_after секунд, и та же отправка повторяется, не нарушая порядка.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float, group_rate_per_minute: float,
+                 max_retries: int = 3, max_idle_chats: int = 10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60.0
+        self.max_retries = max_retries
+        self.max_idle_chats = max_idle_chats
+        self._global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self._chats: "OrderedDict[int, _ChatQueue]" = OrderedDict()
+        self.stats: Dict[str, float] = {
+            "submitted": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "cancelled": 0,
+            "retry_after_seconds_total": 0.0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "max_queue_depth": 0,
+        }
+
+    def _chat_queue(self, chat_id: int) -> _ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if chat_id < 0:  # Группы и каналы
+                bucket = TokenBucket(rate=self.group_rate, capacity=1)
+            else:
+                bucket = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+            chat = self._chats[chat_id] = _ChatQueue(bucket)
+            self._evict_idle_chats()
+        self._chats.move_to_end(chat_id)
+        return chat
+
+    def _evict_idle_chats(self) -> None:
+        if len(self._chats) <= self.max_idle_chats:
+            return
+        for chat_id in list(self._chats):
+            if len(self._chats) <= self.max_idle_chats:
+                break
+            chat = self._chats[chat_id]
+            if not chat.jobs and chat.worker is None:
+                del self._chats[chat_id]
+
+    def queue_depth(self) -> int:
+        return sum(len(chat.jobs) for chat in self._chats.values())
+
+    def submit(self, chat_id: int, factory: SendFactory, cost: float = 1.0) -> "asyncio.Future[Any]":
+        """
+        Ставит отправку в очередь чата и сразу возвращает future с результатом вызова Bot API.
+        factory создает корутину отправки (может вызываться повторно после retry_after).
+        cost - сколько сообщений отправка занимает в лимитах (альбом считается по числу фото).
+        """
+        future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        chat = self._chat_queue(chat_id)
+        chat.jobs.append((factory, future, time.monotonic(), cost))
+        self.stats["submitted"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(chat.jobs))
+        if chat.worker is None:
+            chat.worker = asyncio.create_task(self._chat_worker(chat_id, chat))
+        return future
+
+    async def send(self, chat_id: int, factory: SendFactory, cost: float = 1.0) -> Any:
+        """Отправка с ожиданием результата (с соблюдением порядка и лимитов)."""
+        return await self.submit(chat_id, factory, cost)
+
+    async def _acquire(self, chat: _ChatQueue, cost: float) -> None:
+        # Сначала ведро чата: пока чат ждет свой лимит, общий токен не расходуется
+        await chat.bucket.acquire(cost)
+        await self._global_bucket.acquire(cost)
+
+    async def _chat_worker(self, chat_id: int, chat: _ChatQueue) -> None:
+        try:
+            while chat.jobs:
+                factory, future, enqueued_at, cost = chat.jobs[0]
+                if future.cancelled():
+                    chat.jobs.popleft()
+                    self.stats["cancelled"] += 1
+                    continue
+                await self._acquire(chat, cost)
+                waited = time.monotonic() - enqueued_at
+                self.stats["wait_seconds_total"] += waited
+                self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+
+                attempt = 0
+                while True:
+                    try:
+                        result = await factory()
+                    except TelegramRetryAfter as e:
+                        attempt += 1
+                        self.stats["retry_after_seconds_total"] += e.retry_after
+                        if attempt > self.max_retries:
+                            self._finish(future, error=e)
+                            break
+                        self.stats["retried"] += 1
+                        logging.warning(f"Telegram Sender: 429 для чата {chat_id}, пауза {e.retry_after} с "
+                                        f"(попытка {attempt}/{self.max_retries}).")
+                        chat.bucket.pause(e.retry_after)
+                        await self._acquire(chat, cost)
+                    except Exception as e:
+                        self._finish(future, error=e)
+                        break
+                    else:
+                        self._finish(future, result=result)
+                        break
+                chat.jobs.popleft()
+        finally:
+            chat.worker = None
+            # Если воркер отменили с непустой очередью, оставшиеся отправки не должны висеть вечно
+            while chat.jobs:
+                _, future, _, _ = chat.jobs.popleft()
+                if not future.done():
+                    future.cancel()
+                    self.stats["cancelled"] += 1
+
+    def _finish(self, future: "asyncio.Future[Any]", result: Any = None,
+                error: Optional[BaseException] = None) -> None:
+        if future.done():  # Вызывающий перестал ждать (отмена хэндлера)
+            return
+        if error is not None:
+            self.stats["failed"] += 1
+            future.set_exception(error)
+        else:
+            self.stats["sent"] += 1
+            future.set_result(result)
+
+    def get_stats(self) -> Dict[str, Any]:
+        started = self.stats["sent"] + self.stats["failed"]
+        return {
+            **self.stats,
+            "queue_depth": self.queue_depth(),
+            "active_chats": sum(1 for chat in self._chats.values() if chat.worker is not None),
+            "tracked_chats": len(self._chats),
+            "avg_wait_seconds": self.stats["wait_seconds_total"] / started if started else 0.0,
+        }
+
+
+telegram_sender = TelegramSendScheduler(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    group_rate_per_minute=TELEGRAM_GROUP_RATE_PER_MINUTE,
+    max_retries=TELEGRAM_SEND_MAX_RETRIES,
+    max_idle_chats=TELEGRAM_SEND_MAX_IDLE_CHATS,
+)
@@ -0,0 +1,298 @@
+"""
+Режим webhook: HTTP сервер aiohttp принимает апдейты от Telegram и раздает их WEBHOOK_WORKERS
+процессам-воркерам, в каждом из которых работает свой диспетчер (main.build_dispatcher()).
+Воркер выбирается по ID пользователя, поэтому все апдейты одного пользователя попадают в один
+процесс. Внутри воркера апдейты одного пользователя обрабатываются строго по очереди (следующий -
+после завершения предыдущего, вместе с записью FSM), а апдейты разных пользователей - параллельно.
+
+Лимиты планировщика AI (AI_RATE_LIMIT_RPM/TPM, AI_MAX_CONCURRENCY) действуют в каждом воркере отдельно:
+для общего лимита на бота их нужно разделить на число воркеров.
+
+Запуск:  python webhook_server.py
+Локальная проверка без Telegram (WEBHOOK_URL не задан - webhook не регистрируется):
+    curl -X POST -H "Content-Type: application/json" --data @update.json http://localhost:8080/webhook
+Автотест с записанными апдейтами (tests/data/webhook_updates.json): python -m pytest tests/test_webhook_server.py
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import main as bot_main  # Загружает .env и настраивает логирование до остальных импортов
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+
+from utils.metrics import METRICS_PORT, start_metrics_server
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Публичный URL для setWebhook (без него сервер просто принимает POST - удобно для локальных тестов)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+# Сколько апдейтов может ждать в очереди одного воркера; при переполнении Telegram получит 503 и повторит позже
+WEBHOOK_WORKER_QUEUE_SIZE = int(os.getenv("WEBHOOK_WORKER_QUEUE_SIZE", "1000"))
+# Сколько воркер ждет завершения начатых апдейтов при остановке
+WEBHOOK_DRAIN_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SECONDS", "30"))
+
+_STOP = None  # Сигнал воркеру: новых апдейтов не будет
+
+# Элемент очереди воркера: ключ шардирования (пользователь) и тело апдейта как пришло от Telegram
+QueuedUpdate = Tuple[int, bytes]
+
+
+def shard_key(update: Dict[str, Any]) -> int:
+    """ID пользователя (или чата) апдейта; для апдейтов без пользователя - update_id."""
+    for field, payload in update.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        for owner_field in ("from", "user", "voter_chat"):
+            owner = payload.get(owner_field)
+            if isinstance(owner, dict) and isinstance(owner.get("id"), int):
+                return owner["id"]
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and isinstance(chat.get("id"), int):
+            return chat["id"]
+    return int(update.get("update_id") or 0)
+
+
+# --- Воркер ---
+
+class KeyedUpdateRunner:
+    """
+    Выполняет апдейты с одинаковым ключом (пользователем) строго по очереди, а с разными - параллельно.
+    У каждого активного ключа своя FIFO очередь и своя задача-обработчик (как очереди чатов в
+    telegram_sender): задача разбирает очередь до конца и завершается, ключ без апдейтов не хранится.
+    """
+
+    def __init__(self, process: Callable[[bytes], Awaitable[None]]):
+        self._process = process
+        self._queues: Dict[int, Deque[bytes]] = {}
+        self._workers: Dict[int, "asyncio.Task[None]"] = {}
+        self.stats: Dict[str, int] = {"submitted": 0, "processed": 0, "failed": 0, "max_active_keys": 0}
+
+    def submit(self, key: int, raw_update: bytes) -> None:
+        self._queues.setdefault(key, deque()).append(raw_update)
+        self.stats["submitted"] += 1
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run_key(key))
+            self.stats["max_active_keys"] = max(self.stats["max_active_keys"], len(self._workers))
+
+    async def _run_key(self, key: int) -> None:
+        key_queue = self._queues[key]
+        try:
+            while key_queue:
+                raw_update = key_queue.popleft()
+                try:
+                    await self._process(raw_update)
+                    self.stats["processed"] += 1
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    logging.error(f"Webhook: Ошибка обработки апдейта (ключ {key}): {e}", exc_info=True)
+        finally:
+            # Между проверкой пустой очереди и удалением нет await - новый апдейт не потеряется
+            del self._queues[key]
+            del self._workers[key]
+
+    def pending(self) -> int:
+        return sum(len(key_queue) for key_queue in self._queues.values()) + len(self._workers)
+
+    async def drain(self, timeout: float) -> int:
+        """Дожидается всех принятых апдейтов; по таймауту отменяет оставшиеся и возвращает их число."""
+        if not self._workers:
+            return 0
+        done, pending = await asyncio.wait(list(self._workers.values()), timeout=timeout)
+        dropped = sum(len(self._queues.get(key, ())) for key, task in self._workers.items() if task in pending)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        return dropped + len(pending)
+
+
+async def consume_updates(worker_id: int, updates: "multiprocessing.Queue[Optional[QueuedUpdate]]",
+                          process: Callable[[bytes], Awaitable[None]],
+                          drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT_SECONDS) -> Dict[str, int]:
+    """
+    Читает очередь воркера до _STOP и раздает апдейты KeyedUpdateRunner. После _STOP дожидается
+    обработки всего, что было принято (не дольше drain_timeout). Возвращает статистику.
+    """
+    loop = asyncio.get_running_loop()
+    runner = KeyedUpdateRunner(process)
+    while True:
+        item = await loop.run_in_executor(None, updates.get)
+        if item is _STOP:
+            break
+        key, raw_update = item
+        runner.submit(key, raw_update)
+
+    pending = runner.pending()
+    if pending:
+        logging.info(f"Webhook воркер {worker_id}: Дожидаемся обработки принятых апдейтов ({pending})...")
+    dropped = await runner.drain(drain_timeout)
+    if dropped:
+        logging.warning(f"Webhook воркер {worker_id}: {dropped} апдейтов не успели обработаться "
+                        f"за {drain_timeout:g} с и отменены.")
+    return {**runner.stats, "dropped_on_stop": dropped}
+
+
+async def _worker_loop(worker_id: int, updates: "multiprocessing.Queue[Optional[QueuedUpdate]]") -> None:
+    dp = bot_main.build_dispatcher()
+    bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(bot_main.bot_api_metrics_middleware)
+    # У каждого воркера свои метрики и свой порт: METRICS_PORT + 1 + номер воркера
+    metrics_runner = await start_metrics_server(METRICS_PORT + 1 + worker_id) if METRICS_PORT else None
+    await dp.emit_startup(bot=bot)
+    stats: Dict[str, int] = {}
+
+    async def process(raw_update: bytes) -> None:
+        await dp.feed_raw_update(bot, json.loads(raw_update))
+
+    logging.info(f"Webhook воркер {worker_id} (pid {os.getpid()}) запущен.")
+    try:
+        stats = await consume_updates(worker_id, updates, process)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if bot_main.telegram_media_cache:
+            bot_main.telegram_media_cache.flush()
+        from database.db_setup import async_engine
+        if async_engine:
+            await async_engine.dispose()
+        logging.info(f"Webhook воркер {worker_id} остановлен: {stats}.")
+
+
+def _worker_main(worker_id: int, updates: "multiprocessing.Queue[Optional[QueuedUpdate]]") -> None:
+    # Останавливает воркер только _STOP от сервера: Ctrl+C приходит всей группе процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker_loop(worker_id, updates))
+
+
+# --- HTTP сервер ---
+
+class WebhookFanout:
+    """Принимает апдейты по HTTP и раскладывает их по очередям воркеров (шардирование по пользователю)."""
+
+    def __init__(self, workers: int, queue_size: int, secret: Optional[str] = None):
+        context = multiprocessing.get_context("spawn")  # fork процесса с event loop и сокетами небезопасен
+        self.secret = secret
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(max(workers, 1))]
+        self.processes = [context.Process(target=_worker_main, args=(i, q), name=f"webhook-worker-{i}")
+                          for i, q in enumerate(self.queues)]
+        self.accepting = True
+        self.stats: Dict[str, int] = {"received": 0, "rejected_full": 0, "rejected_auth": 0, "bad_request": 0}
+
+    def start(self) -> None:
+        for process in self.processes:
+            process.start()
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            self.stats["rejected_auth"] += 1
+            return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)  # Идет остановка - Telegram повторит доставку позже
+        raw_update = await request.read()
+        try:
+            update = json.loads(raw_update)
+        except ValueError:
+            self.stats["bad_request"] += 1
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            self.stats["bad_request"] += 1
+            return web.Response(status=400)
+
+        key = shard_key(update)
+        worker_queue = self.queues[key % len(self.queues)]
+        try:
+            worker_queue.put_nowait((key, raw_update))
+        except queue.Full:
+            self.stats["rejected_full"] += 1
+            logging.warning("Webhook: Очередь воркера переполнена, апдейт отклонен (Telegram повторит).")
+            return web.Response(status=503)
+        self.stats["received"] += 1
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        alive = sum(1 for process in self.processes if process.is_alive())
+        return web.json_response({**self.stats, "workers_alive": alive, "workers": len(self.processes)},
+                                 status=200 if alive == len(self.processes) else 503)
+
+    async def drain(self) -> None:
+        """Перестает принимать апдейты, отдает воркерам _STOP и ждет их завершения."""
+        self.accepting = False
+        loop = asyncio.get_running_loop()
+        for worker_queue in self.queues:
+            await loop.run_in_executor(None, worker_queue.put, _STOP)
+        deadline = time.monotonic() + WEBHOOK_DRAIN_TIMEOUT_SECONDS + 10
+        for process in self.processes:
+            if process.pid is None:  # Не запускался (например, fanout без воркеров в тестах)
+                continue
+            await loop.run_in_executor(None, process.join, max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logging.warning(f"Webhook: {process.name} не завершился вовремя, принудительная остановка.")
+                process.terminate()
+
+
+def build_app(fanout: WebhookFanout) -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, fanout.handle_update)
+    app.router.add_get("/healthz", fanout.handle_health)
+    return app
+
+
+async def run_webhook_server() -> None:
+    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not bot_token:
+        logging.error("ОШИБКА: Не найден TELEGRAM_BOT_TOKEN в файле .env! Проверь.")
+        return
+
+    fanout = WebhookFanout(WEBHOOK_WORKERS, WEBHOOK_WORKER_QUEUE_SIZE, WEBHOOK_SECRET)
+    fanout.start()
+
+    runner = web.AppRunner(build_app(fanout))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Webhook сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, воркеров: {len(fanout.processes)}.")
+
+    if WEBHOOK_URL:
+        bot = Bot(token=bot_token)
+        try:
+            # Апдейты, пришедшие во время перезапуска, не теряются: Telegram доставит их повторно
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=False,
+                                  allowed_updates=bot_main.resolve_used_update_types())
+            logging.info(f"Webhook зарегистрирован в Telegram: {WEBHOOK_URL}")
+        finally:
+            await bot.session.close()
+    else:
+        logging.info("WEBHOOK_URL не задан: webhook в Telegram не регистрируется (локальный режим).")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+
+    logging.info("Webhook сервер останавливается: новые апдейты не принимаются, дожидаемся воркеров...")
+    await site.stop()
+    await fanout.drain()
+    await runner.cleanup()
+    logging.info(f"Webhook сервер остановлен: {fanout.stats}.")
+
+
+if __name__ == '__main__':
+    asyncio.run(run_webhook_server())